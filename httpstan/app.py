@@ -3,11 +3,32 @@
 Configure the server and schedule startup and shutdown tasks.
 """
 
+import asyncio
+import contextlib
+import functools
 import logging
+import typing
 
 import aiohttp.web
 
+import httpstan.cache
+import httpstan.models
 import httpstan.routes
+import httpstan.scheduler
+from httpstan.config import (
+    HTTPSTAN_CACHE_EVICTION_INTERVAL,
+    HTTPSTAN_CACHE_MAX_DATASET_BYTES,
+    HTTPSTAN_CACHE_MAX_DATASETS,
+    HTTPSTAN_CACHE_MAX_FIT_BYTES,
+    HTTPSTAN_CACHE_MAX_FITS,
+    HTTPSTAN_CACHE_MAX_MODEL_BYTES,
+    HTTPSTAN_CACHE_MAX_MODELS,
+    HTTPSTAN_CACHE_MAX_OBJECT_BYTES,
+    HTTPSTAN_CACHE_MAX_OBJECTS,
+    HTTPSTAN_CACHE_TTL,
+    HTTPSTAN_MAX_QUEUED_FITS,
+    HTTPSTAN_NUM_WORKERS,
+)
 
 logger = logging.getLogger("httpstan")
 
@@ -23,6 +44,100 @@ async def _warn_unfinished_operations(app: aiohttp.web.Application) -> None:
             logger.critical(f"Operation `{name}` cancelled before finishing.")
 
 
+def _in_use(app: aiohttp.web.Application) -> typing.Set[str]:
+    """Get names of models being built, and of models and data sets used by unfinished operations."""
+    in_use = set(app["model_builds"])
+    for operation in app["operations"].values():
+        if operation["done"]:
+            continue
+        metadata = operation.get("metadata", {})
+        fits = metadata.get("fits", [metadata["fit"]] if "fit" in metadata else [])
+        # fit names look like models/{model_id}/fits/{fit_id}
+        in_use.update(fit["name"].rsplit("/", maxsplit=2)[0] for fit in fits)
+        if "dataset" in metadata:
+            in_use.add(metadata["dataset"]["name"])
+    return in_use
+
+
+async def _evict_from_cache(app: aiohttp.web.Application) -> None:
+    """Enforce cache limits, every ``HTTPSTAN_CACHE_EVICTION_INTERVAL`` seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # scanning the cache directory may take a while. Scan in a different thread.
+            evicted = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    httpstan.cache.evict,
+                    max_models=HTTPSTAN_CACHE_MAX_MODELS,
+                    max_model_bytes=HTTPSTAN_CACHE_MAX_MODEL_BYTES,
+                    max_fits=HTTPSTAN_CACHE_MAX_FITS,
+                    max_fit_bytes=HTTPSTAN_CACHE_MAX_FIT_BYTES,
+                    max_datasets=HTTPSTAN_CACHE_MAX_DATASETS,
+                    max_dataset_bytes=HTTPSTAN_CACHE_MAX_DATASET_BYTES,
+                    max_objects=HTTPSTAN_CACHE_MAX_OBJECTS,
+                    max_object_bytes=HTTPSTAN_CACHE_MAX_OBJECT_BYTES,
+                    ttl=HTTPSTAN_CACHE_TTL,
+                    in_use=_in_use(app),
+                    precompiled_header_salt=httpstan.models.stan_headers_salt(),
+                ),
+            )
+        except Exception as exc:  # pragma: no cover
+            logger.error(f"Unable to evict entries from the cache: {exc}")
+        else:
+            for name in evicted:
+                logger.info(f"Evicted `{name}` from the cache.")
+                httpstan.models.evict_services_extension_module(name)
+        await asyncio.sleep(HTTPSTAN_CACHE_EVICTION_INTERVAL)
+
+
+async def _start_cache_eviction(app: aiohttp.web.Application) -> None:
+    limits = (
+        HTTPSTAN_CACHE_MAX_MODELS,
+        HTTPSTAN_CACHE_MAX_MODEL_BYTES,
+        HTTPSTAN_CACHE_MAX_FITS,
+        HTTPSTAN_CACHE_MAX_FIT_BYTES,
+        HTTPSTAN_CACHE_MAX_DATASETS,
+        HTTPSTAN_CACHE_MAX_DATASET_BYTES,
+        HTTPSTAN_CACHE_MAX_OBJECTS,
+        HTTPSTAN_CACHE_MAX_OBJECT_BYTES,
+        HTTPSTAN_CACHE_TTL,
+    )
+    if any(limits):
+        app["cache_eviction_task"] = asyncio.create_task(_evict_from_cache(app))
+
+
+async def _stop_cache_eviction(app: aiohttp.web.Application) -> None:
+    task = app.get("cache_eviction_task")
+    if task is not None:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+async def _precompile_header(app: aiohttp.web.Application) -> None:
+    """Precompile the Stan model header in the background, so model builds need not wait for it.
+
+    Model builds starting before the header is precompiled wait for it.
+
+    """
+    try:
+        await httpstan.models.precompile_header()
+    except Exception as exc:  # pragma: no cover
+        logger.warning(f"Unable to precompile the Stan model header: {exc}")
+
+
+async def _start_precompiling_header(app: aiohttp.web.Application) -> None:
+    app["precompile_header_task"] = asyncio.create_task(_precompile_header(app))
+
+
+async def _stop_precompiling_header(app: aiohttp.web.Application) -> None:
+    task = app["precompile_header_task"]
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+
 def make_app() -> aiohttp.web.Application:
     """Assemble aiohttp Application.
 
@@ -35,5 +150,16 @@ def make_app() -> aiohttp.web.Application:
     httpstan.routes.setup_routes(app)
     # startup and shutdown tasks
     app["operations"] = {}
+    # queues to which messages from running operations are forwarded, keyed by operation name
+    app["operation_message_queues"] = {}
+    # tasks running operations, keyed by operation name
+    app["operation_tasks"] = {}
+    # tasks building models and their operations, keyed by model name
+    app["model_builds"] = {}
+    app["fit_scheduler"] = httpstan.scheduler.FitScheduler(HTTPSTAN_NUM_WORKERS, HTTPSTAN_MAX_QUEUED_FITS)
+    app.on_startup.append(_start_cache_eviction)
+    app.on_startup.append(_start_precompiling_header)
     app.on_cleanup.append(_warn_unfinished_operations)
+    app.on_cleanup.append(_stop_cache_eviction)
+    app.on_cleanup.append(_stop_precompiling_header)
     return app
@@ -8,24 +8,235 @@ isort:skip_file
 
 import setuptools
 import setuptools.command.build_ext as build_ext
+import asyncio
+import fcntl
+import functools
+import hashlib
 import io
+import json
 import logging
 import os
+import platform
+import shutil
+import subprocess
 import sys
 import tempfile
-from typing import IO, Any, List, TextIO
+import traceback
+from pathlib import Path
+from typing import IO, Any, Callable, List, Optional, TextIO
 
-from httpstan.config import HTTPSTAN_DEBUG
+import httpstan.cache
+from httpstan.config import HTTPSTAN_COMPILE_NICE, HTTPSTAN_DEBUG
 
+logger = logging.getLogger("httpstan")
 
-def run_build_ext(extensions: List[setuptools.Extension], build_lib: str) -> str:
+# maximum size of a message from a build process. Compiler output can be large.
+MESSAGE_SIZE_LIMIT = 256 * 1024**2
+# header included by every generated model, precompiled if `precompiled_header_salt` is provided
+PRECOMPILED_HEADER = "stan/model/model_header.hpp"
+
+
+@functools.lru_cache()
+def _compiler_version(compiler: str) -> str:
+    """Get the version message of a compiler, e.g., the output of ``g++ --version``."""
+    return subprocess.run([compiler, "--version"], capture_output=True, text=True).stdout
+
+
+def _object_cache_key(
+    compiler_so: List[str], cc_args: List[str], extra_postargs: List[str], src: str, salt: str
+) -> str:
+    """Calculate the key of an object file in the object cache.
+
+    The key is a hash of the source code, the compiler command and arguments,
+    the compiler version and `salt`. Include directories are left out, as
+    their paths differ between environments. What matters about the headers
+    found in them must be recorded in `salt`.
+
+    """
+    hash = _compile_hash(compiler_so, cc_args, extra_postargs, salt)
+    hash.update(Path(src).read_bytes())
+    return hash.hexdigest()
+
+
+def _compile_hash(
+    compiler_so: List[str], cc_args: List[str], extra_postargs: List[str], salt: str
+) -> "hashlib.blake2b":
+    """Hash the compiler command and arguments, without include directories, the compiler version and `salt`."""
+    hash = hashlib.blake2b(digest_size=20)
+    for arg in compiler_so + [arg for arg in cc_args if not arg.startswith("-I")] + extra_postargs:
+        hash.update(arg.encode() + b"\0")
+    hash.update(_compiler_version(compiler_so[0]).encode())
+    hash.update(salt.encode())
+    return hash
+
+
+def _precompiled_header(
+    compiler_so: List[str], cc_args: List[str], extra_postargs: List[str], salt: str
+) -> Optional[Path]:
+    """Get the directory holding `PRECOMPILED_HEADER` precompiled with the given compiler arguments.
+
+    The header is precompiled on first use. GCC looks for ``<header>.gch``
+    in each include directory before the header itself, so the directory
+    returned is placed first among the include directories. GCC ignores a
+    precompiled header built with different arguments.
+
+    Returns ``None`` if the compiler is not GCC or if precompiling fails.
+
+    """
+    if platform.system() == "Darwin" or "clang" in _compiler_version(compiler_so[0]):  # pragma: no cover
+        # Clang only uses precompiled headers passed with `-include-pch`
+        return None
+    include_dirs = [Path(arg[len("-I") :]) for arg in cc_args if arg.startswith("-I")]
+    headers = [path / PRECOMPILED_HEADER for path in include_dirs if (path / PRECOMPILED_HEADER).exists()]
+    if not headers:
+        return None
+    directory = httpstan.cache.precompiled_header_directory()
+    key = _compile_hash(compiler_so, cc_args, extra_postargs, salt).hexdigest()
+    precompiled_path = directory / key / f"{PRECOMPILED_HEADER}.gch"
+    if precompiled_path.exists():
+        httpstan.cache.record_access(precompiled_path)
+        return directory / key
+    directory.mkdir(parents=True, exist_ok=True)
+    # concurrent builds wait for the header to be precompiled once
+    with (directory / f"{key}.lock").open("a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if precompiled_path.exists():
+            httpstan.cache.record_access(precompiled_path)
+            return directory / key
+        logger.info(f"Precompiling `{PRECOMPILED_HEADER}`. This takes a minute or two.")
+        try:
+            precompiled_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=precompiled_path.parent, prefix=".httpstan_", suffix=".gch")
+            os.close(fd)
+        except OSError as exc:  # pragma: no cover
+            logger.warning(f"Unable to precompile `{PRECOMPILED_HEADER}`: {exc}")
+            return None
+        try:
+            command = compiler_so + cc_args + ["-x", "c++-header", str(headers[0]), "-o", temp_path] + extra_postargs
+            subprocess.run(command, capture_output=True, check=True)
+            os.chmod(temp_path, 0o644)
+            # the salt tells which Stan headers were precompiled, letting headers no longer used be pruned
+            (directory / key / "salt").write_text(salt)
+            os.replace(temp_path, precompiled_path)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            os.unlink(temp_path)
+            logger.warning(f"Unable to precompile `{PRECOMPILED_HEADER}`: {exc}")
+            return None
+    return directory / key
+
+
+def _store_object(obj: str, cached_path: Path) -> None:
+    """Copy an object file into the object cache, replacing any existing file atomically."""
+    cached_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=cached_path.parent, prefix=".httpstan_", suffix=".o")
+    os.close(fd)
+    try:
+        shutil.copyfile(obj, temp_path)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, cached_path)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+
+
+class _build_ext_with_progress(build_ext.build_ext):  # type: ignore
+    """build_ext which reports when compiling and when linking starts.
+
+    If `object_cache_salt` is set, object files are looked up in the object
+    cache (see ``httpstan.cache.object_cache_directory``) before compiling,
+    and stored there after compiling.
+
+    If `precompiled_header_salt` is set, sources are compiled against a
+    precompiled `PRECOMPILED_HEADER` (see `_precompiled_header`).
+
+    """
+
+    progress_callback: Optional[Callable[[str], None]] = None
+    object_cache_salt: Optional[str] = None
+    precompiled_header_salt: Optional[str] = None
+
+    def build_extension(self, ext: setuptools.Extension) -> None:
+        precompiled_header_salt = self.precompiled_header_salt
+        if precompiled_header_salt is not None:
+            compile_without_header, header_compiler_so = self.compiler._compile, self.compiler.compiler_so
+
+            def compile_object_with_precompiled_header(
+                obj: str, src: str, src_ext: str, cc_args: List[str], extra_postargs: List[str], pp_opts: List[str]
+            ) -> None:
+                directory = _precompiled_header(header_compiler_so, cc_args, extra_postargs, precompiled_header_salt)
+                if directory is not None:
+                    cc_args = [f"-I{directory}"] + cc_args
+                compile_without_header(obj, src, src_ext, cc_args, extra_postargs, pp_opts)
+
+            self.compiler._compile = compile_object_with_precompiled_header
+        salt = self.object_cache_salt
+        if salt is not None:
+            compile_object, compiler_so = self.compiler._compile, self.compiler.compiler_so
+            object_cache_directory = httpstan.cache.object_cache_directory()
+
+            def compile_object_with_cache(
+                obj: str, src: str, src_ext: str, cc_args: List[str], extra_postargs: List[str], pp_opts: List[str]
+            ) -> None:
+                key = _object_cache_key(compiler_so, cc_args, extra_postargs, src, salt)
+                cached_path = object_cache_directory / f"{key}.o"
+                try:
+                    shutil.copyfile(cached_path, obj)
+                    httpstan.cache.record_access(cached_path)
+                    return
+                except FileNotFoundError:
+                    pass
+                compile_object(obj, src, src_ext, cc_args, extra_postargs, pp_opts)
+                try:
+                    _store_object(obj, cached_path)
+                except OSError as exc:  # pragma: no cover
+                    logger.warning(f"Unable to store object file in `{object_cache_directory}`: {exc}")
+
+            self.compiler._compile = compile_object_with_cache
+        progress_callback = self.progress_callback
+        if progress_callback is not None:
+            compile, link_shared_object = self.compiler.compile, self.compiler.link_shared_object
+
+            def compile_with_progress(*args: Any, **kwargs: Any) -> Any:
+                progress_callback("compile")
+                return compile(*args, **kwargs)
+
+            def link_shared_object_with_progress(*args: Any, **kwargs: Any) -> Any:
+                progress_callback("link")
+                return link_shared_object(*args, **kwargs)
+
+            self.compiler.compile = compile_with_progress
+            self.compiler.link_shared_object = link_shared_object_with_progress
+        super().build_extension(ext)
+
+
+def run_build_ext(
+    extensions: List[setuptools.Extension],
+    build_lib: str,
+    progress_callback: Optional[Callable[[str], None]] = None,
+    object_cache_salt: Optional[str] = None,
+    precompiled_header_salt: Optional[str] = None,
+) -> str:
     """Configure and call `build_ext.run()`, capturing stderr.
 
-    Compiled extension module will be placed in `build_lib`.
+    Compiled extension module will be placed in `build_lib`. Object files
+    are placed in a temporary directory, deleted after the build.
 
     All messages sent to stderr will be saved and returned. These
     messages are typically messages from the compiler or linker.
 
+    If provided, `progress_callback` is called with ``"compile"`` before
+    compiling and with ``"link"`` before linking.
+
+    If `object_cache_salt` is provided, compiled object files are shared
+    through the object cache. `object_cache_salt` must identify everything
+    affecting compilation which is not part of the compiler command, source
+    code or compiler version, e.g., the version of included headers.
+
+    If `precompiled_header_salt` is provided, `PRECOMPILED_HEADER` is
+    precompiled, once for each compiler and set of compiler arguments, and
+    sources are compiled against it. `precompiled_header_salt` must identify
+    the version of the header.
+
     """
 
     # utility functions for silencing compiler output
@@ -59,9 +270,15 @@ def run_build_ext(extensions: List[setuptools.Extension], build_lib: str) -> str
     dist = setuptools.Distribution()
     # Make sure build respects distutils configuration
     dist.parse_config_files(dist.find_config_files())  # type: ignore
-    build_extension = build_ext.build_ext(dist)  # type: ignore
+    build_extension = _build_ext_with_progress(dist)
+    build_extension.progress_callback = progress_callback
+    build_extension.object_cache_salt = object_cache_salt
+    build_extension.precompiled_header_salt = precompiled_header_salt
 
     build_extension.build_lib = build_lib
+    # object files are intermediates. Place them in a temporary directory, deleted after the build.
+    build_temp = tempfile.TemporaryDirectory(prefix="httpstan_")
+    build_extension.build_temp = build_temp.name
 
     # silence stderr for compilation, if stderr is silenceable
     stream = tempfile.TemporaryFile(prefix="httpstan_")
@@ -82,9 +299,13 @@ def run_build_ext(extensions: List[setuptools.Extension], build_lib: str) -> str
         extension._needs_stub = False
     build_extension.extensions = extensions
 
+    build_error = None
     try:
         build_extension.run()
+    except Exception as exc:
+        build_error = exc
     finally:
+        build_temp.cleanup()
         if redirect_stderr:
             stream.seek(0)
             compiler_output = stream.read().decode()
@@ -92,4 +313,133 @@ def run_build_ext(extensions: List[setuptools.Extension], build_lib: str) -> str
             # restore
             os.dup2(orig_stderr, sys.stderr.fileno())
 
+    if build_error is not None:
+        # compiler messages explain the error
+        build_error.add_note(compiler_output)
+        raise build_error
     return compiler_output
+
+
+async def run_build_ext_in_subprocess(
+    extensions: List[dict],
+    build_lib: str,
+    progress_callback: Optional[Callable[[str], None]] = None,
+    object_cache_salt: Optional[str] = None,
+    precompiled_header_salt: Optional[str] = None,
+) -> str:
+    """Call `run_build_ext` in a new Python process.
+
+    Each build has a process of its own, so compiler output from concurrent
+    builds is kept apart. The process lowers its priority by
+    ``HTTPSTAN_COMPILE_NICE``. The process exchanges JSON messages, one per
+    line, with this one (see `main`).
+
+    This function is a coroutine.
+
+    Arguments:
+        extensions: Keyword arguments for `setuptools.Extension`, one dict per extension
+        build_lib: Directory in which to place compiled extension modules
+        progress_callback: Called with ``"compile"`` before compiling and with ``"link"`` before linking
+        object_cache_salt: If provided, share object files through the object cache (see `run_build_ext`)
+        precompiled_header_salt: If provided, compile against a precompiled header (see `run_build_ext`)
+
+    Returns:
+        Compiler output.
+
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "httpstan.build_ext",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=MESSAGE_SIZE_LIMIT,
+    )
+    assert process.stdin is not None and process.stdout is not None and process.stderr is not None
+    stdout, stderr = process.stdout, process.stderr
+    result: dict = {}
+
+    async def read_messages() -> None:
+        nonlocal result
+        async for line in stdout:
+            message = json.loads(line)
+            if "progress" in message:
+                if progress_callback is not None:
+                    progress_callback(message["progress"])
+            else:
+                result = message
+
+    try:
+        process.stdin.write(
+            json.dumps(
+                {
+                    "extensions": extensions,
+                    "build_lib": build_lib,
+                    "object_cache_salt": object_cache_salt,
+                    "precompiled_header_salt": precompiled_header_salt,
+                }
+            ).encode()
+        )
+        process.stdin.close()
+        _, stderr_bytes = await asyncio.gather(read_messages(), stderr.read())
+        await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if stderr_bytes:
+        logger.debug(f"Output from build process: {stderr_bytes.decode(errors='replace')}")
+    if "compiler_output" not in result:
+        error = result.get("error", f"Build process exited with code {process.returncode}.")
+        raise RuntimeError(error)
+    return str(result["compiler_output"])
+
+
+def main() -> None:
+    """Build extension modules described by a JSON message read from stdin.
+
+    Used by `run_build_ext_in_subprocess`. Progress messages and a final
+    message with the compiler output (or an error) are written to stdout,
+    one JSON message per line.
+
+    """
+    request = json.load(sys.stdin)
+    if HTTPSTAN_COMPILE_NICE:
+        os.nice(HTTPSTAN_COMPILE_NICE)
+    # messages use the original stdout. Anything else written to stdout goes to stderr.
+    messages = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def send_message(message: dict) -> None:
+        messages.write(json.dumps(message) + "\n")
+        messages.flush()
+
+    extensions = []
+    for kwargs in request["extensions"]:
+        # JSON has no tuples. setuptools requires macros to be tuples.
+        kwargs["define_macros"] = [tuple(macro) for macro in kwargs.get("define_macros", [])]
+        extensions.append(setuptools.Extension(**kwargs))
+    try:
+        compiler_output = run_build_ext(
+            extensions,
+            request["build_lib"],
+            lambda phase: send_message({"progress": phase}),
+            request.get("object_cache_salt"),
+            request.get("precompiled_header_salt"),
+        )
+    except Exception as exc:
+        send_message({"error": "".join(traceback.format_exception_only(exc))})
+        sys.exit(1)
+    send_message({"compiler_output": compiler_output})
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--precompile"]:
+        # precompile the Stan model header ahead of model builds, e.g., when building a container image
+        import httpstan.models
+
+        asyncio.run(httpstan.models.precompile_header())
+    else:
+        main()
@@ -1,17 +1,36 @@
 """Cache management.
 
 Functions in this module manage the Stan model cache and related caches.
+
+Compiler output, stanc warnings, extension modules, fits and data sets are
+kept by a storage backend (see ``httpstan.storage``). By default, the backend is the
+cache directory itself. With a backend shared by several machines, models
+built by one machine are copied to the cache directory of another when first
+used there.
 """
 
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
 import logging
+import os
 import shutil
+import sqlite3
+import tempfile
+import time
 import typing
 from importlib.machinery import EXTENSION_SUFFIXES
 from pathlib import Path
 
 import appdirs
+import numpy as np
 
 import httpstan
+import httpstan.storage
+from httpstan.config import HTTPSTAN_STORAGE
 
 logger = logging.getLogger("httpstan")
 
@@ -21,99 +40,411 @@ def cache_directory() -> Path:
     return Path(appdirs.user_cache_dir("httpstan", version=httpstan.__version__))
 
 
+def object_cache_directory() -> Path:
+    """Get the path to the object cache.
+
+    Compiled model object files are kept here, keyed by a hash of the C++ code,
+    the compiler arguments and the compiler version (see ``httpstan.build_ext``).
+    Unlike the rest of the cache, the directory is shared by all httpstan versions.
+
+    """
+    return Path(appdirs.user_cache_dir("httpstan")) / "objects"
+
+
+def precompiled_header_directory() -> Path:
+    """Get the path to the precompiled Stan model headers.
+
+    Each precompiled header is kept in a directory of its own, named after a
+    hash of the compiler arguments, the compiler version and the Stan headers
+    (see ``httpstan.build_ext``). Like the object cache, the directory is
+    shared by all httpstan versions.
+
+    """
+    return Path(appdirs.user_cache_dir("httpstan")) / "precompiled"
+
+
+def storage() -> httpstan.storage.Storage:
+    """Get the storage backend for models and fits, chosen with ``HTTPSTAN_STORAGE``."""
+    if HTTPSTAN_STORAGE:
+        return httpstan.storage.from_url(HTTPSTAN_STORAGE)
+    return httpstan.storage.LocalStorage(cache_directory())
+
+
+def model_key(model_name: str) -> str:
+    """Get the storage key prefix of a model's files, e.g., ``models/dyeicfn2``."""
+    model_id = model_name.split("/")[1]
+    return f"models/{model_id}"
+
+
 def model_directory(model_name: str) -> Path:
     """Get the path to a model's directory. Directory may not exist."""
-    model_id = model_name.split("/")[1]
-    return cache_directory() / "models" / model_id
+    return cache_directory() / model_key(model_name)
+
 
+# suffixes of stored fits, by format: gzip-compressed JSON lines, or columns (see `httpstan.fits.dump_columns`)
+FIT_SUFFIXES = {"jsonlines": ".jsonlines.gz", "columns": ".columns.npz"}
 
-def fit_path(fit_name: str) -> Path:
-    """Get the path to a fit file. File may not exist."""
-    # fit_name structure: cache / models / model_id / fit_id
-    fit_directory, fit_id = fit_name.rsplit("/", maxsplit=1)
-    fit_filename = fit_id + ".jsonlines.gz"
-    return cache_directory() / fit_directory / fit_filename
+
+def fit_key(fit_name: str, format: str = "jsonlines") -> str:
+    """Get the storage key of a fit stored in `format`."""
+    # fit_name structure: models / model_id / fits / fit_id
+    return f"{fit_name}{FIT_SUFFIXES[format]}"
+
+
+def fit_metadata_key(fit_name: str) -> str:
+    """Get the storage key of a fit's integrity metadata."""
+    return f"{fit_name}.meta.json"
+
+
+def fit_path(fit_name: str, format: str = "jsonlines") -> Path:
+    """Get the path to a fit file in the cache directory. File may not exist."""
+    return cache_directory() / fit_key(fit_name, format)
 
 
 def delete_model_directory(model_name: str) -> None:
-    """Delete the directory in which a model and associated fits are stored."""
+    """Delete the directory in which a model and associated fits are stored.
+
+    Only the copy in the cache directory is deleted. See `delete_model`.
+
+    """
+    _remove_from_model_index(model_name)
     shutil.rmtree(model_directory(model_name), ignore_errors=True)
 
 
+def delete_model(model_name: str) -> None:
+    """Delete a model and associated fits, from the storage backend as well as from the cache directory."""
+    storage_ = storage()
+    for key in storage_.list(f"{model_key(model_name)}/"):
+        with contextlib.suppress(KeyError):
+            storage_.delete(key)
+    delete_model_directory(model_name)
+
+
+def store_services_extension_module(model_name: str) -> None:
+    """Store a model's extension module, built in the cache directory, with the storage backend."""
+    model_directory_ = model_directory(model_name)
+    module_path = next(path for path in model_directory_.iterdir() if path.suffix in EXTENSION_SUFFIXES)
+    key = f"{model_key(model_name)}/{module_path.name}"
+    storage_ = storage()
+    if storage_.path(key) != module_path:
+        storage_.put(key, module_path.read_bytes())
+    _add_to_model_index(model_name)
+
+
+def fetch_services_extension_module(model_name: str) -> Path:
+    """Copy a model's extension module from the storage backend to the cache directory.
+
+    Returns:
+        Path of the extension module.
+
+    Raises:
+        KeyError: Model not found.
+
+    """
+    storage_ = storage()
+    for key in storage_.list(f"{model_key(model_name)}/"):
+        if Path(key).suffix in EXTENSION_SUFFIXES:
+            break
+    else:
+        raise KeyError(f"No module for `{model_name}` found in storage.")
+    module_path = cache_directory() / key
+    if storage_.path(key) == module_path:
+        _add_to_model_index(model_name)
+        return module_path
+    module_path.parent.mkdir(parents=True, exist_ok=True)
+    # other processes may be importing the module. Write to a temporary file and rename.
+    fd, temp_path = tempfile.mkstemp(dir=module_path.parent, prefix=".httpstan_")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(storage_.get(key))
+        os.replace(temp_path, module_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    _add_to_model_index(model_name)
+    return module_path
+
+
+@contextlib.asynccontextmanager
+async def model_build_lock(model_name: str) -> typing.AsyncIterator[None]:
+    """Hold an exclusive lock on building a model.
+
+    The lock is a file lock in the cache directory. It is respected by every
+    process using the cache directory, but not by other machines sharing the
+    storage backend. Two machines may build the same model at once. Both store
+    the same extension module, so the only cost is the duplicated build.
+
+    This function is a coroutine.
+
+    """
+    model_id = model_name.split("/")[1]
+    lock_path = cache_directory() / "locks" / f"{model_id}.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with lock_path.open("a") as fh:
+        # waiting for the lock blocks. Wait in a different thread.
+        await asyncio.get_running_loop().run_in_executor(None, fcntl.flock, fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
 def dump_services_extension_module_compiler_output(compiler_output: str, model_name: str) -> None:
     """Dump compiler output from building a model-specific stan::services extension module."""
-    model_directory_ = model_directory(model_name)
-    model_directory_.mkdir(parents=True, exist_ok=True)
-    with (model_directory_ / "stderr.log").open("w") as fh:
-        fh.write(compiler_output)
+    storage().put(f"{model_key(model_name)}/stderr.log", compiler_output.encode())
 
 
 def load_services_extension_module_compiler_output(model_name: str) -> str:
     """Load compiler output from building a model-specific stan::services extension module."""
     # may raise KeyError
-    model_directory_ = model_directory(model_name)
-    if not model_directory_.exists():
-        raise KeyError(f"Directory for `{model_name}` at `{model_directory}` does not exist.")
-    with (model_directory_ / "stderr.log").open() as fh:
-        return fh.read()
+    return storage().get(f"{model_key(model_name)}/stderr.log").decode()
 
 
-def list_model_names() -> typing.List[str]:
-    """Return model names (e.g., `models/dyeicfn2`) for models in cache."""
-    models_directory = cache_directory() / "models"
-    if not models_directory.exists():
-        return []
+def _storage_is_cache_directory() -> bool:
+    """Return True if models and fits are stored in the cache directory itself (the default)."""
+    return storage().path("models") == cache_directory() / "models"
 
-    def has_extension_suffix(path: Path) -> bool:
-        return path.suffix in EXTENSION_SUFFIXES
 
+def _scan_model_names() -> typing.List[str]:
+    """Find models in the cache directory by looking for extension modules."""
+    models_directory = cache_directory() / "models"
+    if not models_directory.is_dir():
+        return []
     model_names = []
-    for item in models_directory.iterdir():
-        if not item.is_dir():
+    for model_directory_ in models_directory.iterdir():
+        if not model_directory_.is_dir():
             continue
-        # look for a compiled extension module, file with a suffix in EXTENSION_SUFFIXES
-        if any(map(has_extension_suffix, item.iterdir())):
-            model_names.append(f"models/{item.name}")
+        if any(path.suffix in EXTENSION_SUFFIXES for path in model_directory_.iterdir()):
+            model_names.append(f"models/{model_directory_.name}")
     return model_names
 
 
+@contextlib.contextmanager
+def _model_index() -> typing.Iterator[sqlite3.Connection]:
+    """Open the index of models in the cache directory.
+
+    The index is an SQLite database holding the names of the models whose
+    extension modules are in the cache directory. It is updated when a model
+    is built, fetched from the storage backend or deleted. Listing models
+    then requires neither a scan of the cache directory nor reading files. An
+    index missing from an existing cache directory is rebuilt by scanning it.
+
+    """
+    path = cache_directory() / "models.sqlite3"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=60)
+    try:
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS models (name TEXT PRIMARY KEY)")
+            connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+            if connection.execute("SELECT 1 FROM metadata WHERE key = 'scanned'").fetchone() is None:
+                model_names = _scan_model_names()
+                connection.executemany("INSERT OR IGNORE INTO models VALUES (?)", [(name,) for name in model_names])
+                connection.execute("INSERT OR IGNORE INTO metadata VALUES ('scanned', '1')")
+        yield connection
+    finally:
+        connection.close()
+
+
+def _add_to_model_index(model_name: str) -> None:
+    with _model_index() as connection, connection:
+        connection.execute("INSERT OR IGNORE INTO models VALUES (?)", (model_name,))
+
+
+def _remove_from_model_index(model_name: str) -> None:
+    with _model_index() as connection, connection:
+        connection.execute("DELETE FROM models WHERE name = ?", (model_name,))
+
+
+def list_model_names(start_after: str = "", limit: int = 0) -> typing.List[str]:
+    """Return model names (e.g., `models/dyeicfn2`) for models in cache.
+
+    Names are sorted. If the storage backend is the cache directory, names
+    are read from the index of models (see `_model_index`).
+
+    Arguments:
+        start_after: Only names sorting after `start_after` are returned.
+        limit: Maximum number of names returned. Zero means no limit.
+
+    """
+    if _storage_is_cache_directory():
+        with _model_index() as connection:
+            query = "SELECT name FROM models WHERE name > ? ORDER BY name LIMIT ?"
+            return [name for name, in connection.execute(query, (start_after, limit or -1))]
+    model_names = set()
+    for key in storage().list("models/"):
+        # look for a compiled extension module, file with a suffix in EXTENSION_SUFFIXES
+        parts = key.split("/")
+        if len(parts) == 3 and Path(parts[2]).suffix in EXTENSION_SUFFIXES:
+            model_names.add(f"models/{parts[1]}")
+    model_names_sorted = [name for name in sorted(model_names) if name > start_after]
+    return model_names_sorted[:limit] if limit else model_names_sorted
+
+
 def dump_stanc_warnings(stanc_warnings: str, model_name: str) -> None:
     """Dump stanc warnings associated with a model."""
-    model_directory_ = model_directory(model_name)
-    model_directory_.mkdir(parents=True, exist_ok=True)
-    with (model_directory_ / "stanc.log").open("w") as fh:
-        fh.write(stanc_warnings)
+    storage().put(f"{model_key(model_name)}/stanc.log", stanc_warnings.encode())
 
 
 def load_stanc_warnings(model_name: str) -> str:
     """Load stanc output associated with a model."""
     # may raise KeyError
-    model_directory_ = model_directory(model_name)
-    if not model_directory_.exists():
-        raise KeyError(f"Directory for `{model_name}` at `{model_directory}` does not exist.")
-    with (model_directory_ / "stanc.log").open() as fh:
-        return fh.read()
+    return storage().get(f"{model_key(model_name)}/stanc.log").decode()
 
 
-def dump_fit(fit_bytes: bytes, name: str) -> None:
-    """Store Stan fit in filesystem-based cache.
+def dump_fit(fit_bytes: bytes, name: str, num_draws: int = 0, format: str = "jsonlines") -> None:
+    """Store Stan fit in the cache.
 
     The Stan fit is passed via ``fit_bytes``. The content
     must already be compressed.
 
+    Metadata is stored alongside the fit, after the fit itself: the length
+    and a checksum of ``fit_bytes``, its format, the time of creation and the
+    number of draws. A fit without metadata, or not matching it, is treated
+    as missing.
+
     Arguments:
         name: Stan fit name
-        fit_bytes: gzip-compressed messages associated with Stan fit.
+        fit_bytes: gzip-compressed messages associated with Stan fit, or columns.
+        num_draws: number of draws in the messages.
+        format: ``jsonlines`` or ``columns``, see `FIT_SUFFIXES`.
     """
     # fits are stored under their "parent" models
-    path = fit_path(name)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("wb") as fh:
-        fh.write(fit_bytes)
+    storage_ = storage()
+    storage_.put(fit_key(name, format), fit_bytes)
+    metadata = {
+        "length": len(fit_bytes),
+        "blake2b": hashlib.blake2b(fit_bytes).hexdigest(),
+        "format": format,
+        "created": time.time(),
+        "num_draws": num_draws,
+    }
+    storage_.put(fit_metadata_key(name), json.dumps(metadata).encode())
+
+
+def load_fit_metadata(name: str) -> dict:
+    """Load the metadata of a Stan fit in the cache, without reading the fit.
+
+    Use this function to check if a fit exists. A fit whose size does not
+    match the length recorded in its metadata (e.g., a truncated fit) is
+    treated as missing. The checksum is only verified when the fit is read.
+
+    Arguments:
+        name: Stan fit name
+
+    Returns
+        dict with keys ``length`` (size of the compressed fit, in bytes),
+        ``blake2b`` (checksum), ``format``, ``created`` (seconds since the
+        epoch) and ``num_draws``.
+
+    Raises:
+        KeyError: Fit not found, or corrupt.
+    """
+    storage_ = storage()
+    try:
+        metadata = dict(json.loads(storage_.get(fit_metadata_key(name))))
+        metadata.setdefault("format", "jsonlines")
+        size = storage_.size(fit_key(name, metadata["format"]))
+    except (KeyError, ValueError):
+        raise KeyError(f"Fit `{name}` not found.")
+    if size != metadata.get("length"):
+        logger.warning(f"Fit `{name}` is corrupt. Treating it as missing.")
+        raise KeyError(f"Fit `{name}` not found.")
+    return metadata
+
+
+def _verify_fit(name: str, fh: typing.BinaryIO, metadata: dict) -> None:
+    """Check a fit against its integrity metadata, reading `fh` to the end."""
+    hash, length = hashlib.blake2b(), 0
+    for chunk in iter(lambda: fh.read(1024**2), b""):
+        hash.update(chunk)
+        length += len(chunk)
+    if length != metadata.get("length") or hash.hexdigest() != metadata.get("blake2b"):
+        logger.warning(f"Fit `{name}` is corrupt. Treating it as missing.")
+        raise KeyError(f"Fit `{name}` not found.")
+
+
+def _seekable(fh: typing.BinaryIO) -> typing.BinaryIO:
+    """Return `fh` if it supports seeking. Otherwise, copy it to a temporary file and return that.
+
+    Blobs read from some storage backends (see `httpstan.storage.Storage.open`) do not support seeking.
+
+    """
+    if fh.seekable():
+        return fh
+    with fh:
+        temporary_file = tempfile.TemporaryFile()
+        try:
+            shutil.copyfileobj(fh, temporary_file, 1024**2)
+        except BaseException:
+            temporary_file.close()
+            raise
+    temporary_file.seek(0)
+    return typing.cast(typing.BinaryIO, temporary_file)
+
+
+class FitStream:
+    """Stan fit in the cache, read from start to end while its checksum is calculated.
+
+    Once the end of the fit is reached, the checksum is compared with the fit's
+    metadata. A fit which does not match is corrupt: it is deleted and
+    `KeyError` is raised. Reading a fit this way lets a fit be sent while it
+    is read, rather than after reading all of it to verify it.
+
+    Attributes:
+        name: Stan fit name
+        metadata: Metadata of the fit, see `load_fit_metadata`.
+        raw: File object holding the fit. Reading it directly bypasses the checksum. It may not
+            support seeking until `verify` has been called.
+
+    """
+
+    def __init__(self, name: str, raw: typing.BinaryIO, metadata: dict) -> None:
+        self.name, self.raw, self.metadata = name, raw, metadata
+        self._hash, self._length, self._checked = hashlib.blake2b(), 0, False
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.raw.read(size)
+        if chunk:
+            self._hash.update(chunk)
+            self._length += len(chunk)
+        elif size != 0 and not self._checked:
+            self._checked = True
+            if self._length != self.metadata["length"] or self._hash.hexdigest() != self.metadata["blake2b"]:
+                self._delete_corrupt()
+        return chunk
+
+    def verify(self) -> None:
+        """Check the whole fit against its metadata, before reading it directly through `raw`.
+
+        Raises:
+            KeyError: Fit is corrupt.
+        """
+        self.raw = _seekable(self.raw)
+        try:
+            _verify_fit(self.name, self.raw, self.metadata)
+        except KeyError:
+            self._delete_corrupt()
+        self.raw.seek(0)
+
+    def _delete_corrupt(self) -> None:
+        logger.warning(f"Fit `{self.name}` is corrupt. Deleting it.")
+        with contextlib.suppress(KeyError):
+            delete_fit(self.name)
+        raise KeyError(f"Fit `{self.name}` not found.")
+
+    def close(self) -> None:
+        self.raw.close()
+
+    def __enter__(self) -> "FitStream":
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.close()
 
 
 def load_fit(name: str) -> bytes:
-    """Load Stan fit from the filesystem-based cache.
+    """Load Stan fit from the cache.
 
     Arguments:
         name: Stan fit name
@@ -121,24 +452,390 @@ def load_fit(name: str) -> bytes:
 
     Returns
         gzip-compressed messages associated with Stan fit.
+
+    Raises:
+        KeyError: Fit not found, or corrupt.
     """
-    # fits are stored under their "parent" models
-    path = fit_path(name)
+    with open_fit(name) as fh:
+        return fh.read()
+
+
+def open_fit(name: str) -> typing.BinaryIO:
+    """Open Stan fit in the cache for reading.
+
+    The fit is checked against its integrity metadata first, reading all of
+    it. To send a fit while reading it, use `open_fit_stream`.
+
+    Arguments:
+        name: Stan fit name
+
+    Returns
+        File object from which gzip-compressed messages associated with Stan fit, or columns, may be
+        read. Use `httpstan.fits.open_messages` to read messages from either.
+
+    Raises:
+        KeyError: Fit not found, or corrupt.
+    """
+    metadata = load_fit_metadata(name)
+    fh = _seekable(_open_fit_file(name, metadata))
+    try:
+        _verify_fit(name, fh, metadata)
+    except BaseException:
+        fh.close()
+        raise
+    fh.seek(0)
+    return fh
+
+
+def open_fit_stream(name: str) -> FitStream:
+    """Open Stan fit in the cache for reading from start to end.
+
+    Unlike `open_fit`, only the size of the fit is checked before reading. The
+    checksum is checked once the end of the fit is reached (see `FitStream`).
+
+    Arguments:
+        name: Stan fit name
+
+    Raises:
+        KeyError: Fit not found, or corrupt.
+    """
+    metadata = load_fit_metadata(name)
+    return FitStream(name, _open_fit_file(name, metadata), metadata)
+
+
+def _open_fit_file(name: str, metadata: dict) -> typing.BinaryIO:
+    """Open the file holding a fit, recording its use."""
     try:
-        with path.open("rb") as fh:
-            return fh.read()
-    except FileNotFoundError:
+        fh = storage().open(fit_key(name, metadata["format"]))
+    except KeyError:
         raise KeyError(f"Fit `{name}` not found.")
+    path = storage().path(fit_key(name, metadata["format"]))
+    if path is not None:
+        record_access(path)
+    return fh
 
 
 def delete_fit(name: str) -> None:
-    """Delete Stan fit from the filesystem-based cache.
+    """Delete Stan fit from the cache.
 
     Arguments:
         name: Stan fit name
     """
-    path = fit_path(name)
-    try:
-        path.unlink()
-    except FileNotFoundError:
+    storage_ = storage()
+    # without its metadata, the fit is treated as missing. Delete metadata first.
+    with contextlib.suppress(KeyError):
+        storage_.delete(fit_metadata_key(name))
+    deleted = False
+    for format in FIT_SUFFIXES:
+        with contextlib.suppress(KeyError):
+            storage_.delete(fit_key(name, format))
+            deleted = True
+    if not deleted:
         raise KeyError(f"Fit `{name}` not found.")
+
+
+def dataset_metadata_key(dataset_name: str) -> str:
+    """Get the storage key of the list of variables in a data set."""
+    # dataset_name structure: datasets / dataset_id
+    return f"{dataset_name}/dataset.json"
+
+
+def dataset_variable_key(dataset_name: str, variable: str) -> str:
+    """Get the storage key of a variable in a data set."""
+    return f"{dataset_name}/{variable}.npy"
+
+
+def dump_dataset(arrays: typing.Dict[str, np.ndarray], name: str) -> None:
+    """Store a data set in the cache.
+
+    The list of variables, stored last, marks the data set as complete.
+
+    Arguments:
+        arrays: Mapping of names to arrays, see `httpstan.datasets.to_arrays`.
+        name: data set name
+    """
+    storage_ = storage()
+    variables = []
+    for variable, array in arrays.items():
+        fh = io.BytesIO()
+        np.save(fh, array, allow_pickle=False)
+        storage_.put(dataset_variable_key(name, variable), fh.getvalue())
+        variables.append({"name": variable, "dtype": array.dtype.str, "shape": list(array.shape)})
+    storage_.put(dataset_metadata_key(name), json.dumps({"variables": variables}).encode())
+
+
+def load_dataset_metadata(name: str) -> dict:
+    """Load the list of variables in a data set, without reading the variables.
+
+    Arguments:
+        name: data set name
+
+    Returns
+        dict with key ``variables``, a list of dicts with keys ``name``, ``dtype`` and ``shape``.
+
+    Raises:
+        KeyError: Data set not found.
+    """
+    storage_ = storage()
+    try:
+        metadata = dict(json.loads(storage_.get(dataset_metadata_key(name))))
+    except KeyError:
+        raise KeyError(f"Data set `{name}` not found.")
+    path = storage_.path(dataset_metadata_key(name))
+    if path is not None:
+        record_access(path)
+    return metadata
+
+
+def load_dataset(name: str) -> typing.Dict[str, np.ndarray]:
+    """Load a data set from the cache.
+
+    Variables stored in local files are memory-mapped, not read.
+
+    Arguments:
+        name: data set name
+
+    Returns
+        Mapping of names to (read-only) arrays.
+
+    Raises:
+        KeyError: Data set not found.
+    """
+    storage_ = storage()
+    arrays: typing.Dict[str, np.ndarray] = {}
+    for variable in load_dataset_metadata(name)["variables"]:
+        key = dataset_variable_key(name, variable["name"])
+        path = storage_.path(key)
+        if path is not None:
+            arrays[variable["name"]] = np.load(path, mmap_mode="r", allow_pickle=False)
+        else:
+            arrays[variable["name"]] = np.load(io.BytesIO(storage_.get(key)), allow_pickle=False)
+    return arrays
+
+
+def delete_dataset(name: str) -> None:
+    """Delete a data set from the cache.
+
+    Arguments:
+        name: data set name
+
+    Raises:
+        KeyError: Data set not found.
+    """
+    storage_ = storage()
+    # without its list of variables, the data set is treated as missing. Delete the list first.
+    try:
+        storage_.delete(dataset_metadata_key(name))
+    except KeyError:
+        raise KeyError(f"Data set `{name}` not found.")
+    for key in storage_.list(f"{name}/"):
+        with contextlib.suppress(KeyError):
+            storage_.delete(key)
+
+
+def record_access(path: Path) -> None:
+    """Record that a cached file has been used.
+
+    The modification time of the file records when it was last used. Access
+    times are unreliable, as file systems are often mounted with ``noatime``
+    or ``relatime``. Used for least-recently-used eviction (see `evict`).
+
+    """
+    with contextlib.suppress(OSError):
+        os.utime(path)
+
+
+def _list_cache_entries() -> typing.Dict[str, typing.List[dict]]:
+    """List models, fits, data sets, object files and precompiled headers in the cache directory.
+
+    Returns:
+        Entries of each kind, keyed by ``models``, ``fits``, ``datasets``,
+        ``objects`` and ``precompiled_headers``. Each entry is described by a
+        dict with keys ``name``, ``bytes`` and ``accessed`` (when it was last
+        used, in seconds since the epoch). Precompiled headers have an
+        additional key, ``salt``, the salt they were precompiled with, if
+        known (see `httpstan.build_ext`).
+
+    """
+    entries: typing.Dict[str, typing.List[dict]] = {
+        "models": [],
+        "fits": [],
+        "datasets": [],
+        "objects": [],
+        "precompiled_headers": [],
+    }
+    models_directory = cache_directory() / "models"
+    for model_directory_ in models_directory.iterdir() if models_directory.is_dir() else []:
+        files = [path for path in model_directory_.iterdir() if path.is_file()]
+        module_paths = [path for path in files if path.suffix in EXTENSION_SUFFIXES]
+        fit_paths = [
+            path for suffix in FIT_SUFFIXES.values() for path in (model_directory_ / "fits").glob(f"*{suffix}")
+        ]
+        # models without an extension module are being built (or have been deleted)
+        if module_paths:
+            entries["models"].append(
+                {
+                    "name": f"models/{model_directory_.name}",
+                    "bytes": sum(path.stat().st_size for path in files),
+                    "accessed": module_paths[0].stat().st_mtime,
+                }
+            )
+        for fit_path_ in fit_paths:
+            metadata_path = fit_path_.with_name(f"{fit_path_.name.split('.')[0]}.meta.json")
+            stat = fit_path_.stat()
+            entries["fits"].append(
+                {
+                    "name": f"models/{model_directory_.name}/fits/{fit_path_.name.split('.')[0]}",
+                    "bytes": stat.st_size + (metadata_path.stat().st_size if metadata_path.exists() else 0),
+                    "accessed": stat.st_mtime,
+                }
+            )
+    # data sets without a list of variables are being stored (or have been deleted)
+    for metadata_path in (cache_directory() / "datasets").glob("*/dataset.json"):
+        entries["datasets"].append(
+            {
+                "name": f"datasets/{metadata_path.parent.name}",
+                "bytes": sum(path.stat().st_size for path in metadata_path.parent.iterdir() if path.is_file()),
+                "accessed": metadata_path.stat().st_mtime,
+            }
+        )
+    # temporary files, named ".httpstan_*", are not entries
+    for object_path in object_cache_directory().glob("*.o"):
+        if object_path.name.startswith(".httpstan_"):
+            continue
+        stat = object_path.stat()
+        entries["objects"].append(
+            {"name": f"objects/{object_path.name}", "bytes": stat.st_size, "accessed": stat.st_mtime}
+        )
+    for header_directory in precompiled_header_directory().glob("*/"):
+        header_paths = [path for path in header_directory.rglob("*.gch") if not path.name.startswith(".httpstan_")]
+        # headers being precompiled are not entries yet
+        if not header_paths:
+            continue
+        salt_path = header_directory / "salt"
+        entries["precompiled_headers"].append(
+            {
+                "name": f"precompiled/{header_directory.name}",
+                "bytes": sum(path.stat().st_size for path in header_paths),
+                "accessed": max(path.stat().st_mtime for path in header_paths),
+                "salt": salt_path.read_text() if salt_path.exists() else None,
+            }
+        )
+    return entries
+
+
+def cache_usage() -> dict:
+    """Get the number and combined size (in bytes) of each kind of entry in the cache directory.
+
+    See `_list_cache_entries` for the kinds of entries.
+
+    """
+    return {
+        kind: {"count": len(entries_), "bytes": sum(entry["bytes"] for entry in entries_)}
+        for kind, entries_ in _list_cache_entries().items()
+    }
+
+
+def _select_evictions(entries: typing.List[dict], max_count: int, max_bytes: int, ttl: float) -> typing.List[dict]:
+    """Select entries to evict, least recently used first. Limits of zero are no limits.
+
+    Entries are dicts (see `_list_cache_entries`) with an additional key, ``in_use``.
+
+    """
+    count, total_bytes, now = len(entries), sum(entry["bytes"] for entry in entries), time.time()
+    selected = []
+    for entry in sorted(entries, key=lambda entry: entry["accessed"]):
+        expired = ttl > 0 and now - entry["accessed"] > ttl
+        over_budget = 0 < max_count < count or 0 < max_bytes < total_bytes
+        if not expired and not over_budget:
+            break
+        # entries in use count towards limits but are not evicted
+        if entry["in_use"]:
+            continue
+        selected.append(entry)
+        count, total_bytes = count - 1, total_bytes - entry["bytes"]
+    return selected
+
+
+def evict(
+    max_models: int = 0,
+    max_model_bytes: int = 0,
+    max_fits: int = 0,
+    max_fit_bytes: int = 0,
+    max_datasets: int = 0,
+    max_dataset_bytes: int = 0,
+    max_objects: int = 0,
+    max_object_bytes: int = 0,
+    ttl: float = 0,
+    in_use: typing.Container[str] = (),
+    precompiled_header_salt: typing.Optional[str] = None,
+) -> typing.List[str]:
+    """Evict least-recently-used entries from the cache directory.
+
+    Fits are evicted until there are at most `max_fits` fits, together using
+    at most `max_fit_bytes` bytes. Models (not counting their fits), data sets
+    and object files are evicted in the same way. Entries not used for `ttl`
+    seconds are evicted as well. Limits of zero are no limits. Evicting a
+    model evicts its fits.
+
+    Precompiled headers are evicted if not used for `ttl` seconds or if they
+    were precompiled with a salt other than `precompiled_header_salt`, i.e.,
+    against different Stan headers.
+
+    If the storage backend is not the cache directory, only the copies of
+    models in the cache directory are deleted.
+
+    Arguments:
+        in_use: Names of models, along with their fits, and of data sets which must not be evicted.
+
+    Returns:
+        Names of evicted entries.
+
+    """
+    entries = _list_cache_entries()
+    for entry in entries["models"] + entries["datasets"]:
+        entry["in_use"] = entry["name"] in in_use
+    for fit in entries["fits"]:
+        # fit names look like models/{model_id}/fits/{fit_id}
+        fit["in_use"] = fit["name"].rsplit("/", maxsplit=2)[0] in in_use
+    for entry in entries["objects"]:
+        entry["in_use"] = False
+    storage_is_cache_directory = _storage_is_cache_directory()
+    evicted = []
+    for fit in _select_evictions(entries["fits"], max_fits, max_fit_bytes, ttl):
+        with contextlib.suppress(KeyError):
+            delete_fit(fit["name"])
+        evicted.append(fit["name"])
+    for model in _select_evictions(entries["models"], max_models, max_model_bytes, ttl):
+        if storage_is_cache_directory:
+            delete_model(model["name"])
+        else:
+            delete_model_directory(model["name"])
+        evicted.append(model["name"])
+    # data sets are only found in the cache directory if it is the storage backend
+    for dataset in _select_evictions(entries["datasets"], max_datasets, max_dataset_bytes, ttl):
+        with contextlib.suppress(KeyError):
+            delete_dataset(dataset["name"])
+        evicted.append(dataset["name"])
+    for object_ in _select_evictions(entries["objects"], max_objects, max_object_bytes, ttl):
+        with contextlib.suppress(FileNotFoundError):
+            (object_cache_directory() / object_["name"].split("/")[1]).unlink()
+        evicted.append(object_["name"])
+    now = time.time()
+    for header in entries["precompiled_headers"]:
+        # e.g., a header precompiled by a different httpstan version sharing the directory
+        stale = precompiled_header_salt is not None and header["salt"] != precompiled_header_salt
+        if stale or 0 < ttl < now - header["accessed"]:
+            _delete_precompiled_header(header["name"].split("/")[1])
+            evicted.append(header["name"])
+    return evicted
+
+
+def _delete_precompiled_header(key: str) -> None:
+    """Delete a precompiled header, and its lock unless it is held by a build waiting for the header."""
+    directory = precompiled_header_directory()
+    shutil.rmtree(directory / key, ignore_errors=True)
+    lock_path = directory / f"{key}.lock"
+    with contextlib.suppress(OSError), lock_path.open("a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        lock_path.unlink()
@@ -31,6 +31,8 @@ def compile(program_code: str, stan_model_name: str) -> Tuple[str, str]:
                 stanc_binary,
                 "--name",
                 stan_model_name,
+                # generated code refers to the filename. Leave out the name of the temporary directory.
+                f"--filename-in-msg={filepath.name}",
                 "--warn-pedantic",
                 "--print-cpp",
                 str(filepath),
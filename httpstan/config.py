@@ -1,3 +1,40 @@
 import os
 
 HTTPSTAN_DEBUG = os.environ.get("HTTPSTAN_DEBUG", "0") in {"true", "1"}
+# maximum number of loaded model-specific extension modules kept in memory
+HTTPSTAN_MODULE_CACHE_SIZE = int(os.environ.get("HTTPSTAN_MODULE_CACHE_SIZE", "64"))
+# maximum number (and combined approximate size of data) of model instances kept in memory
+HTTPSTAN_MODEL_INSTANCE_CACHE_SIZE = int(os.environ.get("HTTPSTAN_MODEL_INSTANCE_CACHE_SIZE", "16"))
+HTTPSTAN_MODEL_INSTANCE_CACHE_BYTES = int(os.environ.get("HTTPSTAN_MODEL_INSTANCE_CACHE_BYTES", str(1024**3)))
+# number of processes running stan::services functions, defaults to the number of CPUs
+HTTPSTAN_NUM_WORKERS = int(os.environ.get("HTTPSTAN_NUM_WORKERS", "0")) or os.cpu_count() or 1
+# maximum number of calls to stan::services functions waiting for a process
+HTTPSTAN_MAX_QUEUED_FITS = int(os.environ.get("HTTPSTAN_MAX_QUEUED_FITS", "1024"))
+# maximum number of operations kept in memory. Operations which are done are forgotten first.
+HTTPSTAN_MAX_OPERATIONS = int(os.environ.get("HTTPSTAN_MAX_OPERATIONS", "10000"))
+# use the precompiled Stan model header, if available, when compiling models
+HTTPSTAN_PRECOMPILED_HEADER = os.environ.get("HTTPSTAN_PRECOMPILED_HEADER", "1") in {"true", "1"}
+# maximum number of models built at once, and the niceness increment of the processes building them
+HTTPSTAN_COMPILE_WORKERS = int(os.environ.get("HTTPSTAN_COMPILE_WORKERS", "2"))
+HTTPSTAN_COMPILE_NICE = int(os.environ.get("HTTPSTAN_COMPILE_NICE", "10"))
+# share compiled model object files across httpstan versions and Python executables
+HTTPSTAN_OBJECT_CACHE = os.environ.get("HTTPSTAN_OBJECT_CACHE", "1") in {"true", "1"}
+# storage backend for models and fits: empty (the cache directory), a shared directory or an http(s) URL
+HTTPSTAN_STORAGE = os.environ.get("HTTPSTAN_STORAGE", "")
+# limits on the number and combined size (in bytes) of models, of fits, of data sets and of object files in
+# the cache directory, and the number of seconds after which unused entries are evicted. Zero means no limit.
+HTTPSTAN_CACHE_MAX_MODELS = int(os.environ.get("HTTPSTAN_CACHE_MAX_MODELS", "0"))
+HTTPSTAN_CACHE_MAX_MODEL_BYTES = int(os.environ.get("HTTPSTAN_CACHE_MAX_MODEL_BYTES", "0"))
+HTTPSTAN_CACHE_MAX_FITS = int(os.environ.get("HTTPSTAN_CACHE_MAX_FITS", "0"))
+HTTPSTAN_CACHE_MAX_FIT_BYTES = int(os.environ.get("HTTPSTAN_CACHE_MAX_FIT_BYTES", "0"))
+HTTPSTAN_CACHE_MAX_DATASETS = int(os.environ.get("HTTPSTAN_CACHE_MAX_DATASETS", "0"))
+HTTPSTAN_CACHE_MAX_DATASET_BYTES = int(os.environ.get("HTTPSTAN_CACHE_MAX_DATASET_BYTES", "0"))
+HTTPSTAN_CACHE_MAX_OBJECTS = int(os.environ.get("HTTPSTAN_CACHE_MAX_OBJECTS", "0"))
+HTTPSTAN_CACHE_MAX_OBJECT_BYTES = int(os.environ.get("HTTPSTAN_CACHE_MAX_OBJECT_BYTES", "0"))
+HTTPSTAN_CACHE_TTL = float(os.environ.get("HTTPSTAN_CACHE_TTL", "0"))
+# seconds between checks of the cache limits
+HTTPSTAN_CACHE_EVICTION_INTERVAL = float(os.environ.get("HTTPSTAN_CACHE_EVICTION_INTERVAL", "60"))
+# keep debug information in model extension modules and the generated C++ code uncompressed
+HTTPSTAN_KEEP_DEBUG_INFO = os.environ.get("HTTPSTAN_KEEP_DEBUG_INFO", "0") in {"true", "1"}
+# send draws and diagnostics from worker processes as binary frames, storing fits as columns of values
+HTTPSTAN_BINARY_FRAMING = os.environ.get("HTTPSTAN_BINARY_FRAMING", "0") in {"true", "1"}
@@ -0,0 +1,83 @@
+"""Helper functions for data sets stored by httpstan.
+
+A data set is data for a Stan model, uploaded once and referred to by its
+ID (``data_id``) in requests which take data. Data sets are stored in
+``.npy`` format, one file per variable, by ``httpstan.cache``. The name of a
+data set is derived from its contents.
+"""
+
+import base64
+import hashlib
+import re
+import typing
+
+import numpy as np
+
+import httpstan.utils
+
+# Stan variable names. Names are used in storage keys.
+_variable_name_re = re.compile(r"[A-Za-z][A-Za-z0-9_]*")
+
+
+def to_arrays(data: dict) -> typing.Dict[str, np.ndarray]:
+    """Convert data for a Stan model into arrays as stored in a data set.
+
+    Floating point values become float64 arrays and integer values int32
+    arrays. Arrays are in column-major order, the order used by Stan.
+
+    Arguments:
+        data: Mapping of names to values (e.g., {'y': [0, 1, 2]}).
+
+    Returns:
+        Mapping of names to arrays, in order of names.
+
+    Raises:
+        ValueError: Invalid value.
+
+    """
+    arrays: typing.Dict[str, np.ndarray] = {}
+    for name, value in sorted(data.items()):
+        array = np.asarray(value)
+        if np.issubdtype(array.dtype, np.floating):
+            dtype: type = np.float64
+        elif np.issubdtype(array.dtype, np.integer):
+            httpstan.utils.check_int32_range(name, array)
+            dtype = np.int32
+        else:
+            raise ValueError(f"Variable `{name}` must be int or float.")
+        arrays[name] = np.asarray(array, dtype=dtype, order="F")
+    return arrays
+
+
+def check_variable_names(arrays: typing.Dict[str, np.ndarray]) -> None:
+    """Check that the names of variables in a data set are Stan variable names.
+
+    Raises:
+        ValueError: Invalid variable name.
+
+    """
+    for name in arrays:
+        if not _variable_name_re.fullmatch(name):
+            raise ValueError(f"`{name}` is not a valid Stan variable name.")
+
+
+def calculate_dataset_name(arrays: typing.Dict[str, np.ndarray]) -> str:
+    """Calculate the name of a data set from its arrays.
+
+    The ID of a data set is a hash of the names, types, shapes and values
+    (in column-major order) of its arrays.
+
+    Arguments:
+        arrays: Mapping of names to arrays, as returned by `to_arrays`.
+
+    Returns:
+        str: data set name, e.g., ``datasets/lzx6g2qbtfbhwxye``.
+
+    """
+    hash = hashlib.blake2b(digest_size=10)
+    for name, array in sorted(arrays.items()):
+        hash.update(f"{name}:{array.dtype.str}:{array.shape};".encode())
+        # a view, not a copy, of arrays in column-major order
+        hash.update(np.ravel(array, order="F").data)
+    id = base64.b32encode(hash.digest()).decode().lower()
+    return f"datasets/{id}"
@@ -1,13 +1,32 @@
 """Helper functions for Stan fits."""
 
 import base64
+import gzip
 import hashlib
-import pickle
+import io
+import json
 import random
+import re
+import struct
 import sys
+import typing
+
+import numpy as np
 
 import httpstan
 
+# Draws are written by `socket_writer.hpp` as JSON objects with a fixed key order.
+SAMPLE_DRAW_PREFIX = b'{"version":1,"topic":"sample","values":{'
+# match the names (keys) in a JSON object whose values are numbers
+_sample_draw_names_re = re.compile(rb'"[^"]*":')
+# With binary framing, `socket_writer.hpp` sends draws and diagnostics in frames: a zero byte, a type
+# byte and the length of the payload (uint32, little-endian), followed by the payload.
+_frame_prefix = struct.Struct("<xcI")
+# payload: JSON object with keys `topic` and `names`, sent once per topic
+FRAME_HEADER = b"H"
+# payload: values (float64, little-endian), one per name
+FRAME_ROW = b"R"
+
 
 def calculate_fit_name(function: str, model_name: str, kwargs: dict) -> str:
     """Calculate fit name from parameters and data.
@@ -22,7 +41,7 @@ def calculate_fit_name(function: str, model_name: str, kwargs: dict) -> str:
 
     - UTF-8 encoded name of service function (e.g., ``hmc_nuts_diag_e_adapt``)
     - UTF-8 encoded Stan model name (which is derived from a hash of ``program_code``)
-    - Bytes of pickled kwargs dictionary
+    - Canonical binary form of kwargs (see `_hash_kwargs`)
     - UTF-8 encoded string recording the httpstan version
     - UTF-8 encoded string identifying the system platform
     - UTF-8 encoded string identifying the system bit architecture
@@ -50,7 +69,7 @@ def calculate_fit_name(function: str, model_name: str, kwargs: dict) -> str:
     hash = hashlib.blake2b(digest_size=digest_size)
     hash.update(function.encode())
     hash.update(model_name.encode())
-    hash.update(pickle.dumps(kwargs))
+    _hash_kwargs(hash, kwargs)
 
     # system identifiers
     hash.update(httpstan.__version__.encode())
@@ -62,3 +81,244 @@ def calculate_fit_name(function: str, model_name: str, kwargs: dict) -> str:
 
     id = base64.b32encode(hash.digest()).decode().lower()
     return f"{model_name}/fits/{id}"
+
+
+def _hash_kwargs(hash: "hashlib.blake2b", kwargs: dict) -> None:
+    """Update `hash` with a canonical binary form of `kwargs`.
+
+    Arguments are hashed in order of their names. Data (``data``, ``init``),
+    mappings of names to arrays, are hashed as the name, type and shape of
+    each array followed by its values in column-major order. Arrays in
+    column-major order, as returned by `httpstan.datasets.to_arrays`, are not
+    copied. Other arguments are hashed as their ``repr``.
+
+    """
+    for key, value in sorted(kwargs.items()):
+        hash.update(f"{key}=".encode())
+        if isinstance(value, dict):
+            for name, array in sorted(value.items()):
+                array = np.asarray(array)
+                hash.update(f"{name}:{array.dtype.str}:{array.shape};".encode())
+                hash.update(np.ravel(array, order="F").data)
+        else:
+            hash.update(f"{value!r};".encode())
+
+
+def extract_draws(lines: typing.Iterable[bytes]) -> typing.Tuple[typing.List[str], np.ndarray]:
+    """Extract draws from the messages of a fit.
+
+    Only messages with topic ``sample`` which record a draw are used. The
+    parameter names are read from the first draw. Values of subsequent draws
+    are parsed directly from the message text, without decoding each message
+    into a dictionary.
+
+    Arguments:
+        lines: newline-delimited JSON-encoded messages, one per item.
+
+    Returns:
+        (list of str, numpy.ndarray): names, draws as float64 matrix (one row per draw)
+            stored in column-major order.
+
+    """
+    names: typing.List[str] = []
+    values = []
+    for line in lines:
+        if not line.startswith(SAMPLE_DRAW_PREFIX):
+            continue
+        if not names:
+            names = list(json.loads(line)["values"])
+        # drop prefix and the two closing braces, leaving `"name":value,...`
+        values.append(_sample_draw_names_re.sub(b"", line[len(SAMPLE_DRAW_PREFIX) :].rstrip()[:-2]))
+    draws = np.fromstring(b",".join(values), sep=",") if values else np.empty(0)
+    return names, np.asfortranarray(draws.reshape(len(values), len(names)))
+
+
+def row_message(topic: str, names: typing.Sequence[str], values: np.ndarray) -> bytes:
+    """Encode a row of values as the JSON message `socket_writer.hpp` sends without binary framing."""
+    message = {"version": 1, "topic": topic, "values": dict(zip(names, values.tolist()))}
+    return json.dumps(message, separators=(",", ":")).encode()
+
+
+class FrameDecoder:
+    """Decode the messages sent through a connection from a socket_writer or socket_logger.
+
+    Messages are JSON-encoded, one per line, or, with binary framing, rows of
+    values in frames (see `socket_writer.hpp`). JSON-encoded messages are kept
+    as they are. Rows are kept by topic, with their position among the
+    JSON-encoded messages. See `dump_columns`.
+
+    """
+
+    def __init__(self) -> None:
+        # JSON-encoded messages, each followed by a newline
+        self.messages = bytearray()
+        # by topic: names, values of rows and positions of rows in `messages`
+        self.columns: typing.Dict[str, typing.Tuple[typing.List[str], bytearray, typing.List[int]]] = {}
+        self._buffer = bytearray()
+        self._topic = ""
+
+    def feed(self, data: bytes, json_rows: bool = False) -> typing.List[bytes]:
+        """Decode `data`, received from the connection.
+
+        Arguments:
+            data: bytes received.
+            json_rows: return rows as JSON-encoded messages, as well as other messages.
+
+        Returns:
+            Complete messages received, JSON-encoded, without newlines.
+
+        """
+        buffer = self._buffer
+        buffer += data
+        messages = []
+        start = 0
+        while start < len(buffer):
+            if buffer[start] != 0:
+                end = buffer.find(b"\n", start)
+                if end == -1:
+                    break
+                self.messages += buffer[start : end + 1]
+                messages.append(bytes(buffer[start:end]))
+                start = end + 1
+                continue
+            if len(buffer) - start < _frame_prefix.size:
+                break
+            frame_type, size = _frame_prefix.unpack_from(buffer, start)
+            end = start + _frame_prefix.size + size
+            if len(buffer) < end:
+                break
+            payload = buffer[start + _frame_prefix.size : end]
+            if frame_type == FRAME_HEADER:
+                header = json.loads(payload)
+                self._topic = header["topic"]
+                self.columns[self._topic] = (header["names"], bytearray(), [])
+            elif frame_type == FRAME_ROW:
+                names, values, positions = self.columns[self._topic]
+                values += payload
+                positions.append(len(self.messages))
+                if json_rows:
+                    messages.append(row_message(self._topic, names, np.frombuffer(payload, "<f8")))
+            else:
+                raise ValueError(f"Unknown frame type `{frame_type!r}`.")
+            start = end
+        del buffer[:start]
+        return messages
+
+    def num_rows(self, topic: str) -> int:
+        """Number of rows with topic `topic` received."""
+        return len(self.columns[topic][2]) if topic in self.columns else 0
+
+
+def dump_columns(decoders: typing.Sequence[FrameDecoder]) -> bytes:
+    """Combine the messages decoded from connections into a fit stored as columns.
+
+    The fit is a compressed NumPy ``.npz`` archive holding the arrays:
+
+    - ``messages``: JSON-encoded messages (uint8), each followed by a newline, in order of connection.
+    - ``topics``: topics of rows, in order of connection.
+    - ``<topic>_names``: names of values (str).
+    - ``<topic>_values``: values (float64, one row per message, stored in column-major order).
+    - ``<topic>_positions``: position (int64) in ``messages`` of each row, the
+      offset of the message which followed it.
+
+    Arguments:
+        decoders: one per connection, in order of connection.
+
+    """
+    arrays: typing.Dict[str, typing.Any] = {}
+    messages = bytearray()
+    topics = []
+    for decoder in decoders:
+        for topic, (names, values, positions) in decoder.columns.items():
+            if topic in topics:
+                raise ValueError(f"Rows with topic `{topic}` received through more than one connection.")
+            topics.append(topic)
+            arrays[f"{topic}_names"] = np.array(names, dtype=str)
+            rows = np.frombuffer(values, "<f8").reshape(len(positions), len(names))
+            arrays[f"{topic}_values"] = np.asfortranarray(rows)
+            arrays[f"{topic}_positions"] = np.array(positions, dtype=np.int64) + len(messages)
+        messages += decoder.messages
+    arrays["messages"] = np.frombuffer(messages, dtype=np.uint8)
+    arrays["topics"] = np.array(topics, dtype=str)
+    fh = io.BytesIO()
+    np.savez_compressed(fh, **arrays)
+    return fh.getvalue()
+
+
+def is_columns(fit_file: typing.BinaryIO) -> bool:
+    """Return True if a fit is stored as columns (see `dump_columns`), not as gzip-compressed messages."""
+    # ``.npz`` archives are zip archives
+    is_zip = fit_file.read(4) == b"PK\x03\x04"
+    fit_file.seek(0)
+    return is_zip
+
+
+def _column_messages(fit_file: typing.BinaryIO) -> typing.Iterator[bytes]:
+    """Yield the messages of a fit stored as columns, rows JSON-encoded again, in order."""
+    with np.load(fit_file, allow_pickle=False) as npz:
+        messages = npz["messages"].tobytes()
+        position = 0
+        # rows from a later connection follow rows, and messages, from earlier connections
+        for topic in npz["topics"].tolist():
+            names = npz[f"{topic}_names"].tolist()
+            for row_position, values in zip(npz[f"{topic}_positions"].tolist(), npz[f"{topic}_values"]):
+                if row_position > position:
+                    yield messages[position:row_position]
+                    position = row_position
+                yield row_message(topic, names, values) + b"\n"
+        yield messages[position:]
+
+
+class _IteratorReader(io.RawIOBase):
+    """Read the bytes yielded by an iterator."""
+
+    def __init__(self, chunks: typing.Iterator[bytes]) -> None:
+        self._chunks = chunks
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: typing.Any) -> int:
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def open_messages(fit_file: typing.BinaryIO) -> typing.BinaryIO:
+    """Open the newline-delimited JSON-encoded messages of a fit for reading.
+
+    For a fit stored as columns, messages holding rows are JSON-encoded again,
+    as ``socket_writer.hpp`` encodes them without binary framing.
+
+    Arguments:
+        fit_file: File object holding a fit, as returned by `httpstan.cache.open_fit`.
+
+    """
+    if is_columns(fit_file):
+        return typing.cast(typing.BinaryIO, io.BufferedReader(_IteratorReader(_column_messages(fit_file))))
+    return typing.cast(typing.BinaryIO, gzip.GzipFile(fileobj=fit_file))
+
+
+def read_draws(fit_file: typing.BinaryIO) -> typing.Tuple[typing.List[str], np.ndarray]:
+    """Read the draws of a fit, as `extract_draws` extracts them.
+
+    Draws of a fit stored as columns are read directly from its columns.
+
+    Arguments:
+        fit_file: File object holding a fit, as returned by `httpstan.cache.open_fit`.
+
+    """
+    if not is_columns(fit_file):
+        with gzip.GzipFile(fileobj=fit_file) as lines:
+            return extract_draws(lines)
+    with np.load(fit_file, allow_pickle=False) as npz:
+        if "sample_values" not in npz:
+            return [], np.empty((0, 0), order="F")
+        return npz["sample_names"].tolist(), npz["sample_values"]
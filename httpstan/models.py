@@ -7,26 +7,53 @@ from C++ code generated and loading the resulting module.
 
 import asyncio
 import base64
+import collections
+import gzip
 import hashlib
 import importlib
 import importlib.resources
 import logging
+import os
+import pickle
 import platform
+import shutil
+import subprocess
 import sys
+import tempfile
+import weakref
 from importlib.machinery import EXTENSION_SUFFIXES
 from pathlib import Path
 from types import ModuleType
-from typing import List, Optional, Tuple
-
-import setuptools
+from typing import Any, Callable, List, Optional, Tuple
 
 import httpstan.build_ext
 import httpstan.cache
 import httpstan.compile
+from httpstan.config import (
+    HTTPSTAN_COMPILE_WORKERS,
+    HTTPSTAN_KEEP_DEBUG_INFO,
+    HTTPSTAN_MODEL_INSTANCE_CACHE_BYTES,
+    HTTPSTAN_MODEL_INSTANCE_CACHE_SIZE,
+    HTTPSTAN_MODULE_CACHE_SIZE,
+    HTTPSTAN_OBJECT_CACHE,
+    HTTPSTAN_PRECOMPILED_HEADER,
+)
 
 PACKAGE_DIR = Path(__file__).parent.resolve(strict=True)
 logger = logging.getLogger("httpstan")
 
+# Least-recently-used caches of loaded extension modules and of model instances.
+# Loading a module and constructing a model (which copies the data and runs the
+# transformed data block) cost far more than a single `log_prob_grad` call.
+# Keys of `_model_instances` are (model name, data digest). Values record the
+# size of the pickled data, used as an estimate of the memory held by the instance.
+_services_extension_modules: "collections.OrderedDict[str, Tuple[Path, ModuleType]]" = collections.OrderedDict()
+_model_instances: "collections.OrderedDict[Tuple[str, str], Tuple[int, Any]]" = collections.OrderedDict()
+# semaphores limiting the number of concurrent builds, one for each event loop
+_compile_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
 
 def calculate_model_name(program_code: str) -> str:
     """Calculate model name from Stan program code.
@@ -65,9 +92,32 @@ def calculate_model_name(program_code: str) -> str:
     return f"models/{id}"
 
 
+def calculate_stan_model_name(program_code: str) -> str:
+    """Calculate the name stanc gives the C++ model class.
+
+    Unlike the model name, the Stan model name depends only on the program
+    code. C++ code generated for a program is then the same in every
+    environment, allowing compiled objects to be shared (see
+    ``httpstan.cache.object_cache_directory``).
+
+    Arguments:
+        program_code: Stan program code.
+
+    Returns:
+        str: Stan model name, e.g., ``model_2uxewutp``.
+
+    """
+    hash = hashlib.blake2b(program_code.encode(), digest_size=5)
+    # stan name cannot start with number
+    return f"model_{base64.b32encode(hash.digest()).decode().lower()}"
+
+
 def import_services_extension_module(model_name: str) -> ModuleType:
     """Load an existing model-specific stan::services extension module.
 
+    Loaded modules are cached. A cached module is only returned if the
+    extension module file is still present in the model directory.
+
     Arguments:
         model_name
 
@@ -78,11 +128,18 @@ def import_services_extension_module(model_name: str) -> ModuleType:
         KeyError: Model not found.
 
     """
-    model_directory = httpstan.cache.model_directory(model_name)
     try:
-        module_path = next(filter(lambda p: p.suffix in EXTENSION_SUFFIXES, model_directory.iterdir()))
-    except (FileNotFoundError, StopIteration):
-        raise KeyError(f"No module for `{model_name}` found in `{model_directory}`")
+        module_path, module = _services_extension_modules[model_name]
+    except KeyError:
+        pass
+    else:
+        if module_path.exists():
+            _services_extension_modules.move_to_end(model_name)
+            httpstan.cache.record_access(module_path)
+            return module
+        evict_services_extension_module(model_name)
+
+    module_path = _services_extension_module_path(model_name)
     # The module name, which is independent of the filename, is always "stan_services". The module
     # name must be defined in stan_services.cpp, which is compiled before we know with which
     # specific stan model it will be linked with. Since we want to compile stan_services.cpp in
@@ -91,44 +148,115 @@ def import_services_extension_module(model_name: str) -> ModuleType:
     module: ModuleType = importlib.util.module_from_spec(spec)  # type: ignore
     spec.loader.exec_module(module)  # type: ignore
 
+    _services_extension_modules[model_name] = (module_path, module)
+    httpstan.cache.record_access(module_path)
+    while len(_services_extension_modules) > HTTPSTAN_MODULE_CACHE_SIZE:
+        _services_extension_modules.popitem(last=False)
     return module
 
 
-async def build_services_extension_module(program_code: str, extra_compile_args: Optional[List[str]] = None) -> str:
-    """Compile a model-specific stan::services extension module.
+async def fetch_and_import_services_extension_module(model_name: str) -> ModuleType:
+    """Load an existing model-specific stan::services extension module, like `import_services_extension_module`.
 
-    Since compiling an extension module takes a long time, compilation takes
-    place in a different thread.
+    If the extension module is not in the cache directory, it is copied from
+    the storage backend in a different thread, without blocking the event
+    loop. The module itself is imported in the calling thread: Stan Math
+    sets up its (thread-local) autodiff stack in the thread loading the module.
 
-    Messages generated by the compiler—normally sent to stderr—are collected
-    and saved. These messages are returned by the function.
+    This is a coroutine function.
 
-    Returns compiler messages.
+    Raises:
+        KeyError: Model not found.
 
-    This is a coroutine function.
+    """
+    await asyncio.get_running_loop().run_in_executor(None, _services_extension_module_path, model_name)
+    return import_services_extension_module(model_name)
 
-    IMPORTANT NOTE: This function builds the extension module in the cache
-    directory, making it available for later `import`ing. This "side-effect" is
-    why there are no functions called `load_services_extension_module` and
-    `dump_services_extension_module`.
+
+def _services_extension_module_path(model_name: str) -> Path:
+    """Get the path of a model's extension module, copying it from the storage backend if needed.
+
+    Raises:
+        KeyError: Model not found.
 
     """
-    model_name = calculate_model_name(program_code)
-    model_directory_path = httpstan.cache.model_directory(model_name)
+    model_directory = httpstan.cache.model_directory(model_name)
+    try:
+        return next(filter(lambda p: p.suffix in EXTENSION_SUFFIXES, model_directory.iterdir()))
+    except (FileNotFoundError, StopIteration):
+        # model may have been built by another machine sharing the storage backend. May raise KeyError.
+        return httpstan.cache.fetch_services_extension_module(model_name)
 
-    model_directory_path.mkdir(parents=True, exist_ok=True)
 
-    stan_model_name = f"model_{model_name.split('/')[1]}"
-    cpp_code, _ = httpstan.compile.compile(program_code, stan_model_name)
-    cpp_code_path = model_directory_path / f"{stan_model_name}.cpp"
-    with cpp_code_path.open("w") as fh:
-        fh.write(cpp_code)
+async def get_model_instance(model_name: str, data: dict, data_id: Optional[str] = None) -> Any:
+    """Return an instance of a model constructed with `data`.
 
-    include_dirs = [
-        str(model_directory_path),
-        str(PACKAGE_DIR / "include"),
-    ]
+    Instances are cached, keyed by model name and a hash of `data` and
+    `data_id`. The cache is bounded both in the number of instances and in the
+    (approximate) size of the data they hold.
+
+    Arguments:
+        model_name
+        data: Data for the Stan model.
+        data_id: ID of a data set whose variables are combined with `data`. Data sets are
+            identified by their contents, so the data set is only read if no instance is cached.
 
+    This is a coroutine function.
+
+    Returns:
+        Instance of ``Model``, defined in ``stan_services.cpp``.
+
+    Raises:
+        KeyError: Model or data set not found.
+
+    """
+    data_bytes = pickle.dumps(data)
+    hash = hashlib.blake2b(data_bytes, digest_size=16)
+    hash.update(f"data_id:{data_id or ''}".encode())
+    key = (model_name, hash.hexdigest())
+    try:
+        _, instance = _model_instances[key]
+    except KeyError:
+        pass
+    else:
+        _model_instances.move_to_end(key)
+        return instance
+
+    services_module = await fetch_and_import_services_extension_module(model_name)
+    size = len(data_bytes)
+    if data_id is not None:
+        # reading the data set may take a while. Read in a different thread.
+        dataset = await asyncio.get_running_loop().run_in_executor(
+            None, httpstan.cache.load_dataset, f"datasets/{data_id}"
+        )
+        size += sum(array.nbytes for array in dataset.values())
+        data = {**dataset, **data}
+    # constructing the model may raise an exception, e.g., if data are invalid
+    instance = services_module.Model(data)  # type: ignore
+    _model_instances[key] = (size, instance)
+
+    # evict least-recently-used instances, always keeping the newest one
+    def over_budget() -> bool:
+        if len(_model_instances) > HTTPSTAN_MODEL_INSTANCE_CACHE_SIZE:
+            return True
+        return sum(size for size, _ in _model_instances.values()) > HTTPSTAN_MODEL_INSTANCE_CACHE_BYTES
+
+    while len(_model_instances) > 1 and over_budget():
+        _model_instances.popitem(last=False)
+    return instance
+
+
+def evict_services_extension_module(model_name: str) -> None:
+    """Remove a model's extension module and model instances from the in-memory caches."""
+    _services_extension_modules.pop(model_name, None)
+    for key in [key for key in _model_instances if key[0] == model_name]:
+        del _model_instances[key]
+
+
+def _services_extension(
+    name: str, cpp_code_path: Path, include_dirs: List[str], extra_compile_args: Optional[List[str]]
+) -> dict:
+    """Get keyword arguments for the `setuptools.Extension` of a stan::services extension module."""
     stan_macros: List[Tuple[str, Optional[str]]] = [
         ("BOOST_DISABLE_ASSERTS", None),
         ("BOOST_PHOENIX_NO_VARIADIC_EXPRESSION", None),
@@ -151,8 +279,8 @@ async def build_services_extension_module(program_code: str, extra_compile_args:
     libraries = ["sundials_cvodes", "sundials_idas", "sundials_nvecserial", "tbb"]
     if platform.system() == "Darwin":  # pragma: no cover
         libraries.extend(["tbbmalloc", "tbbmalloc_proxy"])
-    extension = setuptools.Extension(
-        f"stan_services_{stan_model_name}",  # filename only. Module name is "stan_services"
+    return dict(
+        name=name,  # filename only. Module name is "stan_services"
         language="c++",
         sources=[str(cpp_code_path)],
         define_macros=stan_macros,
@@ -166,11 +294,137 @@ async def build_services_extension_module(program_code: str, extra_compile_args:
         ],
     )
 
-    extensions = [extension]
-    build_lib = str(model_directory_path)
 
-    # Building the model takes a long time. Run in a different thread.
-    compiler_output = await asyncio.get_running_loop().run_in_executor(
-        None, httpstan.build_ext.run_build_ext, extensions, build_lib
+async def build_services_extension_module(
+    program_code: str,
+    extra_compile_args: Optional[List[str]] = None,
+    progress_callback: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Compile a model-specific stan::services extension module.
+
+    Since compiling an extension module takes a long time, compilation takes
+    place in a different thread.
+
+    Messages generated by the compiler—normally sent to stderr—are collected
+    and saved. These messages are returned by the function.
+
+    At most ``HTTPSTAN_COMPILE_WORKERS`` extension modules are built at once,
+    each in a process of its own.
+
+    If provided, `progress_callback` is called with ``"compile"`` before C++
+    code is compiled and with ``"link"`` before the extension module is linked.
+
+    Returns compiler messages.
+
+    This is a coroutine function.
+
+    IMPORTANT NOTE: This function builds the extension module in the cache
+    directory, making it available for later `import`ing. This "side-effect" is
+    why there are no functions called `load_services_extension_module` and
+    `dump_services_extension_module`.
+
+    """
+    model_name = calculate_model_name(program_code)
+    model_directory_path = httpstan.cache.model_directory(model_name)
+
+    model_directory_path.mkdir(parents=True, exist_ok=True)
+
+    stan_model_name = calculate_stan_model_name(program_code)
+    cpp_code, _ = httpstan.compile.compile(program_code, stan_model_name)
+    cpp_code_path = model_directory_path / f"{stan_model_name}.cpp"
+    with cpp_code_path.open("w") as fh:
+        fh.write(cpp_code)
+
+    include_dirs = [
+        str(model_directory_path),
+        str(PACKAGE_DIR / "include"),
+    ]
+
+    extension = _services_extension(
+        f"stan_services_{stan_model_name}", cpp_code_path, include_dirs, extra_compile_args
     )
+
+    extensions = [extension]
+
+    # The extension module is built in a temporary directory and moved into the model directory
+    # once complete. A crash during the build cannot leave a partly written module behind.
+    with tempfile.TemporaryDirectory(dir=model_directory_path, prefix=".httpstan_") as build_lib:
+        # Building the model takes a long time. Build in a different process, limiting concurrent builds.
+        async with _compile_semaphore():
+            # `stan/model/model_header.hpp` is precompiled, in the build process, by the first build needing it
+            compiler_output = await httpstan.build_ext.run_build_ext_in_subprocess(
+                extensions,
+                build_lib,
+                progress_callback,
+                stan_headers_salt() if HTTPSTAN_OBJECT_CACHE else None,
+                stan_headers_salt() if HTTPSTAN_PRECOMPILED_HEADER else None,
+            )
+        if not HTTPSTAN_KEEP_DEBUG_INFO:
+            await asyncio.get_running_loop().run_in_executor(
+                None, _minimize_model_files, Path(build_lib), cpp_code_path
+            )
+        for path in Path(build_lib).iterdir():
+            os.replace(path, model_directory_path / path.name)
     return compiler_output
+
+
+async def precompile_header() -> None:
+    """Precompile the Stan model header, as model builds would, if not already precompiled.
+
+    A model build needing the header while it is being precompiled waits for
+    it (see ``httpstan.build_ext._precompiled_header``). Does nothing if
+    ``HTTPSTAN_PRECOMPILED_HEADER`` is not set.
+
+    This is a coroutine function.
+
+    """
+    if not HTTPSTAN_PRECOMPILED_HEADER:
+        return
+    with tempfile.TemporaryDirectory(prefix="httpstan_") as build_lib:
+        # the header is precompiled when compiling any source with the flags used by models. An empty one is quickest.
+        cpp_code_path = Path(build_lib) / "precompile_header.cpp"
+        cpp_code_path.touch()
+        extension = _services_extension(
+            "stan_services_precompile_header", cpp_code_path, [str(PACKAGE_DIR / "include")], None
+        )
+        await httpstan.build_ext.run_build_ext_in_subprocess([extension], build_lib, None, None, stan_headers_salt())
+
+
+def _minimize_model_files(build_lib: Path, cpp_code_path: Path) -> None:
+    """Shrink the files of a model built successfully.
+
+    Debug information is stripped from the extension module, making it much
+    smaller and faster to load. The C++ code is compressed.
+
+    """
+    for module_path in build_lib.iterdir():
+        if module_path.suffix not in EXTENSION_SUFFIXES:
+            continue
+        try:
+            subprocess.run(["strip", "-S", str(module_path)], capture_output=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            logger.warning(f"Unable to strip debug information from `{module_path.name}`: {exc}")
+    with cpp_code_path.open("rb") as fh, gzip.open(cpp_code_path.with_suffix(".cpp.gz"), "wb") as gzip_fh:
+        shutil.copyfileobj(fh, gzip_fh)
+    cpp_code_path.unlink()
+
+
+def stan_headers_salt() -> str:
+    """Identify the Stan headers which models are compiled against, for keys of the object cache.
+
+    Also identifies the precompiled Stan model header. Precompiled headers
+    with a different salt are pruned from the cache (see ``httpstan.cache.evict``).
+
+    """
+    hash = hashlib.blake2b(digest_size=16)
+    for header in ("stan/version.hpp", "stan/math/version.hpp"):
+        hash.update((PACKAGE_DIR / "include" / header).read_bytes())
+    return hash.hexdigest()
+
+
+def _compile_semaphore() -> asyncio.Semaphore:
+    """Get the semaphore limiting the number of concurrent builds in the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _compile_semaphores:
+        _compile_semaphores[loop] = asyncio.Semaphore(HTTPSTAN_COMPILE_WORKERS)
+    return _compile_semaphores[loop]
@@ -45,16 +45,23 @@ def openapi_spec() -> apispec.APISpec:
         plugins=[DocPlugin(), apispec.ext.marshmallow.MarshmallowPlugin()],
     )
     spec.path(path="/v1/health", view=views.handle_health)
+    spec.path(path="/v1/cache", view=views.handle_get_cache_usage)
     spec.path(path="/v1/models", view=views.handle_create_model)
     spec.path(path="/v1/models", view=views.handle_list_models)
     spec.path(path="/v1/models/{model_id}", view=views.handle_delete_model)
+    spec.path(path="/v1/datasets", view=views.handle_create_dataset)
+    spec.path(path="/v1/datasets/{dataset_id}", view=views.handle_get_dataset)
+    spec.path(path="/v1/datasets/{dataset_id}", view=views.handle_delete_dataset)
     spec.path(path="/v1/models/{model_id}/params", view=views.handle_show_params)
     spec.path(path="/v1/models/{model_id}/log_prob", view=views.handle_log_prob)
     spec.path(path="/v1/models/{model_id}/log_prob_grad", view=views.handle_log_prob_grad)
+    spec.path(path="/v1/models/{model_id}/log_prob_grad_batch", view=views.handle_log_prob_grad_batch)
     spec.path(path="/v1/models/{model_id}/write_array", view=views.handle_write_array)
     spec.path(path="/v1/models/{model_id}/transform_inits", view=views.handle_transform_inits)
     spec.path(path="/v1/models/{model_id}/fits", view=views.handle_create_fit)
     spec.path(path="/v1/models/{model_id}/fits/{fit_id}", view=views.handle_get_fit)
     spec.path(path="/v1/models/{model_id}/fits/{fit_id}", view=views.handle_delete_fit)
     spec.path(path="/v1/operations/{operation_id}", view=views.handle_get_operation)
+    spec.path(path="/v1/operations/{operation_id}", view=views.handle_delete_operation)
+    spec.path(path="/v1/operations/{operation_id}/messages", view=views.handle_get_operation_messages)
     return spec
@@ -0,0 +1,99 @@
+"""Admission and scheduling of calls to stan::services functions.
+
+Calls run in a process pool with a fixed number of workers. Calls waiting for
+a worker are queued per client and started in round-robin order, so one
+client submitting many fits cannot starve other clients.
+"""
+
+import asyncio
+import collections
+import contextlib
+import math
+import time
+import typing
+
+
+class FitScheduler:
+    """Limit the number of running and queued services calls.
+
+    Arguments:
+        num_workers: Maximum number of calls running at once
+        max_queued: Maximum number of calls waiting for a worker
+
+    """
+
+    def __init__(self, num_workers: int, max_queued: int) -> None:
+        self.num_workers = num_workers
+        self.max_queued = max_queued
+        self.num_running = 0
+        # futures of waiting calls, by client. Order of keys is the round-robin order.
+        self._waiting: typing.Dict[str, typing.Deque[asyncio.Future]] = collections.OrderedDict()
+        # moving average of the duration of recent calls, in seconds
+        self._mean_duration = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of calls waiting for a worker."""
+        return sum(len(futures) for futures in self._waiting.values())
+
+    def can_admit(self, num_calls: int = 1) -> bool:
+        """Return True if `num_calls` more calls may be queued."""
+        free_workers = max(self.num_workers - self.num_running - self.queue_depth, 0)
+        return self.queue_depth + max(num_calls - free_workers, 0) <= self.max_queued
+
+    def retry_after(self) -> int:
+        """Estimate the number of seconds until a queued call would start."""
+        return max(math.ceil(self._mean_duration * (self.queue_depth + 1) / self.num_workers), 1)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, client: str) -> typing.AsyncIterator[float]:
+        """Wait for a worker to become available to `client`.
+
+        This function is a coroutine.
+
+        Yields:
+            Seconds spent waiting for a worker.
+
+        """
+        queued = time.monotonic()
+        if self.num_running >= self.num_workers or self._waiting:
+            future = asyncio.get_running_loop().create_future()
+            self._waiting.setdefault(client, collections.deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # worker was handed to this call already. Pass it on.
+                    self.num_running -= 1
+                    self._start_next()
+                else:
+                    self._remove(client, future)
+                raise
+        else:
+            self.num_running += 1
+        started = time.monotonic()
+        try:
+            yield started - queued
+        finally:
+            self._mean_duration = 0.8 * self._mean_duration + 0.2 * (time.monotonic() - started)
+            self.num_running -= 1
+            self._start_next()
+
+    def _remove(self, client: str, future: asyncio.Future) -> None:
+        futures = self._waiting[client]
+        futures.remove(future)
+        if not futures:
+            del self._waiting[client]
+
+    def _start_next(self) -> None:
+        """Hand a free worker to the next client in round-robin order."""
+        if self.num_running >= self.num_workers or not self._waiting:
+            return
+        client, futures = next(iter(self._waiting.items()))
+        future = futures.popleft()
+        # move client to the end of the round-robin order
+        del self._waiting[client]
+        if futures:
+            self._waiting[client] = futures
+        self.num_running += 1
+        future.set_result(None)
@@ -44,9 +44,29 @@ class Status(marshmallow.Schema):
 
 
 class CreateModelRequest(marshmallow.Schema):
-    """Schema for request to build a Stan program."""
+    """Schema for request to build a Stan program.
+
+    If ``asynchronous`` is true, building the program is a long-running
+    operation.
+
+    """
 
     program_code = fields.String(required=True)
+    asynchronous = fields.Boolean(missing=False)
+
+
+class ListModelsRequest(marshmallow.Schema):
+    """Query parameters of a request to list models.
+
+    Models are listed in order of their names. If ``page_size`` is set, at
+    most ``page_size`` models are returned, along with a token for the next
+    page, if any.
+
+    """
+
+    page_size = fields.Integer(validate=validate.Range(min=1))
+    page_token = fields.String(missing="")
+    names_only = fields.Boolean(missing=False)
 
 
 class Model(marshmallow.Schema):
@@ -55,6 +75,21 @@ class Model(marshmallow.Schema):
     stanc_warnings = fields.String(required=True)
 
 
+class CacheEntriesUsage(marshmallow.Schema):
+    count = fields.Integer(required=True)
+    bytes = fields.Integer(required=True)
+
+
+class CacheUsage(marshmallow.Schema):
+    """Number and combined size of each kind of entry in the cache."""
+
+    models = fields.Nested(CacheEntriesUsage(), required=True)
+    fits = fields.Nested(CacheEntriesUsage(), required=True)
+    datasets = fields.Nested(CacheEntriesUsage(), required=True)
+    objects = fields.Nested(CacheEntriesUsage(), required=True)
+    precompiled_headers = fields.Nested(CacheEntriesUsage(), required=True)
+
+
 class Data(marshmallow.Schema):
     """Data for a Stan model."""
 
@@ -84,6 +119,29 @@ class Data(marshmallow.Schema):
                 )
 
 
+class CreateDatasetRequest(marshmallow.Schema):
+    """Schema for request to store a data set."""
+
+    data = fields.Nested(Data(), missing={})
+
+
+class DatasetVariable(marshmallow.Schema):
+    """Variable in a data set."""
+
+    name = fields.String(required=True)
+    # NumPy array-protocol type string, e.g., ``<f8``
+    dtype = fields.String(required=True)
+    shape = fields.List(fields.Integer(), required=True)
+
+
+class Dataset(marshmallow.Schema):
+    """Data set, referred to by its ID (``data_id``) in requests which take data."""
+
+    # e.g., datasets/eqr7mghoyiqmmvdp
+    name = fields.String(required=True)
+    variables = fields.List(fields.Nested(DatasetVariable()), required=True)
+
+
 class CreateFitRequest(marshmallow.Schema):
     """Schema for request to start sampling.
 
@@ -91,6 +149,12 @@ class CreateFitRequest(marshmallow.Schema):
 
     Sampler parameters can be found in ``httpstan/stan_services.cpp``.
 
+    ``num_chains`` is not a sampler parameter. If present, the operation runs
+    ``num_chains`` chains with consecutive chain ids, starting from ``chain``.
+
+    ``data_id`` is the ID of a data set stored with ``POST /v1/datasets``. Its
+    variables are combined with those in ``data``.
+
     """
 
     function = fields.String(
@@ -100,9 +164,11 @@ class CreateFitRequest(marshmallow.Schema):
         ),
     )
     data = fields.Nested(Data(), missing={})
+    data_id = fields.String(validate=validate.Regexp(r"^[a-z2-7]+$"))
     init = fields.Nested(Data(), missing={})
     random_seed = fields.Integer(validate=validate.Range(min=0))
     chain = fields.Integer(validate=validate.Range(min=0))
+    num_chains = fields.Integer(validate=validate.Range(min=1))
     init_radius: fields.Number = fields.Number()
     num_warmup = fields.Integer(validate=validate.Range(min=0))
     num_samples = fields.Integer(validate=validate.Range(min=0))
@@ -128,6 +194,7 @@ class Fit(marshmallow.Schema):
 
 class ShowParamsRequest(marshmallow.Schema):
     data = fields.Nested(Data(), missing={})
+    data_id = fields.String(validate=validate.Regexp(r"^[a-z2-7]+$"))
 
 
 class Parameter(marshmallow.Schema):  # noqa
@@ -192,6 +259,7 @@ class ShowLogProbRequest(marshmallow.Schema):
     """Schema for log_prob request."""
 
     data = fields.Nested(Data(), missing={})
+    data_id = fields.String(validate=validate.Regexp(r"^[a-z2-7]+$"))
     unconstrained_parameters = fields.List(fields.Float(), required=True)
     adjust_transform = fields.Boolean(missing=True)
 
@@ -200,14 +268,25 @@ class ShowLogProbGradRequest(marshmallow.Schema):
     """Schema for log_prob_grad request."""
 
     data = fields.Nested(Data(), missing={})
+    data_id = fields.String(validate=validate.Regexp(r"^[a-z2-7]+$"))
     unconstrained_parameters = fields.List(fields.Float(), required=True)
     adjust_transform = fields.Boolean(missing=True)
 
 
+class ShowLogProbGradBatchRequest(marshmallow.Schema):
+    """Schema for batched log_prob_grad request."""
+
+    data = fields.Nested(Data(), missing={})
+    data_id = fields.String(validate=validate.Regexp(r"^[a-z2-7]+$"))
+    unconstrained_parameters = fields.List(fields.List(fields.Float()), required=True)
+    adjust_transform = fields.Boolean(missing=True)
+
+
 class ShowWriteArrayRequest(marshmallow.Schema):
     """Schema for write_array request."""
 
     data = fields.Nested(Data(), missing={})
+    data_id = fields.String(validate=validate.Regexp(r"^[a-z2-7]+$"))
     unconstrained_parameters = fields.List(fields.Float(), required=True)
     include_tparams = fields.Boolean(missing=True)
     include_gqs = fields.Boolean(missing=True)
@@ -217,4 +296,5 @@ class ShowTransformInitsRequest(marshmallow.Schema):
     """Schema for transform_inits request."""
 
     data = fields.Nested(Data(), missing={})
+    data_id = fields.String(validate=validate.Regexp(r"^[a-z2-7]+$"))
     constrained_parameters = fields.Nested(Data(), required=True)
@@ -100,5 +100,5 @@ def function_arguments(function_name: str, services_module: types.ModuleType) ->
     function_name_with_arguments = docstring.split(" -> ", 1).pop(0)
     parameters = re.findall(r"(\w+): \w+", function_name_with_arguments)
     # remove arguments which are specific to the wrapper
-    arguments_exclude = {"socket_filename"}
+    arguments_exclude = {"socket_filename", "binary_framing"}
     return list(filter(lambda arg: arg not in arguments_exclude, parameters))
@@ -8,24 +8,30 @@ Unix domain socket.
 """
 
 import asyncio
-import collections
 import concurrent.futures
+import contextlib
 import functools
 import io
 import logging
 import multiprocessing as mp
 import os
-import select
 import signal
 import socket
 import tempfile
 import typing
 import zlib
 
+import numpy as np
+
 import httpstan.cache
 import httpstan.models
 import httpstan.services.arguments as arguments
-from httpstan.config import HTTPSTAN_DEBUG
+from httpstan.config import (
+    HTTPSTAN_BINARY_FRAMING,
+    HTTPSTAN_DEBUG,
+    HTTPSTAN_NUM_WORKERS,
+)
+from httpstan.fits import SAMPLE_DRAW_PREFIX, FrameDecoder, dump_columns
 
 
 # Use `get_context` to get a package-specific multiprocessing context.
@@ -34,9 +40,40 @@ def init_worker() -> None:
     signal.signal(signal.SIGINT, signal.SIG_IGN)  # ignore KeyboardInterrupt
 
 
-executor = concurrent.futures.ProcessPoolExecutor(mp_context=mp.get_context("fork"), initializer=init_worker)
+executor = concurrent.futures.ProcessPoolExecutor(
+    max_workers=HTTPSTAN_NUM_WORKERS, mp_context=mp.get_context("fork"), initializer=init_worker
+)
 logger = logging.getLogger("httpstan")
 
+# maximum number of bytes read from a socket at once
+MESSAGE_CHUNK_SIZE = 64 * 1024
+# arrays in `data` and `init` of at least this many bytes are sent to worker processes in files
+SHARED_ARRAY_MIN_BYTES = 64 * 1024
+# seconds a message queue may stay full before it is dropped. A subscriber which stops reading must
+# not pause a fit indefinitely.
+MESSAGE_QUEUE_TIMEOUT = 10.0
+# put, in place of further messages, on a queue which has been dropped
+MESSAGE_QUEUE_DROPPED = b"dropped"
+
+
+async def _put_message(message_queues: typing.List[asyncio.Queue], message: typing.Optional[bytes]) -> None:
+    """Put `message` on each queue, dropping queues which remain full for `MESSAGE_QUEUE_TIMEOUT` seconds.
+
+    A dropped queue is removed from `message_queues` and emptied. `MESSAGE_QUEUE_DROPPED` is put on it,
+    as the final item.
+
+    """
+    for queue in list(message_queues):
+        try:
+            await asyncio.wait_for(queue.put(message), MESSAGE_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Message queue full for {MESSAGE_QUEUE_TIMEOUT} seconds. Dropping it.")
+            if queue in message_queues:
+                message_queues.remove(queue)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(MESSAGE_QUEUE_DROPPED)
+
 
 # This function belongs inside `_make_lazy_function_wrapper`. It is defined here
 # because `pickle` (used by ProcessPoolExecutor) cannot pickle local functions.
@@ -45,9 +82,64 @@ def _make_lazy_function_wrapper_helper(
 ) -> typing.Callable:  # pragma: no cover
     services_module = httpstan.models.import_services_extension_module(model_name)
     function = getattr(services_module, function_basename + "_wrapper")
+    # large arrays, and a data set, are read (memory-mapped) here, in the worker process, rather than sent to it
+    for field, paths in kwargs.pop("array_paths", {}).items():
+        kwargs[field] = {**kwargs[field], **{name: np.load(path, mmap_mode="r") for name, path in paths.items()}}
+    data_id = kwargs.pop("data_id", None)
+    if data_id is not None:
+        kwargs["data"] = {**httpstan.cache.load_dataset(f"datasets/{data_id}"), **kwargs["data"]}
     return function(*args, **kwargs)  # type: ignore
 
 
+def _write_arrays(kwargs: dict, directory: str) -> typing.Dict[str, typing.Dict[str, str]]:
+    """Move large arrays in `data` and `init` into ``.npy`` files in `directory`.
+
+    Arrays moved are removed from `kwargs`. Worker processes memory-map the
+    files (see `_make_lazy_function_wrapper_helper`). Sending a file name to a
+    worker is cheaper than pickling an array and sending it through a pipe.
+
+    Returns:
+        Paths of the files, by argument and variable name.
+
+    """
+    array_paths: typing.Dict[str, typing.Dict[str, str]] = {}
+    for field in ("data", "init"):
+        arrays = {
+            name: value
+            for name, value in kwargs.get(field, {}).items()
+            if isinstance(value, np.ndarray) and value.nbytes >= SHARED_ARRAY_MIN_BYTES
+        }
+        if not arrays:
+            continue
+        kwargs[field] = {name: value for name, value in kwargs[field].items() if name not in arrays}
+        array_paths[field] = {}
+        for i, (name, array) in enumerate(arrays.items()):
+            path = os.path.join(directory, f"{field}_{i}.npy")
+            np.save(path, array, allow_pickle=False)
+            array_paths[field][name] = path
+    return array_paths
+
+
+@contextlib.asynccontextmanager
+async def shared_arrays(kwargs: dict) -> typing.AsyncIterator[None]:
+    """Move large arrays in `kwargs` into files (see `_write_arrays`), deleted on exit.
+
+    Paths of the files are added to `kwargs` as ``array_paths``. If `kwargs`
+    already has ``array_paths``, nothing is done. Operations running several
+    chains write arrays once, passing the same files to every chain.
+
+    This function is a coroutine.
+
+    """
+    if "array_paths" in kwargs:
+        yield
+        return
+    with tempfile.TemporaryDirectory(prefix="httpstan_") as arrays_directory:
+        loop = asyncio.get_running_loop()
+        kwargs["array_paths"] = await loop.run_in_executor(None, _write_arrays, kwargs, arrays_directory)
+        yield
+
+
 # In order to avoid problems with the ProcessPoolExecutor, the module
 # needs to be loaded inside the spawned process, not before.
 def _make_lazy_function_wrapper(function_basename: str, model_name: str) -> typing.Callable:
@@ -61,6 +153,7 @@ async def call(
     model_name: str,
     fit_name: str,
     logger_callback: typing.Optional[typing.Callable] = None,
+    message_queues: typing.Optional[typing.List[asyncio.Queue]] = None,
     **kwargs: dict,
 ) -> None:
     """Call stan::services function.
@@ -70,19 +163,28 @@ async def call(
 
     This is a coroutine function.
 
+    If the task running this coroutine is cancelled, the stan::services
+    function is stopped. Cancellation completes once the worker process
+    running the function is free. No fit is saved.
+
     Arguments:
         function_name: full name of function in stan::services
         services_module (module): model-specific services extension module
         fit_name: Name of fit, used for saving length-prefixed messages
         logger_callback: Callback function for logger messages, including sampling progress messages
+        message_queues: Queues to which each complete message is put as it arrives. Queues may be
+            added to or removed from the list at any time. ``None`` is put after the final message.
+            A full queue delays the reading of further messages, for at most ``MESSAGE_QUEUE_TIMEOUT``
+            seconds. Then the queue is removed from the list, and ``MESSAGE_QUEUE_DROPPED`` is put on it.
         kwargs: named stan::services function arguments, see CmdStan documentation.
+            ``data_id``, if present, is the ID of a data set combined with ``data``.
     """
     method, function_basename = function_name.replace("stan::services::", "").split("::", 1)
 
     # Fetch defaults for missing arguments. This is an important step!
     # For example, `random_seed`, if not in `kwargs`, will be set.
-    # temporarily load the module to lookup function arguments
-    services_module = httpstan.models.import_services_extension_module(model_name)
+    # temporarily load the module to lookup function arguments. Loading may read from the storage backend.
+    services_module = await httpstan.models.fetch_and_import_services_extension_module(model_name)
     function_arguments = arguments.function_arguments(function_basename, services_module)
     del services_module
     # This is clumsy due to the way default values are available. There is no
@@ -93,70 +195,153 @@ async def call(
         if arg not in kwargs:
             kwargs[arg] = typing.cast(typing.Any, arguments.lookup_default(arguments.Method[method.upper()], arg))
 
-    with socket.socket(socket.AF_UNIX, type=socket.SOCK_STREAM) as socket_:
-        temp_fd, socket_filename = tempfile.mkstemp(prefix="httpstan_", suffix=".sock")
-        os.close(temp_fd)
-        os.unlink(socket_filename)
-        socket_.bind(socket_filename)
-        socket_.listen(4)  # three stan callback writers, one stan callback logger
-
-        lazy_function_wrapper = _make_lazy_function_wrapper(function_basename, model_name)
-        lazy_function_wrapper_partial = functools.partial(lazy_function_wrapper, socket_filename, **kwargs)
-
-        # If HTTPSTAN_DEBUG is set block until sampling is complete. Do not use an executor.
-        if HTTPSTAN_DEBUG:  # pragma: no cover
-            future: asyncio.Future = asyncio.Future()
-            logger.debug("Calling stan::services function with debug mode on.")
-            print("Warning: httpstan debug mode is on! `num_samples` must be set to a small number (e.g., 10).")
-            future.set_result(lazy_function_wrapper_partial())
-        else:
-            future = asyncio.get_running_loop().run_in_executor(executor, lazy_function_wrapper_partial)  # type: ignore
-
-        messages_files: typing.Mapping[socket.socket, io.BytesIO] = collections.defaultdict(io.BytesIO)
-        # using a wbits value which makes things compatible with gzip
-        messages_compressobjs: typing.Mapping[socket.socket, zlib._Compress] = collections.defaultdict(
-            functools.partial(zlib.compressobj, level=zlib.Z_BEST_SPEED, wbits=zlib.MAX_WBITS | 16)
-        )
-        potential_readers = [socket_]
+    loop = asyncio.get_running_loop()
+    # one compressed file per connection, in the order in which connections are accepted
+    messages_files: typing.List[io.BytesIO] = []
+    # with binary framing, one decoder per connection instead, in the same order
+    decoders: typing.List[FrameDecoder] = []
+    connection_tasks: typing.List[asyncio.Task] = []
+    # draws written, recorded with the fit
+    num_draws = 0
 
-        while True:
-            # note: timeout of 0.01 seems to work well based on measurements
-            readable, writeable, errored = select.select(potential_readers, [], [], 0.01)
-            for s in readable:
-                if s is socket_:
-                    conn, _ = s.accept()
-                    logger.debug("Opened socket connection to a socket_logger or socket_writer.")
-                    potential_readers.append(conn)
-                    continue
-                message = s.recv(8192)
-                if not len(message):
-                    # `close` called on other end
-                    s.close()
-                    logger.debug("Closed socket connection to a socket_logger or socket_writer.")
-                    potential_readers.remove(s)
-                    continue
+    async def read_messages(conn: socket.socket) -> None:
+        """Read messages from a socket_logger or socket_writer until the connection is closed.
+
+        A socket_interrupt also opens a connection. It sends no messages.
+
+        """
+        nonlocal num_draws
+        logger.debug("Opened socket connection to a socket_logger or socket_writer.")
+        if HTTPSTAN_BINARY_FRAMING:
+            await read_frames(conn)
+            return
+        messages_file = io.BytesIO()
+        messages_files.append(messages_file)
+        # using a wbits value which makes things compatible with gzip
+        compressobj = zlib.compressobj(level=zlib.Z_BEST_SPEED, wbits=zlib.MAX_WBITS | 16)
+        # pieces of a message which has not been completely received, used with `message_queues`
+        partial_messages: typing.List[bytes] = []
+        # end of the previous chunk, which may hold the start of a draw
+        tail = b""
+        with conn:
+            while message := await loop.sock_recv(conn, MESSAGE_CHUNK_SIZE):
+                num_draws += (tail + message).count(SAMPLE_DRAW_PREFIX)
+                tail = (tail + message)[-len(SAMPLE_DRAW_PREFIX) + 1 :]
                 # Only trigger callback if message has topic `logger`.
                 if logger_callback and b'"logger"' in message:
                     logger_callback(message)
-                messages_files[s].write(messages_compressobjs[s].compress(message))
-            # if `potential_readers == [socket_]` then either (1) no connections
-            # have been opened or (2) all connections have been closed.
-            if not readable:
-                if potential_readers == [socket_] and future.done():
-                    logger.debug(
-                        f"Stan services function `{function_basename}` returned without problems or raised a C++ exception."
+                # zlib releases the GIL while compressing. Compress in a thread, keeping the event loop free.
+                messages_file.write(await loop.run_in_executor(None, compressobj.compress, message))
+                if message_queues is None:
+                    continue
+                if b"\n" not in message:
+                    partial_messages.append(message)
+                    continue
+                complete_messages = b"".join(partial_messages + [message]).split(b"\n")
+                partial_messages[:] = [complete_messages.pop()]
+                for complete_message in complete_messages:
+                    await _put_message(message_queues, complete_message)
+        # `close` called on other end
+        messages_file.write(compressobj.flush())
+        logger.debug("Closed socket connection to a socket_logger or socket_writer.")
+
+    async def read_frames(conn: socket.socket) -> None:
+        """Read messages, draws and diagnostics in frames, until the connection is closed."""
+        decoder = FrameDecoder()
+        decoders.append(decoder)
+        with conn:
+            while data := await loop.sock_recv(conn, MESSAGE_CHUNK_SIZE):
+                # rows are only encoded as JSON again while a queue is waiting for messages
+                complete_messages = decoder.feed(data, json_rows=bool(message_queues))
+                # Only trigger callback if a message has topic `logger`.
+                if logger_callback and any(b'"logger"' in message for message in complete_messages):
+                    logger_callback(b"\n".join(complete_messages))
+                if not message_queues:
+                    continue
+                for complete_message in complete_messages:
+                    await _put_message(message_queues, complete_message)
+        logger.debug("Closed socket connection to a socket_logger or socket_writer.")
+
+    def accept_connections(socket_: socket.socket) -> None:
+        """Accept all pending connections, without blocking."""
+        while True:
+            try:
+                conn, _ = socket_.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)
+            connection_tasks.append(asyncio.create_task(read_messages(conn)))
+
+    temp_fd, socket_filename = tempfile.mkstemp(prefix="httpstan_", suffix=".sock")
+    os.close(temp_fd)
+    os.unlink(socket_filename)
+    # large arrays are sent to the worker process in files, deleted once the function has returned
+    async with shared_arrays(kwargs):
+        with socket.socket(socket.AF_UNIX, type=socket.SOCK_STREAM) as socket_:
+            socket_.bind(socket_filename)
+            socket_.listen(5)  # three stan callback writers, one stan callback logger, one stan callback interrupt
+            socket_.setblocking(False)
+            loop.add_reader(socket_, accept_connections, socket_)
+            cancelled = False
+            try:
+                lazy_function_wrapper = _make_lazy_function_wrapper(function_basename, model_name)
+                lazy_function_wrapper_partial = functools.partial(lazy_function_wrapper, socket_filename, **kwargs)
+                if HTTPSTAN_BINARY_FRAMING:
+                    # not passed otherwise, keeping extension modules built by earlier versions usable
+                    lazy_function_wrapper_partial = functools.partial(
+                        lazy_function_wrapper_partial, binary_framing=True
                     )
-                    break
-                # no messages right now and not done. Sleep briefly so other pending tasks get a chance to run.
-                await asyncio.sleep(0.001)
-
-    compressed_parts = []
-    for s, fh in messages_files.items():
-        fh.write(messages_compressobjs[s].flush())
-        fh.flush()
-        compressed_parts.append(fh.getvalue())
-        fh.close()
-    httpstan.cache.dump_fit(b"".join(compressed_parts), fit_name)
+
+                # If HTTPSTAN_DEBUG is set block until sampling is complete. Do not use an executor.
+                if HTTPSTAN_DEBUG:  # pragma: no cover
+                    future: asyncio.Future = asyncio.Future()
+                    logger.debug("Calling stan::services function with debug mode on.")
+                    print(
+                        "Warning: httpstan debug mode is on! `num_samples` must be set to a small number (e.g., 10)."
+                    )
+                    future.set_result(lazy_function_wrapper_partial())
+                else:
+                    future = loop.run_in_executor(executor, lazy_function_wrapper_partial)  # type: ignore
+                # wait for the function to return or raise an exception
+                await asyncio.wait([future])
+            except asyncio.CancelledError:
+                cancelled = True
+            finally:
+                loop.remove_reader(socket_)
+                os.unlink(socket_filename)
+            if cancelled:
+                # Closing every connection stops the stan::services function. See `httpstan/socket_interrupt.hpp`.
+                logger.debug(f"Call to stan services function `{function_basename}` cancelled.")
+                socket_.close()
+                for task in connection_tasks:
+                    task.cancel()
+                await asyncio.gather(*connection_tasks, return_exceptions=True)
+                await asyncio.wait([future])
+                raise asyncio.CancelledError
+            # Every connection was opened before the function returned. Accept those not yet accepted.
+            accept_connections(socket_)
+            await asyncio.gather(*connection_tasks)
+            logger.debug(
+                f"Stan services function `{function_basename}` returned without problems or raised a C++ exception."
+            )
+
+    if message_queues is not None:
+        await _put_message(message_queues, None)
+
+    # writing, syncing and hashing a large fit takes a while. Do not block the event loop.
+    if HTTPSTAN_BINARY_FRAMING:
+        num_draws = sum(decoder.num_rows("sample") for decoder in decoders)
+        fit_bytes = await loop.run_in_executor(None, dump_columns, decoders)
+        await loop.run_in_executor(
+            None, functools.partial(httpstan.cache.dump_fit, fit_bytes, fit_name, num_draws, format="columns")
+        )
+        jsonlines_parts = [bytes(decoder.messages) for decoder in decoders]
+    else:
+        compressed_parts = []
+        for fh in messages_files:
+            compressed_parts.append(fh.getvalue())
+            fh.close()
+        await loop.run_in_executor(None, httpstan.cache.dump_fit, b"".join(compressed_parts), fit_name, num_draws)
 
     # `result()` method will raise exceptions, if any
     error_code = future.result()
@@ -165,10 +350,13 @@ async def call(
         import gzip
         import json
 
+        if not HTTPSTAN_BINARY_FRAMING:
+            jsonlines_parts = [gzip.decompress(b"".join(compressed_parts))]
+
         error_messages, warn_messages = [], []
         num_warn_messages = 4
 
-        jsonlines = gzip.decompress(b"".join(compressed_parts)).decode()
+        jsonlines = b"".join(jsonlines_parts).decode()
         for line in jsonlines.split("\n"):
             try:
                 message = json.loads(line)
@@ -0,0 +1,61 @@
+#ifndef HTTPSTAN_SOCKET_INTERRUPT_HPP
+#define HTTPSTAN_SOCKET_INTERRUPT_HPP
+
+#include "unix_socket_client.hpp"
+#include <chrono>
+#include <stan/callbacks/interrupt.hpp>
+#include <stdexcept>
+#include <string>
+
+namespace stan {
+namespace callbacks {
+
+/**
+ * <code>socket_interrupt</code> is an implementation of <code>interrupt</code>
+ * which stops an algorithm when httpstan closes its end of a socket.
+ *
+ * httpstan closes the socket when an operation is cancelled. The interrupt
+ * holds a connection of its own, on which nothing is sent. Once per
+ * iteration (but no more often than every `check_interval`) the connection
+ * is checked. If the other end has been closed, an exception is thrown which
+ * ends the call to the stan::services function.
+ */
+class socket_interrupt : public interrupt {
+private:
+  static constexpr std::chrono::milliseconds check_interval{10};
+
+  /**
+   * Socket watched for closing by the other end.
+   */
+  httpstan::unix_socket_client socket_;
+
+  std::chrono::steady_clock::time_point next_check_;
+
+public:
+  /**
+   * Constructs an interrupt watching a new connection to a socket.
+   *
+   * @param[in] socket_filename path of the Unix-domain socket to connect to
+   */
+  explicit socket_interrupt(const std::string &socket_filename)
+      : socket_(socket_filename), next_check_(std::chrono::steady_clock::now()) {}
+
+  /**
+   * Throw if the other end of the socket has been closed.
+   *
+   * @throws std::runtime_error if the operation has been cancelled
+   */
+  void operator()() {
+    std::chrono::steady_clock::time_point now = std::chrono::steady_clock::now();
+    if (now < next_check_)
+      return;
+    next_check_ = now + check_interval;
+    if (socket_.peer_closed())
+      throw std::runtime_error("Operation cancelled.");
+  }
+};
+
+} // namespace callbacks
+} // namespace stan
+
+#endif // HTTPSTAN_SOCKET_INTERRUPT_HPP
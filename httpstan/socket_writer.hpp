@@ -3,6 +3,8 @@
 
 #include "unix_socket_client.hpp"
 #include <cstddef>
+#include <cstdint>
+#include <cstring>
 #include <rapidjson/stringbuffer.h>
 #include <rapidjson/writer.h>
 #include <stan/callbacks/writer.hpp>
@@ -44,6 +46,18 @@
  *   sample_writer:"Diagonal elements of inverse mass matrix:"
  *   sample_writer:0.961989
  *
+ * Binary framing:
+ *
+ * If constructed with `binary` set, ``sample_writer`` and ``diagnostic_writer``
+ * send vectors of doubles (draws and diagnostics) as binary frames instead of
+ * JSON. A frame is a zero byte (JSON messages never start with one), a type
+ * byte, the length of the payload in bytes (uint32, little-endian) and the
+ * payload. The column header is sent once, in a frame of type `H` whose
+ * payload is a JSON object such as ``{"topic":"sample","names":["lp__",...]}``.
+ * Each vector of doubles is then sent in a frame of type `R` whose payload is
+ * the values as little-endian float64s, one per name. Other messages are sent
+ * as JSON. See ``httpstan/fits.py`` for the decoder.
+ *
  */
 
 namespace stan {
@@ -74,6 +88,7 @@ private:
   std::string message_prefix_;
   std::vector<std::string> diagnostic_fields_;
   std::vector<std::string> sample_fields_;
+  bool binary_;
   ProcessingAdaptationState processing_adaptation_state_ = ProcessingAdaptationState::BEFORE_PROCESSING_ADAPTATION;
 
   /**
@@ -83,6 +98,47 @@ private:
     socket_.send_line(buffer.GetString(), buffer.GetSize());
   }
 
+  /**
+   * Send a binary frame: a zero byte, `type`, the payload length (uint32, little-endian) and the payload.
+   */
+  void send_frame(char type, const char *payload, std::uint32_t size) {
+    std::vector<char> frame(6 + size);
+    frame[0] = '\0';
+    frame[1] = type;
+    for (int i = 0; i < 4; ++i)
+      frame[2 + i] = static_cast<char>((size >> (8 * i)) & 0xff);
+    std::memcpy(frame.data() + 6, payload, size);
+    socket_.send(frame.data(), frame.size());
+  }
+
+  /**
+   * Send the column header of the values sent in subsequent row frames.
+   */
+  void send_header_frame(const char *topic, const std::vector<std::string> &names) {
+    rapidjson::StringBuffer buffer;
+    rapidjson::Writer<rapidjson::StringBuffer> writer(buffer);
+    writer.StartObject();
+    writer.String("topic");
+    writer.String(topic);
+    writer.String("names");
+    writer.StartArray();
+    for (const std::string &name : names)
+      writer.String(name.c_str());
+    writer.EndArray();
+    writer.EndObject();
+    send_frame('H', buffer.GetString(), static_cast<std::uint32_t>(buffer.GetSize()));
+  }
+
+  /**
+   * Send the first `size` values as little-endian float64s.
+   */
+  void send_row_frame(const std::vector<double> &state, std::size_t size) {
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ != __ORDER_LITTLE_ENDIAN__
+#error "Binary framing requires a little-endian platform."
+#endif
+    send_frame('R', reinterpret_cast<const char *>(state.data()), static_cast<std::uint32_t>(size * sizeof(double)));
+  }
+
 public:
   /**
    * Constructs a writer with an output socket
@@ -90,9 +146,11 @@ public:
    *
    * @param[in] socket_filename path of the Unix-domain socket to connect to
    * @param[in] message_prefix will be prefixed to each string which is sent to the socket. Default is "".
+   * @param[in] binary send draws and diagnostics as binary frames. Default is false.
    */
-  explicit socket_writer(const std::string &socket_filename, const std::string &message_prefix = "")
-      : socket_(socket_filename), message_prefix_(message_prefix) {}
+  explicit socket_writer(const std::string &socket_filename, const std::string &message_prefix = "",
+                         bool binary = false)
+      : socket_(socket_filename), message_prefix_(message_prefix), binary_(binary) {}
 
   /**
    * Writes a sequence of names.
@@ -106,6 +164,8 @@ public:
         for (std::vector<std::string>::const_iterator it = names.begin(); it != last; ++it) {
           diagnostic_fields_.push_back(*it);
         }
+        if (binary_)
+          send_header_frame("diagnostic", diagnostic_fields_);
         return;
       }
 
@@ -138,6 +198,8 @@ public:
       for (std::vector<std::string>::const_iterator it = names.begin(); it != last; ++it) {
         sample_fields_.push_back(*it);
       }
+      if (binary_)
+        send_header_frame("sample", sample_fields_);
       return;
     }
   }
@@ -154,6 +216,10 @@ public:
       if (diagnostic_fields_.empty()) {
         throw std::runtime_error("diagnostic fields must be set before receiving values");
       }
+      if (binary_) {
+        send_row_frame(state, diagnostic_fields_.size());
+        return;
+      }
 
       rapidjson::StringBuffer buffer;
       rapidjson::Writer<rapidjson::StringBuffer, rapidjson::UTF8<>, rapidjson::UTF8<>, rapidjson::CrtAllocator,
@@ -208,6 +274,10 @@ public:
       if ((processing_adaptation_state_ == ProcessingAdaptationState::PROCESSING_ADAPTATION) ||
           (processing_adaptation_state_ == ProcessingAdaptationState::FINAL_ADAPTATION_MESSAGE))
         throw std::runtime_error("Adaptation should have completed before sample writer writes a vector of doubles.");
+      if (binary_) {
+        send_row_frame(state, sample_fields_.size());
+        return;
+      }
 
       rapidjson::StringBuffer buffer;
       rapidjson::Writer<rapidjson::StringBuffer, rapidjson::UTF8<>, rapidjson::UTF8<>, rapidjson::CrtAllocator,
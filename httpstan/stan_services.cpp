@@ -1,6 +1,10 @@
+#include <algorithm>
 #include <exception>
 #include <ostream>
 #include <string>
+#include <thread>
+#include <utility>
+#include <vector>
 
 #include <stan/callbacks/interrupt.hpp>
 #include <stan/callbacks/stream_logger.hpp>
@@ -11,9 +15,11 @@
 #include <stan/services/sample/fixed_param.hpp>
 #include <stan/services/sample/hmc_nuts_diag_e_adapt.hpp>
 
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 
+#include "socket_interrupt.hpp"
 #include "socket_logger.hpp"
 #include "socket_writer.hpp"
 
@@ -37,9 +43,10 @@ stan::io::array_var_context &new_array_var_context(py::dict data) {
   for (auto item : split_results[0])
     names_r.push_back(item.cast<std::string>());
 
-  std::vector<double> values_r;
-  for (auto item : split_results[1])
-    values_r.push_back(item.cast<double>());
+  // contiguous float64 array, see `_split_data`. array_var_context only accepts a std::vector, which it
+  // copies again.
+  auto array_r = split_results[1].cast<py::array_t<double, py::array::c_style | py::array::forcecast>>();
+  std::vector<double> values_r(array_r.data(), array_r.data() + array_r.size());
 
   std::vector<std::vector<size_t>> dim_r;
   for (auto lst : split_results[2]) {
@@ -53,9 +60,9 @@ stan::io::array_var_context &new_array_var_context(py::dict data) {
   for (auto item : split_results[3])
     names_i.push_back(item.cast<std::string>());
 
-  std::vector<int> values_i;
-  for (auto item : split_results[4])
-    values_i.push_back(item.cast<int>());
+  // contiguous int32 array, see `_split_data`
+  auto array_i = split_results[4].cast<py::array_t<int, py::array::c_style | py::array::forcecast>>();
+  std::vector<int> values_i(array_i.data(), array_i.data() + array_i.size());
 
   std::vector<std::vector<size_t>> dim_i;
   for (auto lst : split_results[5]) {
@@ -125,142 +132,206 @@ std::vector<std::vector<size_t>> get_dims(py::dict data) {
   return dims_;
 }
 
-// See exported docstring
-double log_prob(py::dict data, const std::vector<double> &unconstrained_parameters, bool adjust_transform) {
-  double lp;
-  stan::io::array_var_context &var_context = new_array_var_context(data);
-  // random_seed, the second argument, is unused but the function requires it.
-  stan::model::model_base &model = new_model(var_context, (unsigned int)1, &std::cout);
-  if (unconstrained_parameters.size() != model.num_params_r()) {
-    throw std::runtime_error(
-        "The number of parameters does not match the number of unconstrained parameters in the model.");
-  }
-  std::vector<stan::math::var> ad_params_r;
-  ad_params_r.reserve(model.num_params_r());
-  for (size_t i = 0; i < model.num_params_r(); i++) {
-    ad_params_r.push_back(unconstrained_parameters[i]);
-  }
-  // calculate logprob
-  std::vector<int> params_i(model.num_params_i(), 0);
-  std::exception_ptr p;
-  try {
-    // params_i, the second argument, is unused but the function requires it (see model_base.hpp).
-    if (adjust_transform) {
-      lp = model.template log_prob<true, true>(ad_params_r, params_i, &std::cout).val();
-    } else {
-      lp = model.template log_prob<true, false>(ad_params_r, params_i, &std::cout).val();
+// Owns a model instance and the array_var_context holding its data.
+//
+// Constructing a model copies the data and runs the transformed data block. Keeping an instance
+// alive allows model methods to be called repeatedly without paying this cost on every call.
+class model_instance {
+private:
+  stan::io::array_var_context *var_context_;
+  stan::model::model_base *model_;
+
+public:
+  explicit model_instance(py::dict data) : var_context_(&new_array_var_context(data)) {
+    try {
+      // random_seed, the second argument, is unused but the function requires it.
+      model_ = &new_model(*var_context_, (unsigned int)1, &std::cout);
+    } catch (...) {
+      delete var_context_;
+      throw;
     }
-    stan::math::recover_memory();
-  } catch (std::exception &ex) {
-    stan::math::recover_memory();
-    p = std::current_exception();
   }
 
-  delete &model;
-  delete &var_context;
-
-  if (p)
-    std::rethrow_exception(p);
+  ~model_instance() {
+    delete model_;
+    delete var_context_;
+  }
 
-  return lp;
-}
+  model_instance(const model_instance &) = delete;
+  model_instance &operator=(const model_instance &) = delete;
 
-// See exported docstring
-std::vector<double> log_prob_grad(py::dict data, const std::vector<double> &unconstrained_parameters,
-                                  bool adjust_transform) {
-  std::vector<double> gradient;
-  stan::io::array_var_context &var_context = new_array_var_context(data);
-  // random_seed, the second argument, is unused but the function requires it.
-  stan::model::model_base &model = new_model(var_context, (unsigned int)1, &std::cout);
-  if (unconstrained_parameters.size() != model.num_params_r()) {
-    throw std::runtime_error(
-        "The number of parameters does not match the number of unconstrained parameters in the model.");
+  // See exported docstring
+  double log_prob(const std::vector<double> &unconstrained_parameters, bool adjust_transform) const {
+    double lp;
+    if (unconstrained_parameters.size() != model_->num_params_r()) {
+      throw std::runtime_error(
+          "The number of parameters does not match the number of unconstrained parameters in the model.");
+    }
+    std::vector<stan::math::var> ad_params_r;
+    ad_params_r.reserve(model_->num_params_r());
+    for (size_t i = 0; i < model_->num_params_r(); i++) {
+      ad_params_r.push_back(unconstrained_parameters[i]);
+    }
+    // calculate logprob
+    std::vector<int> params_i(model_->num_params_i(), 0);
+    try {
+      // params_i, the second argument, is unused but the function requires it (see model_base.hpp).
+      if (adjust_transform) {
+        lp = model_->template log_prob<true, true>(ad_params_r, params_i, &std::cout).val();
+      } else {
+        lp = model_->template log_prob<true, false>(ad_params_r, params_i, &std::cout).val();
+      }
+      stan::math::recover_memory();
+    } catch (std::exception &ex) {
+      stan::math::recover_memory();
+      throw;
+    }
+    return lp;
   }
-  // The params_r parameter is incorrectly declared as non-const in Stan C++.
-  // Unconstrained_parameters are cast from const to non-const below, as required by Stan (see model_base.hpp).
-  std::vector<double> &params_r = const_cast<std::vector<double> &>(unconstrained_parameters);
-  // calculate gradient
-  std::exception_ptr p;
-  std::vector<int> params_i(model.num_params_i(), 0);
-  try {
+
+  // See exported docstring
+  std::vector<double> log_prob_grad(const std::vector<double> &unconstrained_parameters,
+                                    bool adjust_transform) const {
+    std::vector<double> gradient;
+    if (unconstrained_parameters.size() != model_->num_params_r()) {
+      throw std::runtime_error(
+          "The number of parameters does not match the number of unconstrained parameters in the model.");
+    }
+    // The params_r parameter is incorrectly declared as non-const in Stan C++.
+    // Unconstrained_parameters are cast from const to non-const below, as required by Stan (see model_base.hpp).
+    std::vector<double> &params_r = const_cast<std::vector<double> &>(unconstrained_parameters);
+    // calculate gradient
+    std::vector<int> params_i(model_->num_params_i(), 0);
     // params_i, the third argument, is unused but the function requires it (see model_base.hpp).
     if (adjust_transform) {
-      stan::model::log_prob_grad<true, true>(model, params_r, params_i, gradient, &std::cout);
+      stan::model::log_prob_grad<true, true>(*model_, params_r, params_i, gradient, &std::cout);
     } else {
-      stan::model::log_prob_grad<true, false>(model, params_r, params_i, gradient, &std::cout);
+      stan::model::log_prob_grad<true, false>(*model_, params_r, params_i, gradient, &std::cout);
     }
-  } catch (std::exception &ex) {
-    p = std::current_exception();
+    return gradient;
   }
 
-  delete &model;
-  delete &var_context;
-
-  if (p)
-    std::rethrow_exception(p);
-
-  return gradient;
-}
-
-// See exported docstring
-std::vector<double> write_array(py::dict data, const std::vector<double> &unconstrained_parameters,
-                                bool include_tparams = true, bool include_gqs = true) {
-  rng_t base_rng(0);
-  std::vector<double> params_r_constrained;
-  stan::io::array_var_context &var_context = new_array_var_context(data);
-  // random_seed, the second argument, is unused but the function requires it.
-  stan::model::model_base &model = new_model(var_context, (unsigned int)1, &std::cout);
-  if (unconstrained_parameters.size() != model.num_params_r()) {
-    throw std::runtime_error(
-        "The number of parameters does not match the number of unconstrained parameters in the model.");
+  // See exported docstring
+  //
+  // Rows are divided among `num_threads` threads (all hardware threads if 0). Threads are started
+  // and joined on every call; a long-lived pool would not survive the `fork` used to start sampling
+  // worker processes.
+  std::pair<std::vector<double>, std::vector<std::vector<double>>>
+  log_prob_grad_batch(const std::vector<std::vector<double>> &unconstrained_parameters, bool adjust_transform,
+                      unsigned int num_threads = 0) const {
+    size_t num_rows = unconstrained_parameters.size();
+    for (const std::vector<double> &row : unconstrained_parameters) {
+      if (row.size() != model_->num_params_r()) {
+        throw std::runtime_error(
+            "The number of parameters does not match the number of unconstrained parameters in the model.");
+      }
+    }
+    std::vector<double> lps(num_rows);
+    std::vector<std::vector<double>> gradients(num_rows);
+    if (num_threads == 0)
+      num_threads = std::max(std::thread::hardware_concurrency(), 1u);
+    num_threads = std::min<size_t>(num_threads, num_rows);
+
+    std::vector<std::exception_ptr> exceptions(num_threads);
+    auto evaluate_rows = [&](unsigned int thread_index) {
+      // every thread requires its own autodiff tape
+      stan::math::ChainableStack thread_tape;
+      try {
+        std::vector<int> params_i(model_->num_params_i(), 0);
+        for (size_t i = thread_index; i < num_rows; i += num_threads) {
+          // The params_r parameter is incorrectly declared as non-const in Stan C++ (see model_base.hpp).
+          std::vector<double> &params_r = const_cast<std::vector<double> &>(unconstrained_parameters[i]);
+          if (adjust_transform) {
+            lps[i] = stan::model::log_prob_grad<true, true>(*model_, params_r, params_i, gradients[i], &std::cout);
+          } else {
+            lps[i] = stan::model::log_prob_grad<true, false>(*model_, params_r, params_i, gradients[i], &std::cout);
+          }
+        }
+      } catch (...) {
+        exceptions[thread_index] = std::current_exception();
+      }
+    };
+    {
+      py::gil_scoped_release release;
+      std::vector<std::thread> threads;
+      for (unsigned int t = 0; t < num_threads; t++)
+        threads.emplace_back(evaluate_rows, t);
+      for (std::thread &thread : threads)
+        thread.join();
+    }
+    for (std::exception_ptr &p : exceptions) {
+      if (p)
+        std::rethrow_exception(p);
+    }
+    return std::make_pair(lps, gradients);
   }
-  // The params_r parameter is incorrectly declared as non-const in Stan C++.
-  // Unconstrained_parameters are cast from const to non-const below, as required by Stan (see model_base.hpp).
-  std::vector<double> &params_r = const_cast<std::vector<double> &>(unconstrained_parameters);
-  // constrain parameters to their defined support
-  std::exception_ptr p;
-  std::vector<int> params_i(model.num_params_i(), 0);
-  try {
+
+  // See exported docstring
+  std::vector<double> write_array(const std::vector<double> &unconstrained_parameters, bool include_tparams = true,
+                                  bool include_gqs = true) const {
+    rng_t base_rng(0);
+    std::vector<double> params_r_constrained;
+    if (unconstrained_parameters.size() != model_->num_params_r()) {
+      throw std::runtime_error(
+          "The number of parameters does not match the number of unconstrained parameters in the model.");
+    }
+    // The params_r parameter is incorrectly declared as non-const in Stan C++.
+    // Unconstrained_parameters are cast from const to non-const below, as required by Stan (see model_base.hpp).
+    std::vector<double> &params_r = const_cast<std::vector<double> &>(unconstrained_parameters);
+    // constrain parameters to their defined support
+    std::vector<int> params_i(model_->num_params_i(), 0);
     // params_i, the third argument, is unused but the function requires it (see model_base.hpp).
-    model.write_array(base_rng, params_r, params_i, params_r_constrained, include_tparams, include_gqs, &std::cout);
-  } catch (std::exception &ex) {
-    p = std::current_exception();
+    model_->write_array(base_rng, params_r, params_i, params_r_constrained, include_tparams, include_gqs, &std::cout);
+    return params_r_constrained;
   }
 
-  delete &model;
-  delete &var_context;
+  // See exported docstring
+  std::vector<double> transform_inits(py::dict constrained_parameters) const {
+    std::vector<double> params_r_unconstrained;
+    stan::io::var_context &param_var_context = new_array_var_context(constrained_parameters);
+    // unconstrain parameters from their defined support
+    std::exception_ptr p;
+    std::vector<int> params_i(model_->num_params_i(), 0);
+    try {
+      // params_i, the second argument, is unused but the function requires it (see model_base.hpp).
+      model_->transform_inits(param_var_context, params_i, params_r_unconstrained, &std::cout);
+    } catch (std::exception &ex) {
+      p = std::current_exception();
+    }
 
-  if (p)
-    std::rethrow_exception(p);
+    delete &param_var_context;
 
-  return params_r_constrained;
-}
+    if (p)
+      std::rethrow_exception(p);
 
-// See exported docstring
-std::vector<double> transform_inits(py::dict data, py::dict constrained_parameters) {
-  std::vector<double> params_r_unconstrained;
-  stan::io::array_var_context &var_context = new_array_var_context(data);
-  // random_seed, the second argument, is unused but the function requires it.
-  stan::model::model_base &model = new_model(var_context, (unsigned int)1, &std::cout);
-  stan::io::var_context &param_var_context = new_array_var_context(constrained_parameters);
-  // unconstrain parameters from their defined support
-  std::exception_ptr p;
-  std::vector<int> params_i(model.num_params_i(), 0);
-  try {
-    // params_i, the second argument, is unused but the function requires it (see model_base.hpp).
-    model.transform_inits(param_var_context, params_i, params_r_unconstrained, &std::cout);
-  } catch (std::exception &ex) {
-    p = std::current_exception();
+    return params_r_unconstrained;
   }
+};
 
-  delete &model;
-  delete &var_context;
-  delete &param_var_context;
+// See exported docstring
+double log_prob(py::dict data, const std::vector<double> &unconstrained_parameters, bool adjust_transform) {
+  model_instance instance(data);
+  return instance.log_prob(unconstrained_parameters, adjust_transform);
+}
 
-  if (p)
-    std::rethrow_exception(p);
+// See exported docstring
+std::vector<double> log_prob_grad(py::dict data, const std::vector<double> &unconstrained_parameters,
+                                  bool adjust_transform) {
+  model_instance instance(data);
+  return instance.log_prob_grad(unconstrained_parameters, adjust_transform);
+}
 
-  return params_r_unconstrained;
+// See exported docstring
+std::vector<double> write_array(py::dict data, const std::vector<double> &unconstrained_parameters,
+                                bool include_tparams = true, bool include_gqs = true) {
+  model_instance instance(data);
+  return instance.write_array(unconstrained_parameters, include_tparams, include_gqs);
+}
+
+// See exported docstring
+std::vector<double> transform_inits(py::dict data, py::dict constrained_parameters) {
+  model_instance instance(data);
+  return instance.transform_inits(constrained_parameters);
 }
 
 // See exported docstring
@@ -268,17 +339,18 @@ int hmc_nuts_diag_e_adapt_wrapper(std::string socket_filename, py::dict data, py
                                   int chain, double init_radius, int num_warmup, int num_samples, int num_thin,
                                   bool save_warmup, int refresh, double stepsize, double stepsize_jitter,
                                   int max_depth, double delta, double gamma, double kappa, double t0, int init_buffer,
-                                  int term_buffer, int window) {
+                                  int term_buffer, int window, bool binary_framing) {
   int return_code;
   stan::io::array_var_context &var_context = new_array_var_context(data);
   stan::model::model_base &model = new_model(var_context, (unsigned int)random_seed, &std::cout);
   stan::io::array_var_context &init_var_context = new_array_var_context(init);
-  stan::callbacks::interrupt interrupt;
+  stan::callbacks::socket_interrupt interrupt(socket_filename);
   stan::callbacks::logger *logger = new stan::callbacks::socket_logger(socket_filename, "logger:");
   stan::callbacks::writer *init_writer = new stan::callbacks::socket_writer(socket_filename, "init_writer:");
-  stan::callbacks::writer *sample_writer = new stan::callbacks::socket_writer(socket_filename, "sample_writer:");
+  stan::callbacks::writer *sample_writer =
+      new stan::callbacks::socket_writer(socket_filename, "sample_writer:", binary_framing);
   stan::callbacks::writer *diagnostic_writer =
-      new stan::callbacks::socket_writer(socket_filename, "diagnostic_writer:");
+      new stan::callbacks::socket_writer(socket_filename, "diagnostic_writer:", binary_framing);
   std::exception_ptr p;
   py::gil_scoped_release release;
   try {
@@ -306,17 +378,18 @@ int hmc_nuts_diag_e_adapt_wrapper(std::string socket_filename, py::dict data, py
 
 // See exported docstring
 int fixed_param_wrapper(std::string socket_filename, py::dict data, py::dict init, int random_seed, int chain,
-                        double init_radius, int num_samples, int num_thin, int refresh) {
+                        double init_radius, int num_samples, int num_thin, int refresh, bool binary_framing) {
   int return_code;
   stan::io::array_var_context &var_context = new_array_var_context(data);
   stan::model::model_base &model = new_model(var_context, (unsigned int)random_seed, &std::cout);
   stan::io::array_var_context &init_var_context = new_array_var_context(init);
-  stan::callbacks::interrupt interrupt;
+  stan::callbacks::socket_interrupt interrupt(socket_filename);
   stan::callbacks::logger *logger = new stan::callbacks::socket_logger(socket_filename, "logger:");
   stan::callbacks::writer *init_writer = new stan::callbacks::socket_writer(socket_filename, "init_writer:");
-  stan::callbacks::writer *sample_writer = new stan::callbacks::socket_writer(socket_filename, "sample_writer:");
+  stan::callbacks::writer *sample_writer =
+      new stan::callbacks::socket_writer(socket_filename, "sample_writer:", binary_framing);
   stan::callbacks::writer *diagnostic_writer =
-      new stan::callbacks::socket_writer(socket_filename, "diagnostic_writer:");
+      new stan::callbacks::socket_writer(socket_filename, "diagnostic_writer:", binary_framing);
   std::exception_ptr p;
   py::gil_scoped_release release;
   try {
@@ -364,13 +437,30 @@ PYBIND11_MODULE(stan_services, m) {
         py::arg("include_gqs"), "Call the ``write_array`` method of the model.");
   m.def("transform_inits", &transform_inits, py::arg("data"), py::arg("constrained_parameters"),
         "Call the ``transform_inits`` method of the model.");
+  // Every model-specific extension module defines this class. `module_local` keeps pybind11 from
+  // registering the same C++ type globally more than once.
+  py::class_<model_instance>(m, "Model", py::module_local(),
+                             "Instance of the model, constructed once from ``data`` and reused across calls.")
+      .def(py::init<py::dict>(), py::arg("data"))
+      .def("log_prob", &model_instance::log_prob, py::arg("unconstrained_parameters"), py::arg("adjust_transform"),
+           "Call the ``log_prob`` method of the model.")
+      .def("log_prob_grad", &model_instance::log_prob_grad, py::arg("unconstrained_parameters"),
+           py::arg("adjust_transform"), "Call stan::model::log_prob_grad")
+      .def("log_prob_grad_batch", &model_instance::log_prob_grad_batch, py::arg("unconstrained_parameters"),
+           py::arg("adjust_transform"), py::arg("num_threads") = 0,
+           "Call stan::model::log_prob_grad for each row of ``unconstrained_parameters``, using several threads. "
+           "Returns log densities and gradients.")
+      .def("write_array", &model_instance::write_array, py::arg("unconstrained_parameters"),
+           py::arg("include_tparams"), py::arg("include_gqs"), "Call the ``write_array`` method of the model.")
+      .def("transform_inits", &model_instance::transform_inits, py::arg("constrained_parameters"),
+           "Call the ``transform_inits`` method of the model.");
   m.def("hmc_nuts_diag_e_adapt_wrapper", &hmc_nuts_diag_e_adapt_wrapper, py::arg("socket_filename"), py::arg("data"),
         py::arg("init"), py::arg("random_seed"), py::arg("chain"), py::arg("init_radius"), py::arg("num_warmup"),
         py::arg("num_samples"), py::arg("num_thin"), py::arg("save_warmup"), py::arg("refresh"), py::arg("stepsize"),
         py::arg("stepsize_jitter"), py::arg("max_depth"), py::arg("delta"), py::arg("gamma"), py::arg("kappa"),
         py::arg("t0"), py::arg("init_buffer"), py::arg("term_buffer"), py::arg("window"),
-        "Call stan::services::sample::hmc_nuts_diag_e_adapt");
+        py::arg("binary_framing") = false, "Call stan::services::sample::hmc_nuts_diag_e_adapt");
   m.def("fixed_param_wrapper", &fixed_param_wrapper, py::arg("socket_filename"), py::arg("data"), py::arg("init"),
         py::arg("random_seed"), py::arg("chain"), py::arg("init_radius"), py::arg("num_samples"), py::arg("num_thin"),
-        py::arg("refresh"), "Call stan::services::sample::fixed_param");
+        py::arg("refresh"), py::arg("binary_framing") = false, "Call stan::services::sample::fixed_param");
 }
@@ -0,0 +1,244 @@
+"""Storage backends for models and fits.
+
+A storage backend holds blobs identified by keys such as
+``models/dyeicfn2/stderr.log``. Keys are relative paths using ``/`` as the
+separator. ``httpstan.cache`` stores compiler output, stanc warnings,
+extension modules and fits using a backend. A backend shared by several
+machines lets a model compiled on one machine be used on all of them.
+
+The backend is chosen with ``HTTPSTAN_STORAGE`` (see `from_url`).
+"""
+
+import abc
+import http.client
+import io
+import os
+import tempfile
+import typing
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+
+
+class Storage(abc.ABC):
+    """Store of blobs identified by keys."""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> bytes:
+        """Get the blob stored under `key`.
+
+        Raises:
+            KeyError: `key` not found.
+
+        """
+
+    @abc.abstractmethod
+    def put(self, key: str, data: bytes) -> None:
+        """Store `data` under `key`, replacing any existing blob."""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """Delete the blob stored under `key`.
+
+        Raises:
+            KeyError: `key` not found.
+
+        """
+
+    @abc.abstractmethod
+    def list(self, prefix: str) -> typing.List[str]:
+        """List keys starting with `prefix`."""
+
+    @abc.abstractmethod
+    def size(self, key: str) -> int:
+        """Get the size, in bytes, of the blob stored under `key`.
+
+        Raises:
+            KeyError: `key` not found.
+
+        """
+
+    def open(self, key: str) -> typing.BinaryIO:
+        """Open the blob stored under `key` for reading.
+
+        The file object returned may not support seeking.
+
+        Raises:
+            KeyError: `key` not found.
+
+        """
+        return io.BytesIO(self.get(key))
+
+    def path(self, key: str) -> typing.Optional[Path]:
+        """Get the path of the local file holding the blob stored under `key`, if there is one."""
+        return None
+
+
+class LocalStorage(Storage):
+    """Blobs stored as files in a local directory.
+
+    Arguments:
+        root: Directory holding the files. Keys are paths relative to `root`.
+
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    def get(self, key: str) -> bytes:
+        try:
+            return self.path(key).read_bytes()
+        except FileNotFoundError:
+            raise KeyError(f"`{key}` not found in `{self.root}`.")
+
+    def size(self, key: str) -> int:
+        try:
+            return self.path(key).stat().st_size
+        except FileNotFoundError:
+            raise KeyError(f"`{key}` not found in `{self.root}`.")
+
+    def open(self, key: str) -> typing.BinaryIO:
+        try:
+            return self.path(key).open("rb")
+        except FileNotFoundError:
+            raise KeyError(f"`{key}` not found in `{self.root}`.")
+
+    def put(self, key: str, data: bytes) -> None:
+        # Write to a temporary file, flushed to disk, and rename it. Renaming is atomic: readers
+        # see either the old or the new blob, never a partly written one, even after a crash.
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=".httpstan_")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        # record the rename itself on disk
+        directory_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def delete(self, key: str) -> None:
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            raise KeyError(f"`{key}` not found in `{self.root}`.")
+
+    def list(self, prefix: str) -> typing.List[str]:
+        # only directories which could contain matching keys are searched
+        directory = self.path(prefix).parent if not prefix.endswith("/") else self.path(prefix)
+        if not directory.is_dir():
+            return []
+        # temporary files, named ".httpstan_*", are not blobs
+        paths = (path for path in directory.rglob("*") if path.is_file() and not path.name.startswith(".httpstan_"))
+        keys = (path.relative_to(self.root).as_posix() for path in paths)
+        return sorted(key for key in keys if key.startswith(prefix))
+
+
+class SharedFilesystemStorage(LocalStorage):
+    """Blobs stored as files in a directory shared by several machines, e.g., over NFS.
+
+    Like `LocalStorage`, blobs are written to a temporary file which is then
+    renamed. Renaming a file within a directory is atomic on NFS as well, so
+    readers on other machines never see a partly written blob.
+
+    """
+
+
+class HTTPStorage(Storage):
+    """Blobs stored by an HTTP server with an S3-style interface.
+
+    A blob is read, written and deleted with ``GET``, ``PUT`` and ``DELETE``
+    requests to ``<url>/<key>``. Keys are listed with S3 ``ListObjectsV2``
+    requests (``GET <url>?list-type=2&prefix=<prefix>``). Requests are not
+    signed. Use a bucket (or a proxy in front of one) which does not require
+    signed requests.
+
+    Arguments:
+        url: URL of the bucket, e.g., ``http://minio.internal:9000/httpstan``.
+        timeout: Timeout for each request, in seconds.
+
+    """
+
+    def __init__(self, url: str, timeout: float = 60) -> None:
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method: str, key: str = "", data: typing.Optional[bytes] = None, query: str = "") -> bytes:
+        return self._send(method, key, data, query)[1]
+
+    def _send(
+        self, method: str, key: str = "", data: typing.Optional[bytes] = None, query: str = ""
+    ) -> typing.Tuple[http.client.HTTPMessage, bytes]:
+        with self._urlopen(method, key, data, query) as response:
+            return response.headers, response.read()
+
+    def _urlopen(
+        self, method: str, key: str = "", data: typing.Optional[bytes] = None, query: str = ""
+    ) -> http.client.HTTPResponse:
+        url = f"{self.url}/{urllib.parse.quote(key)}" + (f"?{query}" if query else "")
+        request = urllib.request.Request(url, data=data, method=method)
+        try:
+            return typing.cast(http.client.HTTPResponse, urllib.request.urlopen(request, timeout=self.timeout))
+        except urllib.error.HTTPError as exc:
+            if exc.code == 404:
+                raise KeyError(f"`{key}` not found at `{self.url}`.")
+            raise
+
+    def get(self, key: str) -> bytes:
+        return self._request("GET", key)
+
+    def open(self, key: str) -> typing.BinaryIO:
+        # the blob is read as it arrives, without waiting for all of it. The response does not support seeking.
+        return typing.cast(typing.BinaryIO, self._urlopen("GET", key))
+
+    def put(self, key: str, data: bytes) -> None:
+        self._request("PUT", key, data)
+
+    def size(self, key: str) -> int:
+        headers, _ = self._send("HEAD", key)
+        return int(headers["Content-Length"])
+
+    def delete(self, key: str) -> None:
+        # S3 reports success when deleting a missing key. Look before deleting.
+        self._request("HEAD", key)
+        self._request("DELETE", key)
+
+    def list(self, prefix: str) -> typing.List[str]:
+        keys: typing.List[str] = []
+        params = {"list-type": "2", "prefix": prefix}
+        while True:
+            root = ElementTree.fromstring(self._request("GET", query=urllib.parse.urlencode(params)))
+            keys.extend(element.text or "" for element in root.iterfind("{*}Contents/{*}Key"))
+            token = root.findtext("{*}NextContinuationToken")
+            if root.findtext("{*}IsTruncated") != "true" or not token:
+                return keys
+            params["continuation-token"] = token
+
+
+def from_url(url: str) -> Storage:
+    """Create a storage backend from a URL.
+
+    ``http://`` and ``https://`` URLs give an `HTTPStorage`. Paths, and
+    ``file://`` URLs, give a `SharedFilesystemStorage`.
+
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme in {"http", "https"}:
+        return HTTPStorage(url)
+    if parsed.scheme in {"", "file"}:
+        return SharedFilesystemStorage(Path(urllib.parse.unquote(parsed.path)))
+    raise ValueError(f"Unsupported storage URL `{url}`.")
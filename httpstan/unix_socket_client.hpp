@@ -18,7 +18,7 @@ namespace httpstan {
  *
  * It is a small RAII replacement for the sliver of <code>boost::asio</code>
  * that httpstan used: connect to a filesystem path, write newline-terminated
- * messages, and close on destruction. Only Linux and macOS are supported.
+ * messages (or binary frames), notice when the other end has been closed, and close on destruction. Only Linux and macOS are supported.
  */
 class unix_socket_client {
 private:
@@ -109,6 +109,27 @@ public:
     write_all(data, len);
     write_all("\n", 1);
   }
+
+  /**
+   * Write @p len bytes from @p data, blocking until everything has been sent.
+   *
+   * @throws std::runtime_error on any write error
+   */
+  void send(const char *data, std::size_t len) { write_all(data, len); }
+
+  /**
+   * Return true if the other end of the connection has been closed.
+   *
+   * Does not block. Any data waiting to be read is left in place.
+   */
+  bool peer_closed() const {
+    char byte;
+    ssize_t n = ::recv(fd_, &byte, 1, MSG_PEEK | MSG_DONTWAIT);
+    if (n == -1) {
+      return !(errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR);
+    }
+    return n == 0;
+  }
 };
 
 } // namespace httpstan
@@ -8,7 +8,7 @@ import numpy as np
 
 def _split_data(
     data: dict,
-) -> Tuple[List[str], List[float], List[Tuple[int, ...]], List[str], List[int], List[Tuple[int, ...]]]:
+) -> Tuple[List[bytes], np.ndarray, List[Tuple[int, ...]], List[bytes], np.ndarray, List[Tuple[int, ...]]]:
     """Prepare data for use in an array_var_context constructor.
 
     array_var_context is a C++ class defined in Stan. See
@@ -28,6 +28,10 @@ def _split_data(
     uses row-major order by default. To unravel a multi-dimensional array using
     column-major order using numpy indicate order `F` ('F' stands for Fortran).
 
+    Values are returned as contiguous float64 and int32 arrays. C++ reads them
+    through the buffer protocol and copies each into the ``std::vector``
+    passed to ``array_var_context``, which stores a copy of its own.
+
     Arguments:
         data: Mapping of names to values (e.g., {'y': [0, 1, 2]}).
 
@@ -35,27 +39,48 @@ def _split_data(
         Arguments with types matching the signature of ``array_var_context``.
 
     """
-    data = data.copy()
-
-    names_r: List[str] = []
-    values_r: List[float] = []
+    names_r: List[bytes] = []
+    arrays_r: List[np.ndarray] = []
     dim_r: List[Tuple[int, ...]] = []
 
-    names_i: List[str] = []
-    values_i: List[int] = []
+    names_i: List[bytes] = []
+    arrays_i: List[np.ndarray] = []
     dim_i: List[Tuple[int, ...]] = []
 
     for k, v in data.items():
-        if np.issubdtype(np.asarray(v).dtype, np.floating):
+        array = np.asarray(v)
+        if np.issubdtype(array.dtype, np.floating):
             names_r.append(k.encode("utf-8"))
-            # unravel multi-dimensional arrays using column-major ('F') order
-            values_r.extend(np.atleast_1d(v).ravel(order="F").astype(float))
-            dim_r.append(np.asarray(v).shape)
-        elif np.issubdtype(np.asarray(v).dtype, np.integer):
+            arrays_r.append(array)
+            dim_r.append(array.shape)
+        elif np.issubdtype(array.dtype, np.integer):
+            check_int32_range(k, array)
             names_i.append(k.encode("utf-8"))
-            # unravel multi-dimensional arrays using column-major ('F') order
-            values_i.extend(np.atleast_1d(v).ravel(order="F").astype(int))
-            dim_i.append(np.asarray(v).shape)
+            arrays_i.append(array)
+            dim_i.append(array.shape)
         else:
             raise ValueError(f"Variable `{k}` must be int or float.")
-    return names_r, values_r, dim_r, names_i, values_i, dim_i
+    return names_r, _ravel_arrays(arrays_r, np.float64), dim_r, names_i, _ravel_arrays(arrays_i, np.int32), dim_i
+
+
+def check_int32_range(name: str, array: np.ndarray) -> None:
+    """Check that the values of integer variable `name` fit in ``int``, the type Stan uses for integers.
+
+    Raises:
+        ValueError: Value out of range.
+
+    """
+    int32 = np.iinfo(np.int32)
+    if array.size and (array.min() < int32.min or array.max() > int32.max):
+        raise ValueError(f"Variable `{name}` must be within the range of a 32-bit integer.")
+
+
+def _ravel_arrays(arrays: List[np.ndarray], dtype: type) -> np.ndarray:
+    """Unravel arrays using column-major ('F') order into one contiguous array of type `dtype`."""
+    values: np.ndarray = np.empty(sum(array.size for array in arrays), dtype=dtype)
+    start = 0
+    for array in arrays:
+        # a column-major view of the destination, assigned to with a single copy
+        values[start : start + array.size].reshape(array.shape, order="F")[...] = array
+        start += array.size
+    return values
@@ -8,23 +8,48 @@ import asyncio
 import functools
 import gzip
 import http
+import io
+import json
 import logging
+import random
 import re
 import traceback
-from typing import Optional, Sequence, cast
-
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    cast,
+)
+
+import aiohttp
 import aiohttp.web
+import marshmallow
+import numpy as np
 import webargs.aiohttpparser
 
 import httpstan.cache
+import httpstan.compile
+import httpstan.datasets
 import httpstan.fits
 import httpstan.models
+import httpstan.scheduler
 import httpstan.schemas as schemas
 import httpstan.services_stub as services_stub
+from httpstan.config import HTTPSTAN_MAX_OPERATIONS
 
 logger = logging.getLogger("httpstan")
 
 
+# fits are sent to clients in chunks of this many bytes
+FIT_CHUNK_SIZE = 256 * 1024
+# maximum number of messages waiting to be sent to a client following a running operation
+OPERATION_MESSAGES_QUEUE_SIZE = 1024
+
 # match a string such as `Iteration: 2000 / 2000 [100%]  (Sampling)`
 iteration_info_re = re.compile(rb"Iteration:\s+\d+ / \d+ \[\s*\d+%\]\s+\(\w+\)")
 
@@ -36,6 +61,137 @@ def _make_error(message: str, status: int, details: Optional[Sequence] = None) -
     return cast(dict, schemas.Status().load(status_dict))
 
 
+def _accepts(request: aiohttp.web.Request, value: str, header: str = "Accept") -> bool:
+    """Return True if `value` is explicitly listed (with nonzero quality) in a request header.
+
+    Used with ``Accept`` (media types) and ``Accept-Encoding`` (content codings).
+
+    """
+    for header_value in request.headers.getall(header, []):
+        for item in header_value.split(","):
+            token, *params = (part.strip() for part in item.split(";"))
+            if token.lower() == value and not any(param.replace(" ", "") in {"q=0", "q=0.0"} for param in params):
+                return True
+    return False
+
+
+async def _parse_args(schema: marshmallow.Schema, request: aiohttp.web.Request) -> dict:
+    """Parse the arguments in the body of a request.
+
+    Arguments are sent either as a JSON object or, for large data, as a
+    ``multipart/form-data`` body. In a multipart body, the part named ``args``
+    holds the JSON object of arguments, and parts named ``<field>.<name>``
+    (e.g., ``data.y``) hold arrays in NumPy ``.npy`` format. Arrays are added
+    to the field (e.g., ``data``) after the JSON arguments are validated,
+    without validating each of their elements.
+
+    Raises:
+        aiohttp.web.HTTPUnprocessableEntity: Invalid arguments, as with JSON bodies.
+
+    """
+    if request.content_type != "multipart/form-data":
+        return cast(dict, await webargs.aiohttpparser.parser.parse(schema, request))
+
+    json_args: dict = {}
+    arrays: List[Tuple[str, str, np.ndarray]] = []
+    errors: dict = {}
+    async for part in await request.multipart():
+        if not isinstance(part, aiohttp.BodyPartReader) or part.name is None:
+            errors.setdefault("_schema", []).append("Parts must have a name.")
+            continue
+        if part.name == "args":
+            try:
+                json_args = json.loads(await part.read())
+            except ValueError:
+                errors["args"] = ["Invalid JSON."]
+                continue
+            if not isinstance(json_args, dict):
+                errors["args"] = ["Arguments must be a JSON object."]
+            continue
+        field, _, name = part.name.partition(".")
+        # only fields holding data (schemas.Data) accept arrays
+        if not name or not isinstance(getattr(schema.fields.get(field), "schema", None), schemas.Data):
+            errors[part.name] = ["Unknown field."]
+            continue
+        try:
+            array = np.lib.format.read_array(io.BytesIO(await part.read()), allow_pickle=False)
+        except ValueError:
+            errors[part.name] = ["Invalid NPY array."]
+            continue
+        if not (np.issubdtype(array.dtype, np.floating) or np.issubdtype(array.dtype, np.integer)):
+            errors[part.name] = ["Values must be integers or floating point numbers."]
+            continue
+        arrays.append((field, name, array))
+
+    if not errors:
+        try:
+            args = schema.load(json_args)
+        except marshmallow.ValidationError as exc:
+            errors.update(cast(dict, exc.messages))
+    if not errors:
+        for field, name, array in arrays:
+            if name in args[field]:
+                errors[f"{field}.{name}"] = ["Value also provided in JSON arguments."]
+            # copy, as the default value of a field is shared
+            args[field] = {**args[field], name: array}
+    if errors:
+        webargs.aiohttpparser.parser.handle_error(
+            marshmallow.ValidationError({"form": errors}),
+            request,
+            schema,
+            error_status_code=None,
+            error_headers=None,
+        )
+    return cast(dict, args)
+
+
+async def _read_ahead(read: Callable[[], bytes]) -> AsyncIterator[bytes]:
+    """Yield what `read`, called in a different thread, returns until it returns nothing.
+
+    Each chunk is yielded only once the following one has been read. The
+    checksum of a `httpstan.cache.FitStream` is checked when its end is read, so
+    the final chunk of a corrupt fit is never sent.
+
+    """
+    loop = asyncio.get_running_loop()
+    chunk = await loop.run_in_executor(None, read)
+    while chunk:
+        next_chunk = await loop.run_in_executor(None, read)
+        yield chunk
+        chunk = next_chunk
+
+
+def _open_messages(fit_stream: httpstan.cache.FitStream) -> BinaryIO:
+    """Open the newline-delimited JSON-encoded messages of a fit.
+
+    A fit stored as columns is read out of order, so all of it is checked against its metadata
+    first. Other fits are checked once they have been read (see `httpstan.cache.FitStream`).
+
+    """
+    if fit_stream.metadata["format"] == "columns":
+        fit_stream.verify()
+        return httpstan.fits.open_messages(fit_stream.raw)
+    return cast(BinaryIO, gzip.GzipFile(fileobj=cast(BinaryIO, fit_stream)))
+
+
+def _draws_npz(fit_stream: httpstan.cache.FitStream) -> bytes:
+    """Return draws in a fit as a NumPy ``.npz`` archive with arrays ``names`` and ``draws``.
+
+    Arguments:
+        fit_stream: Stan fit, as returned by `httpstan.cache.open_fit_stream`.
+
+    """
+    if fit_stream.metadata["format"] == "columns":
+        fit_stream.verify()
+        names, draws = httpstan.fits.read_draws(fit_stream.raw)
+    else:
+        with _open_messages(fit_stream) as lines:
+            names, draws = httpstan.fits.extract_draws(lines)
+    fh = io.BytesIO()
+    np.savez(fh, names=np.array(names, dtype=str), draws=draws)
+    return fh.getvalue()
+
+
 async def handle_health(request: aiohttp.web.Request) -> aiohttp.web.Response:
     """Return 200 OK.
 
@@ -49,12 +205,44 @@ async def handle_health(request: aiohttp.web.Request) -> aiohttp.web.Response:
     return aiohttp.web.Response(text="httpstan is running.")
 
 
+async def handle_get_cache_usage(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Report the number and combined size of each kind of entry in the cache.
+
+    ---
+    get:
+      summary: Get cache usage
+      description: >-
+        Get the number and combined size (in bytes) of models, fits, data
+        sets, compiled object files and precompiled headers in the cache
+        directory. The size of a model does not include its fits.
+      produces:
+        - application/json
+      responses:
+        "200":
+          description: Cache usage.
+          schema: CacheUsage
+    """
+    # scanning the cache directory may take a while. Scan in a different thread.
+    usage = await asyncio.get_running_loop().run_in_executor(None, httpstan.cache.cache_usage)
+    return aiohttp.web.json_response(schemas.CacheUsage().load(usage))
+
+
 async def handle_create_model(request: aiohttp.web.Request) -> aiohttp.web.Response:
     """Compile Stan model.
 
     ---
     post:
-      description: Compile a Stan model
+      summary: Compile a Stan model
+      description: >-
+        Compile a Stan model.
+
+        Building a model can take a minute or more. If ``asynchronous`` is
+        true, the response is sent immediately. It is an Operation named
+        ``operations/{model_id}`` which may be polled. While the model is
+        being built, ``progress`` in the operation metadata records the
+        current phase of the build: ``stanc`` (translating the Stan program
+        to C++), ``compile`` (compiling C++) or ``link``. When the operation
+        is done, its result is the Model.
       consumes:
         - application/json
       produces:
@@ -67,7 +255,9 @@ async def handle_create_model(request: aiohttp.web.Request) -> aiohttp.web.Respo
           schema: CreateModelRequest
       responses:
         "201":
-          description: Identifier for compiled Stan model and compiler output.
+          description: >-
+            Identifier for compiled Stan model and compiler output. If
+            ``asynchronous`` is true, an Operation whose result is the Model.
           schema: Model
         "400":
           description: Error associated with compile request.
@@ -78,53 +268,163 @@ async def handle_create_model(request: aiohttp.web.Request) -> aiohttp.web.Respo
 
     program_code = args["program_code"]
     model_name = httpstan.models.calculate_model_name(program_code)
-
-    # check if extension module is present in cache
-    try:
-        httpstan.models.import_services_extension_module(model_name)
-    except KeyError:
-        pass
-    else:
-        logger.info(f"Found Stan model in cache (`{model_name}`).")
-        compiler_output = httpstan.cache.load_services_extension_module_compiler_output(model_name)
-        stanc_warnings = httpstan.cache.load_stanc_warnings(model_name)
-        response_dict = schemas.Model().load(
-            {"name": model_name, "compiler_output": compiler_output, "stanc_warnings": stanc_warnings}
+    operation_name = f'operations/{model_name.split("/")[-1]}'
+
+    # Concurrent requests for the same model share a single build.
+    builds = request.app["model_builds"]
+    if model_name not in builds:
+        # check if extension module is present in cache
+        try:
+            compiler_output, stanc_warnings = await _load_model(model_name)
+        except KeyError:
+            pass
+        else:
+            logger.info(f"Found Stan model in cache (`{model_name}`).")
+            response_dict = schemas.Model().load(
+                {"name": model_name, "compiler_output": compiler_output, "stanc_warnings": stanc_warnings}
+            )
+            if args["asynchronous"]:
+                operation_dict = schemas.Operation().load(
+                    {
+                        "name": operation_name,
+                        "done": True,
+                        "metadata": {"model": {"name": model_name}},
+                        "result": response_dict,
+                    }
+                )
+                _add_operation(request.app, operation_dict)
+                return aiohttp.web.json_response(operation_dict, status=201)
+            return aiohttp.web.json_response(response_dict, status=201)
+
+    # extension module is not in cache. Another request may have started building it meanwhile.
+    if model_name not in builds:
+        operation_dict = schemas.Operation().load(
+            {"name": operation_name, "done": False, "metadata": {"model": {"name": model_name}}}
         )
-        return aiohttp.web.json_response(response_dict, status=201)
+        _add_operation(request.app, operation_dict)
+        builds[model_name] = (asyncio.create_task(_build_model(program_code, operation_dict)), operation_dict)
+        builds[model_name][0].add_done_callback(lambda _: builds.pop(model_name, None))
+    else:
+        logger.info(f"Waiting for build of Stan model in progress (`{model_name}`).")
+
+    task, operation_dict = builds[model_name]
+    if args["asynchronous"]:
+        return aiohttp.web.json_response(operation_dict, status=201)
+
+    # shield the build from cancellation, other requests may be waiting for it
+    await asyncio.shield(task)
+    result = operation_dict["result"]
+    if "code" in result:
+        return aiohttp.web.json_response(result, status=result["code"])
+    return aiohttp.web.json_response(result, status=201)
+
+
+async def _load_model(model_name: str) -> Tuple[str, str]:
+    """Import a model's extension module and load its compiler output and stanc warnings.
+
+    This function is a coroutine.
+
+    Raises:
+        KeyError: Model not found.
+
+    """
+    await httpstan.models.fetch_and_import_services_extension_module(model_name)
+    loop = asyncio.get_running_loop()
+    compiler_output = await loop.run_in_executor(
+        None, httpstan.cache.load_services_extension_module_compiler_output, model_name
+    )
+    return compiler_output, await loop.run_in_executor(None, httpstan.cache.load_stanc_warnings, model_name)
+
 
-    # extension module is not in cache
+async def _build_model(program_code: str, operation: dict) -> None:
+    """Build a model-specific services extension module and save it in the cache.
 
-    # clean the directory in which the model will be compiled.
-    httpstan.cache.delete_model_directory(model_name)
+    Progress and the result (a `Model` or a `Status`) are recorded in the
+    operation. Other processes using the cache directory build the model at
+    most once: if a model is found in the cache after waiting for the build
+    lock, it is not built again.
+
+    This function is a coroutine.
+
+    """
+    model_name = operation["metadata"]["model"]["name"]
+
+    def progress_callback(phase: str) -> None:
+        operation["metadata"]["progress"] = phase
 
-    # compile `program_code` to check for fatal errors. If none, save stanc warnings
-    stan_model_name = f"model_{model_name.split('/')[1]}"  # stan name cannot start with number
     try:
-        _, stanc_warnings = httpstan.compile.compile(program_code, stan_model_name)
+        compiler_output, stanc_warnings = await _build_model_locked(program_code, model_name, progress_callback)
     except ValueError as exc:
         message, status = f"Exception while compiling `program_code`: `{repr(exc)}`", 400
         logger.critical(message)
-        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
-    httpstan.cache.dump_stanc_warnings(stanc_warnings, model_name)
-
-    # no fatal stanc errors, continue
-    logger.info(f"Building model-specific services extension module for `{model_name}`.")
-    try:
-        # `build_services_extension_module` has side-effect of storing extension module in cache
-        compiler_output = await httpstan.models.build_services_extension_module(program_code)
+        operation["result"] = _make_error(message, status=status)
     except Exception as exc:  # pragma: no cover
         message, status = (
             f"Exception while building model extension module: `{repr(exc)}`, traceback: `{traceback.format_tb(exc.__traceback__)}`",
             400,
         )
         logger.critical(message)
-        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
-    httpstan.cache.dump_services_extension_module_compiler_output(compiler_output, model_name)
-    response_dict = schemas.Model().load(
-        {"name": model_name, "compiler_output": compiler_output, "stanc_warnings": stanc_warnings}
-    )
-    return aiohttp.web.json_response(response_dict, status=201)
+        operation["result"] = _make_error(message, status=status)
+    else:
+        operation["result"] = schemas.Model().load(
+            {"name": model_name, "compiler_output": compiler_output, "stanc_warnings": stanc_warnings}
+        )
+    operation["done"] = True
+
+
+async def _build_model_locked(
+    program_code: str, model_name: str, progress_callback: Callable[[str], None]
+) -> Tuple[str, str]:
+    """Build a model while holding the model's build lock.
+
+    `progress_callback` is called with ``"stanc"``, ``"compile"`` and ``"link"``
+    as each phase of the build starts.
+
+    This function is a coroutine.
+
+    Returns:
+        Compiler output and stanc warnings.
+
+    Raises:
+        ValueError: `program_code` is not a valid Stan program.
+
+    """
+    loop = asyncio.get_running_loop()
+    async with httpstan.cache.model_build_lock(model_name):
+        try:
+            compiler_output, stanc_warnings = await _load_model(model_name)
+        except KeyError:
+            pass
+        else:
+            logger.info(f"Stan model built by another process (`{model_name}`).")
+            return compiler_output, stanc_warnings
+
+        # clean the directory in which the model will be compiled.
+        httpstan.cache.delete_model_directory(model_name)
+
+        # compile `program_code` to check for fatal errors. If none, save stanc warnings
+        progress_callback("stanc")
+        stan_model_name = httpstan.models.calculate_stan_model_name(program_code)
+        _, stanc_warnings = httpstan.compile.compile(program_code, stan_model_name)
+        await loop.run_in_executor(None, httpstan.cache.dump_stanc_warnings, stanc_warnings, model_name)
+
+        # no fatal stanc errors, continue
+        logger.info(f"Building model-specific services extension module for `{model_name}`.")
+        try:
+            # `build_services_extension_module` has side-effect of storing extension module in cache
+            compiler_output = await httpstan.models.build_services_extension_module(
+                program_code, progress_callback=progress_callback
+            )
+            await loop.run_in_executor(
+                None, httpstan.cache.dump_services_extension_module_compiler_output, compiler_output, model_name
+            )
+            # make the model available to other machines sharing the storage backend. Uploading may take a while.
+            await loop.run_in_executor(None, httpstan.cache.store_services_extension_module, model_name)
+        except BaseException:
+            # do not leave an incomplete model in the cache
+            await loop.run_in_executor(None, httpstan.cache.delete_model, model_name)
+            raise
+    return compiler_output, stanc_warnings
 
 
 async def handle_list_models(request: aiohttp.web.Request) -> aiohttp.web.Response:
@@ -132,9 +432,29 @@ async def handle_list_models(request: aiohttp.web.Request) -> aiohttp.web.Respon
 
     ---
     get:
-      description: List cached models.
+      description: >-
+        List cached models, in order of their names. If ``page_size`` is set,
+        at most ``page_size`` models are listed. If there are more,
+        ``next_page_token`` is set in the response. Pass it as ``page_token``
+        to get the next page.
       produces:
         - application/json
+      parameters:
+        - name: page_size
+          in: query
+          description: Maximum number of models listed.
+          required: false
+          type: integer
+        - name: page_token
+          in: query
+          description: Token, from a previous response, for the page of models desired.
+          required: false
+          type: string
+        - name: names_only
+          in: query
+          description: If true, list only the names of models, leaving out compiler output and stanc warnings.
+          required: false
+          type: boolean
       responses:
         "200":
           description: Identifier for compiled Stan model and compiler output.
@@ -145,18 +465,45 @@ async def handle_list_models(request: aiohttp.web.Request) -> aiohttp.web.Respon
               models:
                 type: array
                 items: Model
+              next_page_token:
+                type: string
     """
+    args = cast(dict, await webargs.aiohttpparser.parser.parse(schemas.ListModelsRequest(), request, location="query"))
+    # listing models reads from the storage backend
+    response = await asyncio.get_running_loop().run_in_executor(None, _list_models, args)
+    return aiohttp.web.json_response(response, status=200)
+
+
+def _list_models(args: dict) -> dict:
+    """List cached models, as requested by `handle_list_models`. Call in a thread other than the event loop's."""
+    page_size = args.get("page_size", 0)
+    # one more name than requested tells if there is another page
+    model_names = httpstan.cache.list_model_names(start_after=args["page_token"], limit=page_size and page_size + 1)
+    next_page_token = None
+    if page_size and len(model_names) > page_size:
+        model_names = model_names[:page_size]
+        next_page_token = model_names[-1]
 
     models = []
-    for model_name in httpstan.cache.list_model_names():
-        compiler_output = httpstan.cache.load_services_extension_module_compiler_output(model_name)
-        stanc_warnings = httpstan.cache.load_stanc_warnings(model_name)
+    for model_name in model_names:
+        if args["names_only"]:
+            models.append({"name": model_name})
+            continue
+        try:
+            compiler_output = httpstan.cache.load_services_extension_module_compiler_output(model_name)
+            stanc_warnings = httpstan.cache.load_stanc_warnings(model_name)
+        except KeyError:  # pragma: no cover
+            # model deleted since it was listed
+            continue
         models.append(
             schemas.Model().load(
                 {"name": model_name, "compiler_output": compiler_output, "stanc_warnings": stanc_warnings}
             )
         )
-    return aiohttp.web.json_response({"models": models}, status=200)
+    response: dict = {"models": models}
+    if next_page_token is not None:
+        response["next_page_token"] = next_page_token
+    return response
 
 
 async def handle_delete_model(request: aiohttp.web.Request) -> aiohttp.web.Response:
@@ -186,19 +533,154 @@ async def handle_delete_model(request: aiohttp.web.Request) -> aiohttp.web.Respo
           schema: Status
     """
     model_name = f"models/{request.match_info['model_id']}"
+    loop = asyncio.get_running_loop()
 
     try:
-        httpstan.models.import_services_extension_module(model_name)
+        await httpstan.models.fetch_and_import_services_extension_module(model_name)
     except KeyError:  # pragma: no cover
         message, status = f"Model `{model_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
-    # delete the directory in which the model and fits are stored
-    httpstan.cache.delete_model_directory(model_name)
+    # delete the model and fits, wherever they are stored
+    await loop.run_in_executor(None, httpstan.cache.delete_model, model_name)
+    httpstan.models.evict_services_extension_module(model_name)
 
     return aiohttp.web.Response(text="OK")
 
 
+async def handle_create_dataset(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Store a data set.
+
+    ---
+    post:
+      summary: Store a data set, for use in later requests.
+      description: >-
+        Store data for a Stan model, to be referred to by its ID (the last
+        part of its name) as ``data_id`` in requests which take data. Data
+        sets are identified by their contents: storing the same data twice
+        gives the same data set. Data may be sent as JSON or, for large data,
+        as arrays in NumPy ``.npy`` format in a multipart body.
+      consumes:
+        - application/json
+        - multipart/form-data
+      produces:
+        - application/json
+      parameters:
+        - name: body
+          in: body
+          description: Data for a Stan model.
+          required: true
+          schema: CreateDatasetRequest
+      responses:
+        "201":
+          description: Stored data set.
+          schema: Dataset
+        "400":
+          description: Error associated with request.
+          schema: Status
+    """
+    args = await _parse_args(schemas.CreateDatasetRequest(), request)
+    try:
+        arrays = httpstan.datasets.to_arrays(args["data"])
+        httpstan.datasets.check_variable_names(arrays)
+    except ValueError as exc:
+        message, status = str(exc), 400
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+    name = httpstan.datasets.calculate_dataset_name(arrays)
+    loop = asyncio.get_running_loop()
+    try:
+        metadata = await loop.run_in_executor(None, httpstan.cache.load_dataset_metadata, name)
+    except KeyError:
+        await loop.run_in_executor(None, httpstan.cache.dump_dataset, arrays, name)
+        metadata = await loop.run_in_executor(None, httpstan.cache.load_dataset_metadata, name)
+    return aiohttp.web.json_response(schemas.Dataset().load({"name": name, **metadata}), status=201)
+
+
+async def handle_get_dataset(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Get the variables in a data set.
+
+    ---
+    get:
+      summary: Get the names, types and shapes of the variables in a data set.
+      produces:
+        - application/json
+      parameters:
+        - name: dataset_id
+          in: path
+          description: ID of data set
+          required: true
+          type: string
+      responses:
+        "200":
+          description: Data set.
+          schema: Dataset
+        "404":
+          description: Data set not found.
+          schema: Status
+    """
+    name = f"datasets/{request.match_info['dataset_id']}"
+    try:
+        metadata = await asyncio.get_running_loop().run_in_executor(None, httpstan.cache.load_dataset_metadata, name)
+    except KeyError:
+        message, status = f"Data set `{name}` not found.", 404
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+    return aiohttp.web.json_response(schemas.Dataset().load({"name": name, **metadata}))
+
+
+async def handle_delete_dataset(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Delete a data set.
+
+    ---
+    delete:
+      summary: Delete a data set.
+      produces:
+        - application/json
+      parameters:
+        - name: dataset_id
+          in: path
+          description: ID of data set
+          required: true
+          type: string
+      responses:
+        "200":
+          description: Data set successfully deleted.
+        "404":
+          description: Data set not found.
+          schema: Status
+    """
+    name = f"datasets/{request.match_info['dataset_id']}"
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, httpstan.cache.delete_dataset, name)
+    except KeyError:
+        message, status = f"Data set `{name}` not found.", 404
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+    return aiohttp.web.Response(text="OK")
+
+
+async def _dataset_error(args: dict) -> Optional[aiohttp.web.Response]:
+    """Check the data set referred to by ``data_id`` in request arguments, if any.
+
+    This function is a coroutine.
+
+    Returns:
+        Error response if the data set is not found or shares a variable with ``data``.
+
+    """
+    if "data_id" not in args:
+        return None
+    name = f"datasets/{args['data_id']}"
+    try:
+        metadata = await asyncio.get_running_loop().run_in_executor(None, httpstan.cache.load_dataset_metadata, name)
+    except KeyError:
+        message, status = f"Data set `{name}` not found.", 404
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+    for variable in metadata["variables"]:
+        if variable["name"] in args["data"]:
+            message, status = f"Variable `{variable['name']}` is in both `data` and data set `{name}`.", 400
+            return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+    return None
+
+
 async def handle_show_params(request: aiohttp.web.Request) -> aiohttp.web.Response:
     """Show parameter names and dimensions.
 
@@ -213,6 +695,7 @@ async def handle_show_params(request: aiohttp.web.Request) -> aiohttp.web.Respon
         ``constrained_param_names``, ``get_param_names`` and ``get_dims``.
       consumes:
         - application/json
+        - multipart/form-data
       produces:
         - application/json
       parameters:
@@ -227,6 +710,13 @@ async def handle_show_params(request: aiohttp.web.Request) -> aiohttp.web.Respon
               Data for Stan Model. Needed to calculate param names and dimensions.
           required: true
           schema: Data
+        - in: body
+          name: data_id
+          description: >-
+              ID of a data set stored with ``POST /v1/datasets``. Its variables are combined with ``data``.
+          required: false
+          schema:
+            type: string
       responses:
         "200":
           description: Parameters for Stan Model
@@ -246,16 +736,25 @@ async def handle_show_params(request: aiohttp.web.Request) -> aiohttp.web.Respon
           schema: Status
 
     """
-    args = cast(dict, await webargs.aiohttpparser.parser.parse(schemas.ShowParamsRequest(), request))
+    args = await _parse_args(schemas.ShowParamsRequest(), request)
     model_name = f'models/{request.match_info["model_id"]}'
     data = args["data"]
 
     try:
-        services_module = httpstan.models.import_services_extension_module(model_name)
+        services_module = await httpstan.models.fetch_and_import_services_extension_module(model_name)
     except KeyError:  # pragma: no cover
         message, status = f"Model `{model_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
+    response = await _dataset_error(args)
+    if response is not None:
+        return response
+    if "data_id" in args:
+        dataset = await asyncio.get_running_loop().run_in_executor(
+            None, httpstan.cache.load_dataset, f"datasets/{args['data_id']}"
+        )
+        data = {**dataset, **data}
+
     # ``get_param_names`` and ``get_dims`` are defined in ``stan_services.cpp``.
     # Apart from converting C++ types into corresponding Python types, they do no processing of the
     # output of ``get_param_names`` and ``get_dims``.
@@ -309,8 +808,22 @@ async def handle_create_fit(request: aiohttp.web.Request) -> aiohttp.web.Respons
         and the parameter ``num_samples`` is not specified, the value 1000 will
         be used. For a full list of default values consult the CmdStan
         documentation.
+
+        If ``num_chains`` is provided, that many chains run in parallel
+        under a single operation. Chains share ``random_seed`` and have
+        consecutive chain ids starting from ``chain``. Each chain produces
+        its own fit. The names of the fits are listed under ``fits`` in the
+        operation metadata, which also records the progress of each chain.
+
+        Calls wait for a free worker process. Waiting calls from different
+        clients are started in turn. The operation metadata records the
+        number of calls waiting when the request was made (``queue_depth``)
+        and, once the call has started, the seconds spent waiting
+        (``queue_wait``). If too many calls are waiting, the request is
+        rejected with status 503 and a ``Retry-After`` header.
       consumes:
         - application/json
+        - multipart/form-data
       produces:
         - application/json
       parameters:
@@ -335,20 +848,37 @@ async def handle_create_fit(request: aiohttp.web.Request) -> aiohttp.web.Respons
         "404":
           description: Fit not found.
           schema: Status
+        "503":
+          description: Too many fits are waiting to run. See the ``Retry-After`` header.
+          schema: Status
     """
     model_name = f'models/{request.match_info["model_id"]}'
-    args = cast(dict, await webargs.aiohttpparser.parser.parse(schemas.CreateFitRequest(), request))
+    args = await _parse_args(schemas.CreateFitRequest(), request)
 
     try:
-        httpstan.models.import_services_extension_module(model_name)
+        await httpstan.models.fetch_and_import_services_extension_module(model_name)
     except KeyError:  # pragma: no cover
         message, status = f"Model `{model_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
+    response = await _dataset_error(args)
+    if response is not None:
+        return response
+    try:
+        # data are converted into arrays once, here, and used both to calculate the fit name and to run the fit
+        args["data"] = httpstan.datasets.to_arrays(args["data"])
+        args["init"] = httpstan.datasets.to_arrays(args["init"])
+    except ValueError as exc:
+        message, status = str(exc), 400
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+
     function = args.pop("function")
+    num_chains = args.pop("num_chains", None)
+    if num_chains is not None:
+        return await _create_multi_chain_fit(request, function, model_name, num_chains, args)
     name = httpstan.fits.calculate_fit_name(function, model_name, args)
     try:
-        httpstan.cache.load_fit(name)
+        await asyncio.get_running_loop().run_in_executor(None, httpstan.cache.load_fit_metadata, name)
     except KeyError:
         pass
     else:
@@ -362,23 +892,121 @@ async def handle_create_fit(request: aiohttp.web.Request) -> aiohttp.web.Respons
                 "result": schemas.Fit().load({"name": name}),
             }
         )
-        request.app["operations"][operation_name] = operation_dict
+        _add_operation(request.app, operation_dict)
         return aiohttp.web.json_response(operation_dict, status=201)
 
-    def _services_call_done(operation: dict, future: asyncio.Future) -> None:
-        """Called when services call (i.e., an operation) is done.
+    scheduler = request.app["fit_scheduler"]
+    if not scheduler.can_admit():
+        return _queue_full_response(scheduler)
+
+    operation_name = f'operations/{name.split("/")[-1]}'
+    operation_dict = schemas.Operation().load(
+        {
+            "name": operation_name,
+            "done": False,
+            "metadata": {"fit": schemas.Fit().load({"name": name}), "queue_depth": scheduler.queue_depth},
+        }
+    )
+    if "data_id" in args:
+        # keeps the data set from being evicted from the cache while the operation runs
+        operation_dict["metadata"]["dataset"] = {"name": f"datasets/{args['data_id']}"}
+
+    # Launch the call to the services function in the background. Wire things up
+    # such that the operation gets updated when the task finishes. Note that
+    # if a task is cancelled before finishing a warning will be issued (see
+    # `on_cleanup` signal handler in main.py).
+    logger_callback_partial = functools.partial(_logger_callback, operation_dict["metadata"], None)
+    message_queues: List[asyncio.Queue] = []
+    task = asyncio.create_task(
+        _scheduled_call(
+            scheduler,
+            request.remote or "",
+            operation_dict["metadata"],
+            function,
+            model_name,
+            operation_dict["metadata"]["fit"]["name"],
+            logger_callback_partial,
+            message_queues,
+            **args,
+        )
+    )
+    task.add_done_callback(functools.partial(_services_call_done, operation_dict))
+    task.add_done_callback(lambda _: request.app["operation_message_queues"].pop(operation_name, None))
+    task.add_done_callback(lambda _: request.app["operation_tasks"].pop(operation_name, None))
+    _add_operation(request.app, operation_dict)
+    request.app["operation_message_queues"][operation_name] = message_queues
+    request.app["operation_tasks"][operation_name] = task
+    return aiohttp.web.json_response(operation_dict, status=201)
+
+
+def _add_operation(app: aiohttp.web.Application, operation: dict) -> None:
+    """Record an operation, forgetting the oldest finished operations if there are too many."""
+    operations = app["operations"]
+    operations.pop(operation["name"], None)
+    operations[operation["name"]] = operation
+    if len(operations) <= HTTPSTAN_MAX_OPERATIONS:
+        return
+    for name in [name for name, other in operations.items() if other["done"]]:
+        del operations[name]
+        if len(operations) <= HTTPSTAN_MAX_OPERATIONS:
+            return
+
+
+def _queue_full_response(scheduler: httpstan.scheduler.FitScheduler) -> aiohttp.web.Response:
+    message, status = "Too many fits are waiting to run. Try again later.", 503
+    headers = {"Retry-After": str(scheduler.retry_after())}
+    return aiohttp.web.json_response(_make_error(message, status=status), status=status, headers=headers)
+
+
+async def _scheduled_call(
+    scheduler: httpstan.scheduler.FitScheduler, client: str, metadata: dict, *args: Any, **kwargs: Any
+) -> None:
+    """Wait for a worker, then call a stan::services function with `services_stub.call`.
 
-        This needs to handle both successful and exception-raising calls.
+    The time spent waiting is recorded in the operation metadata. If an
+    operation runs several chains, the longest wait is recorded.
 
-        Arguments:
-            operation: Operation dict
-            future: Finished future
+    """
+    async with scheduler.slot(client) as queue_wait:
+        metadata["queue_wait"] = max(metadata.get("queue_wait", 0.0), queue_wait)
+        await services_stub.call(*args, **kwargs)
+
+
+def _logger_callback(metadata: dict, chain_index: Optional[int], message: bytes) -> None:
+    """Record sampling progress in operation metadata.
+
+    Arguments:
+        metadata: Operation metadata
+        chain_index: Position of the chain in ``metadata["progress"]``, ``None`` if the operation runs one chain
+        message: Logger message
+
+    """
+    if b"info:Iteration" not in message:
+        return
+    # When sampling completes rapidly, multiple iteration messages can be passed together. Use final one.
+    progress = iteration_info_re.findall(message).pop().decode()
+    if chain_index is None:
+        metadata["progress"] = progress
+    else:
+        metadata["progress"][chain_index] = progress
 
-        """
-        # either the call succeeded or it raised an exception.
-        operation["done"] = True
 
-        exc = future.exception()
+def _services_call_done(operation: dict, future: asyncio.Future) -> None:
+    """Called when services call (i.e., an operation) is done.
+
+    This needs to handle successful, exception-raising and cancelled calls.
+
+    Arguments:
+        operation: Operation dict
+        future: Finished future
+
+    """
+    # either the call succeeded, raised an exception or was cancelled.
+    operation["done"] = True
+
+    fits = operation["metadata"].get("fits", [operation["metadata"].get("fit")])
+    exc = None if future.cancelled() else future.exception()
+    if future.cancelled() or exc:
         if exc:
             # e.g., "hmc_nuts_diag_e_adapt_wrapper() got an unexpected keyword argument, ..."
             # e.g., dimension errors in variable declarations
@@ -388,44 +1016,123 @@ async def handle_create_fit(request: aiohttp.web.Request) -> aiohttp.web.Respons
                 400,
             )
             logger.critical(message)
-            operation["result"] = _make_error(message, status=status)
-            # Delete messages associated with the fit. If initialization
-            # fails, for example, messages will exist on disk. Remove them.
-            try:
-                httpstan.cache.delete_fit(operation["metadata"]["fit"]["name"])
-            except KeyError:
-                pass
         else:
-            logger.info(f"Operation `{operation['name']}` finished.")
+            message, status = f"Operation `{operation['name']}` cancelled.", 400
+            logger.info(message)
+        operation["result"] = _make_error(message, status=status)
+        # Delete messages associated with the fit. If initialization
+        # fails, for example, messages will exist on disk. Remove them,
+        # in a different thread, as deleting may take a while.
+        asyncio.get_running_loop().run_in_executor(None, _delete_fits, [fit["name"] for fit in fits])
+    else:
+        logger.info(f"Operation `{operation['name']}` finished.")
+        if "fits" in operation["metadata"]:
+            operation["result"] = {"fits": schemas.Fit(many=True).load(fits)}
+        else:
             operation["result"] = schemas.Fit().load(operation["metadata"]["fit"])
 
-    operation_name = f'operations/{name.split("/")[-1]}'
-    operation_dict = schemas.Operation().load(
-        {"name": operation_name, "done": False, "metadata": {"fit": schemas.Fit().load({"name": name})}}
-    )
 
-    # Launch the call to the services function in the background. Wire things up
-    # such that the operation gets updated when the task finishes. Note that
-    # if a task is cancelled before finishing a warning will be issued (see
-    # `on_cleanup` signal handler in main.py).
-    def logger_callback(operation: dict, message: bytes) -> None:
-        if b"info:Iteration" not in message:
-            return
-        # When sampling completes rapidly, multiple iteration messages can be passed together. Use final one.
-        operation["metadata"]["progress"] = iteration_info_re.findall(message).pop().decode()
+def _delete_fits(names: List[str]) -> None:
+    """Delete fits, if they exist."""
+    for name in names:
+        try:
+            httpstan.cache.delete_fit(name)
+        except KeyError:
+            pass
 
-    logger_callback_partial = functools.partial(logger_callback, operation_dict)
-    task = asyncio.create_task(
-        services_stub.call(
-            function, model_name, operation_dict["metadata"]["fit"]["name"], logger_callback_partial, **args
+
+async def _create_multi_chain_fit(
+    request: aiohttp.web.Request, function: str, model_name: str, num_chains: int, args: dict
+) -> aiohttp.web.Response:
+    """Start an operation which runs `num_chains` chains in parallel.
+
+    Each chain produces its own fit. Chains share the random seed and have
+    consecutive chain ids, starting from ``chain``. The operation is done when
+    every chain has finished.
+
+    """
+    first_chain = args.get("chain", 1)
+    chains_args = [{**args, "chain": first_chain + i} for i in range(num_chains)]
+    names = [httpstan.fits.calculate_fit_name(function, model_name, chain_args) for chain_args in chains_args]
+    name = httpstan.fits.calculate_fit_name(function, model_name, {**args, "num_chains": num_chains})
+    operation_name = f'operations/{name.split("/")[-1]}'
+    fits = schemas.Fit(many=True).load([{"name": name} for name in names])
+
+    try:
+        for name in names:
+            await asyncio.get_running_loop().run_in_executor(None, httpstan.cache.load_fit_metadata, name)
+    except KeyError:
+        pass
+    else:
+        # cache hit, every chain has been run before
+        operation_dict = schemas.Operation().load(
+            {"name": operation_name, "done": True, "metadata": {"fits": fits}, "result": {"fits": fits}}
         )
+        _add_operation(request.app, operation_dict)
+        return aiohttp.web.json_response(operation_dict, status=201)
+
+    scheduler = request.app["fit_scheduler"]
+    if not scheduler.can_admit(num_chains):
+        return _queue_full_response(scheduler)
+
+    if "random_seed" not in args:
+        # Chains must share a seed. The chain id selects each chain's stream of random numbers.
+        random_seed = random.getrandbits(31)
+        for chain_args in chains_args:
+            chain_args["random_seed"] = random_seed
+
+    operation_dict = schemas.Operation().load(
+        {
+            "name": operation_name,
+            "done": False,
+            "metadata": {"fits": fits, "progress": [None] * num_chains, "queue_depth": scheduler.queue_depth},
+        }
     )
+    if "data_id" in args:
+        operation_dict["metadata"]["dataset"] = {"name": f"datasets/{args['data_id']}"}
+
+    async def call_chains() -> None:
+        """Run all chains, raising the first exception once every chain has finished."""
+        # large arrays in data and inits are written to files once, shared by every chain
+        async with services_stub.shared_arrays(chains_args[0]):
+            shared_args = {
+                key: chains_args[0][key] for key in ("data", "init", "array_paths") if key in chains_args[0]
+            }
+            for chain_args in chains_args[1:]:
+                chain_args.update(shared_args)
+            results = await asyncio.gather(
+                *(
+                    _scheduled_call(
+                        scheduler,
+                        request.remote or "",
+                        operation_dict["metadata"],
+                        function,
+                        model_name,
+                        name,
+                        functools.partial(_logger_callback, operation_dict["metadata"], chain_index),
+                        message_queues,
+                        **chain_args,
+                    )
+                    for chain_index, (name, chain_args) in enumerate(zip(names, chains_args))
+                ),
+                return_exceptions=True,
+            )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    message_queues: List[asyncio.Queue] = []
+    task = asyncio.create_task(call_chains())
     task.add_done_callback(functools.partial(_services_call_done, operation_dict))
-    request.app["operations"][operation_name] = operation_dict
+    task.add_done_callback(lambda _: request.app["operation_message_queues"].pop(operation_name, None))
+    task.add_done_callback(lambda _: request.app["operation_tasks"].pop(operation_name, None))
+    _add_operation(request.app, operation_dict)
+    request.app["operation_message_queues"][operation_name] = message_queues
+    request.app["operation_tasks"][operation_name] = task
     return aiohttp.web.json_response(operation_dict, status=201)
 
 
-async def handle_get_fit(request: aiohttp.web.Request) -> aiohttp.web.Response:
+async def handle_get_fit(request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
     """Get result of a call to a function defined in stan::services.
 
     ---
@@ -436,6 +1143,7 @@ async def handle_get_fit(request: aiohttp.web.Request) -> aiohttp.web.Response:
         - application/json
       produces:
         - text/plain
+        - application/x-npz
       parameters:
         - name: model_id
           in: path
@@ -447,9 +1155,27 @@ async def handle_get_fit(request: aiohttp.web.Request) -> aiohttp.web.Response:
           description: ID of Stan result ("fit") desired
           required: true
           type: string
+        - name: Accept
+          in: header
+          description: >-
+            If ``application/x-npz``, return only the draws as a NumPy ``.npz``
+            archive. The archive holds two arrays, ``names`` (parameter names)
+            and ``draws`` (float64, one row per draw, stored in column-major
+            order).
+          required: false
+          type: string
+        - name: Accept-Encoding
+          in: header
+          description: >-
+            If ``gzip`` is accepted and the fit is stored gzip-compressed,
+            messages are sent as stored, with ``Content-Encoding: gzip``.
+          required: false
+          type: string
       responses:
         "200":
-          description: Newline-delimited JSON-encoded messages from Stan. Includes draws.
+          description: >-
+            Newline-delimited JSON-encoded messages from Stan. Includes draws.
+            Draws only if ``application/x-npz`` is requested.
         "404":
           description: Fit not found.
           schema: Status
@@ -457,14 +1183,46 @@ async def handle_get_fit(request: aiohttp.web.Request) -> aiohttp.web.Response:
     model_name = f"models/{request.match_info['model_id']}"
     fit_name = f"{model_name}/fits/{request.match_info['fit_id']}"
 
+    # The checksum of the fit is checked as the fit is read, rather than before. A corrupt fit
+    # is deleted, and the response ends without being completed.
+    loop = asyncio.get_running_loop()
     try:
-        fit_bytes_gz = httpstan.cache.load_fit(fit_name)
+        # opening the fit reads its metadata from the storage backend
+        fit_stream = await loop.run_in_executor(None, httpstan.cache.open_fit_stream, fit_name)
     except KeyError:  # pragma: no cover
         message, status = f"Fit `{fit_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
-    fit_bytes = gzip.decompress(fit_bytes_gz)
-    assert isinstance(fit_bytes, bytes)
-    return aiohttp.web.Response(body=fit_bytes, content_type="text/plain", charset="utf-8")
+
+    with fit_stream:
+        if _accepts(request, "application/x-npz"):
+            # extracting draws takes a while for large fits. Do not block the event loop.
+            try:
+                npz_bytes = await loop.run_in_executor(None, _draws_npz, fit_stream)
+            except KeyError:
+                message, status = f"Fit `{fit_name}` not found.", 404
+                return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+            return aiohttp.web.Response(body=npz_bytes, content_type="application/x-npz")
+
+        # Stream the fit in chunks so memory use does not grow with the size of the fit.
+        # Fits are usually stored gzip-compressed. Send the stored bytes as-is if the client accepts gzip.
+        response = aiohttp.web.StreamResponse()
+        response.content_type, response.charset = "text/plain", "utf-8"
+        source: BinaryIO
+        if fit_stream.metadata["format"] == "jsonlines" and _accepts(request, "gzip", header="Accept-Encoding"):
+            response.headers["Content-Encoding"] = "gzip"
+            response.content_length = fit_stream.metadata["length"]
+            source = cast(BinaryIO, fit_stream)
+        else:
+            try:
+                source = await loop.run_in_executor(None, _open_messages, fit_stream)
+            except KeyError:
+                message, status = f"Fit `{fit_name}` not found.", 404
+                return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+        await response.prepare(request)
+        async for chunk in _read_ahead(functools.partial(source.read, FIT_CHUNK_SIZE)):
+            await response.write(chunk)
+        await response.write_eof()
+    return response
 
 
 async def handle_delete_fit(request: aiohttp.web.Request) -> aiohttp.web.Response:
@@ -499,13 +1257,14 @@ async def handle_delete_fit(request: aiohttp.web.Request) -> aiohttp.web.Respons
     model_name = f"models/{request.match_info['model_id']}"
     fit_name = f"{model_name}/fits/{request.match_info['fit_id']}"
 
+    loop = asyncio.get_running_loop()
     try:
-        httpstan.cache.load_fit(fit_name)
+        await loop.run_in_executor(None, httpstan.cache.load_fit_metadata, fit_name)
     except KeyError:  # pragma: no cover
         message, status = f"Fit `{fit_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
-    httpstan.cache.delete_fit(fit_name)
+    await loop.run_in_executor(None, httpstan.cache.delete_fit, fit_name)
 
     return aiohttp.web.Response(text="OK")
 
@@ -566,6 +1325,153 @@ async def handle_get_operation(request: aiohttp.web.Request) -> aiohttp.web.Resp
     return aiohttp.web.json_response(operation)
 
 
+async def handle_delete_operation(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Delete an Operation, cancelling it if it is running.
+
+    ---
+    delete:
+      summary: Delete an Operation, cancelling it if it is running.
+      description: >-
+        Forget an Operation. If the Operation is not done, it is cancelled:
+        the call to the stan::services function is stopped and the messages
+        it produced are discarded. The response is sent once the worker
+        process running the function is free.
+
+        Fits saved by an Operation which is done are not deleted.
+      produces:
+        - application/json
+      parameters:
+        - name: operation_id
+          in: path
+          description: ID of Operation
+          required: true
+          type: string
+      responses:
+        "200":
+          description: Operation successfully deleted.
+        "404":
+          description: Operation not found.
+          schema: Status
+    """
+    operation_name = f"operations/{request.match_info['operation_id']}"
+    if operation_name not in request.app["operations"]:
+        message, status = f"Operation `{operation_name}` not found.", 404
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+
+    task = request.app["operation_tasks"].get(operation_name)
+    if task is not None:
+        task.cancel()
+        await asyncio.wait([task])
+    request.app["operations"].pop(operation_name, None)
+    return aiohttp.web.Response(text="OK")
+
+
+async def handle_get_operation_messages(request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+    """Stream messages from an Operation.
+
+    Messages (draws, logger messages) are sent as server-sent events as the
+    operation produces them. Each event carries one JSON-encoded message in its
+    ``data`` field. The stream ends when the operation is done. If the
+    operation is already done, the messages saved in the fit are sent.
+
+    A client which reads messages slowly delays the reading of messages from
+    Stan, which in turn slows the running operation.
+
+    ---
+    get:
+      summary: Stream messages from an Operation.
+      description: >-
+        Send messages produced by a running Operation as server-sent events.
+        Each event's ``data`` is a JSON-encoded message. The stream ends when
+        the Operation is done. A client which stops reading messages while the
+        Operation runs receives an ``error`` event, with a Status, in place of
+        further messages, and the stream ends.
+      produces:
+        - text/event-stream
+      parameters:
+        - name: operation_id
+          in: path
+          description: ID of Operation
+          required: true
+          type: string
+      responses:
+        "200":
+          description: Stream of server-sent events, one per message.
+        "404":
+          description: Operation not found.
+          schema: Status
+    """
+    operation_name = f"operations/{request.match_info['operation_id']}"
+    try:
+        operation = request.app["operations"][operation_name]
+    except KeyError:
+        message, status = f"Operation `{operation_name}` not found.", 404
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+
+    message_queues = request.app["operation_message_queues"].get(operation_name)
+    fit_streams = []
+    if message_queues is None:
+        # operation is done, send messages from the fit(s), checked as they are read (see `handle_get_fit`)
+        try:
+            fits = operation["result"].get("fits", [operation["result"]])
+            for fit in fits:
+                fit_streams.append(
+                    await asyncio.get_running_loop().run_in_executor(None, httpstan.cache.open_fit_stream, fit["name"])
+                )
+        except KeyError:
+            for fit_stream in fit_streams:
+                fit_stream.close()
+            message, status = f"No messages found for operation `{operation_name}`.", 404
+            return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+
+    response = aiohttp.web.StreamResponse(headers={"Cache-Control": "no-cache"})
+    response.content_type = "text/event-stream"
+    await response.prepare(request)
+
+    if message_queues is None:
+        loop = asyncio.get_running_loop()
+        for fit_stream in fit_streams:
+            with fit_stream, await loop.run_in_executor(None, _open_messages, fit_stream) as lines:
+                async for line in _read_ahead(lines.readline):
+                    await response.write(b"data: " + line.rstrip(b"\n") + b"\n\n")
+        await response.write_eof()
+        return response
+
+    # each chain puts `None` after its final message
+    num_running_chains = len(operation["metadata"].get("fits", [None]))
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=OPERATION_MESSAGES_QUEUE_SIZE)
+    message_queues.append(queue)
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(queue.get(), timeout=1)
+            except asyncio.TimeoutError:
+                # guard against missing the end of the operation
+                if operation["done"] and queue.empty():
+                    break
+                continue
+            if line is None:
+                num_running_chains -= 1
+                if not num_running_chains:
+                    break
+                continue
+            if line is services_stub.MESSAGE_QUEUE_DROPPED:
+                # messages were not read quickly enough. The operation continues without this stream.
+                message = "Messages were not read quickly enough. Stream ended before the operation finished."
+                error = json.dumps(_make_error(message, status=429))
+                await response.write(b"event: error\ndata: " + error.encode() + b"\n\n")
+                break
+            await response.write(b"data: " + line + b"\n\n")
+    finally:
+        message_queues.remove(queue)
+        # unblock a pending `put` by the operation
+        while not queue.empty():
+            queue.get_nowait()
+    await response.write_eof()
+    return response
+
+
 async def handle_log_prob(request: aiohttp.web.Request) -> aiohttp.web.Response:
     """Calculate the log probability.
 
@@ -576,6 +1482,7 @@ async def handle_log_prob(request: aiohttp.web.Request) -> aiohttp.web.Response:
         Returns the output of Stan C++ ``log_prob`` model class method.
       consumes:
         - application/json
+        - multipart/form-data
       produces:
         - application/json
       parameters:
@@ -590,6 +1497,13 @@ async def handle_log_prob(request: aiohttp.web.Request) -> aiohttp.web.Response:
               Data for the Stan Model.
           required: true
           schema: Data
+        - in: body
+          name: data_id
+          description: >-
+              ID of a data set stored with ``POST /v1/datasets``. Its variables are combined with ``data``.
+          required: false
+          schema:
+            type: string
         - in: body
           name: unconstrained_parameters
           description: >-
@@ -621,20 +1535,25 @@ async def handle_log_prob(request: aiohttp.web.Request) -> aiohttp.web.Response:
           description: Model not found.
           schema: Status
     """
-    args = cast(dict, await webargs.aiohttpparser.parser.parse(schemas.ShowLogProbRequest(), request))
+    args = await _parse_args(schemas.ShowLogProbRequest(), request)
     model_name = f'models/{request.match_info["model_id"]}'
     data = args["data"]
     unconstrained_parameters = args["unconstrained_parameters"]
     adjust_transform = args["adjust_transform"]
 
     try:
-        services_module = httpstan.models.import_services_extension_module(model_name)
+        await httpstan.models.fetch_and_import_services_extension_module(model_name)
     except KeyError:
         message, status = f"Model `{model_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
+    response = await _dataset_error(args)
+    if response is not None:
+        return response
+
     try:
-        lp = services_module.log_prob(data, unconstrained_parameters, adjust_transform)  # type: ignore
+        model = await httpstan.models.get_model_instance(model_name, data, args.get("data_id"))
+        lp = model.log_prob(unconstrained_parameters, adjust_transform)
     except Exception as exc:
         message, status = f"Error calling log_prob: `{exc}`", 400
         logger.critical(message)
@@ -652,6 +1571,7 @@ async def handle_log_prob_grad(request: aiohttp.web.Request) -> aiohttp.web.Resp
         Returns the output of Stan C++ `stan::model::log_prob_grad`.
       consumes:
         - application/json
+        - multipart/form-data
       produces:
         - application/json
       parameters:
@@ -666,6 +1586,13 @@ async def handle_log_prob_grad(request: aiohttp.web.Request) -> aiohttp.web.Resp
               Data for the Stan Model.
           required: true
           schema: Data
+        - in: body
+          name: data_id
+          description: >-
+              ID of a data set stored with ``POST /v1/datasets``. Its variables are combined with ``data``.
+          required: false
+          schema:
+            type: string
         - in: body
           name: unconstrained_parameters
           description: >-
@@ -699,20 +1626,25 @@ async def handle_log_prob_grad(request: aiohttp.web.Request) -> aiohttp.web.Resp
           description: Model not found.
           schema: Status
     """
-    args = cast(dict, await webargs.aiohttpparser.parser.parse(schemas.ShowLogProbGradRequest(), request))
+    args = await _parse_args(schemas.ShowLogProbGradRequest(), request)
     model_name = f'models/{request.match_info["model_id"]}'
     data = args["data"]
     unconstrained_parameters = args["unconstrained_parameters"]
     adjust_transform = args["adjust_transform"]
 
     try:
-        services_module = httpstan.models.import_services_extension_module(model_name)
+        await httpstan.models.fetch_and_import_services_extension_module(model_name)
     except KeyError:
         message, status = f"Model `{model_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
+    response = await _dataset_error(args)
+    if response is not None:
+        return response
+
     try:
-        gradient = services_module.log_prob_grad(data, unconstrained_parameters, adjust_transform)  # type: ignore
+        model = await httpstan.models.get_model_instance(model_name, data, args.get("data_id"))
+        gradient = model.log_prob_grad(unconstrained_parameters, adjust_transform)
     except Exception as exc:
         message, status = f"Error calling log_prob_grad: `{exc}`", 400
         logger.critical(message)
@@ -720,6 +1652,109 @@ async def handle_log_prob_grad(request: aiohttp.web.Request) -> aiohttp.web.Resp
     return aiohttp.web.json_response({"log_prob_grad": gradient}, status=200)
 
 
+async def handle_log_prob_grad_batch(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    """Calculate the log posterior and its gradient for several sets of unconstrained parameters.
+
+    ---
+    post:
+      summary: Return log posteriors and gradients evaluated at many points.
+      description: >-
+        Returns the output of Stan C++ `stan::model::log_prob_grad` for each row
+        of ``unconstrained_parameters``. Rows are evaluated in parallel using a
+        single instance of the model.
+      consumes:
+        - application/json
+        - multipart/form-data
+      produces:
+        - application/json
+      parameters:
+        - name: model_id
+          in: path
+          description: ID of Stan model to use
+          required: true
+          type: string
+        - in: body
+          name: data
+          description: >-
+              Data for the Stan Model.
+          required: true
+          schema: Data
+        - in: body
+          name: data_id
+          description: >-
+              ID of a data set stored with ``POST /v1/datasets``. Its variables are combined with ``data``.
+          required: false
+          schema:
+            type: string
+        - in: body
+          name: unconstrained_parameters
+          description: >-
+              Sequence of sets of unconstrained parameters (an N x D matrix).
+          required: true
+          schema:
+            type: array
+            items:
+              type: array
+              items:
+                type: number
+        - in: body
+          name: adjust_transform
+          description: >-
+              Boolean to control whether we apply a Jacobian adjust transform.
+          required: false
+          schema:
+            type: boolean
+      responses:
+        "200":
+          description: Log posteriors and gradients evaluated at each set of unconstrained parameters.
+          schema:
+            type: object
+            properties:
+              log_prob:
+                type: array
+                items:
+                  type: number
+              log_prob_grad:
+                type: array
+                items:
+                  type: array
+                  items:
+                    type: number
+        "400":
+          description: Error associated with request.
+          schema: Status
+        "404":
+          description: Model not found.
+          schema: Status
+    """
+    args = await _parse_args(schemas.ShowLogProbGradBatchRequest(), request)
+    model_name = f'models/{request.match_info["model_id"]}'
+    data = args["data"]
+    unconstrained_parameters = args["unconstrained_parameters"]
+    adjust_transform = args["adjust_transform"]
+
+    try:
+        await httpstan.models.fetch_and_import_services_extension_module(model_name)
+    except KeyError:
+        message, status = f"Model `{model_name}` not found.", 404
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+
+    response = await _dataset_error(args)
+    if response is not None:
+        return response
+
+    try:
+        model = await httpstan.models.get_model_instance(model_name, data, args.get("data_id"))
+        # gradients are evaluated by several threads which do not hold the GIL. Do not block the event loop.
+        log_prob_grad_batch = functools.partial(model.log_prob_grad_batch, unconstrained_parameters, adjust_transform)
+        lps, gradients = await asyncio.get_running_loop().run_in_executor(None, log_prob_grad_batch)
+    except Exception as exc:
+        message, status = f"Error calling log_prob_grad_batch: `{exc}`", 400
+        logger.critical(message)
+        return aiohttp.web.json_response(_make_error(message, status=status), status=status)
+    return aiohttp.web.json_response({"log_prob": lps, "log_prob_grad": gradients}, status=200)
+
+
 async def handle_write_array(request: aiohttp.web.Request) -> aiohttp.web.Response:
     """Constrain parameters.
 
@@ -736,6 +1771,7 @@ async def handle_write_array(request: aiohttp.web.Request) -> aiohttp.web.Respon
         Returns the output of Stan C++ ``write_array`` model class method.
       consumes:
         - application/json
+        - multipart/form-data
       produces:
         - application/json
       parameters:
@@ -750,6 +1786,13 @@ async def handle_write_array(request: aiohttp.web.Request) -> aiohttp.web.Respon
               Data for the Stan Model.
           required: true
           schema: Data
+        - in: body
+          name: data_id
+          description: >-
+              ID of a data set stored with ``POST /v1/datasets``. Its variables are combined with ``data``.
+          required: false
+          schema:
+            type: string
         - in: body
           name: unconstrained_parameters
           description: >-
@@ -792,7 +1835,7 @@ async def handle_write_array(request: aiohttp.web.Request) -> aiohttp.web.Respon
           description: Model not found.
           schema: Status
     """
-    args = cast(dict, await webargs.aiohttpparser.parser.parse(schemas.ShowWriteArrayRequest(), request))
+    args = await _parse_args(schemas.ShowWriteArrayRequest(), request)
     model_name = f'models/{request.match_info["model_id"]}'
     data = args["data"]
     unconstrained_parameters = args["unconstrained_parameters"]
@@ -800,13 +1843,18 @@ async def handle_write_array(request: aiohttp.web.Request) -> aiohttp.web.Respon
     include_gqs = args["include_gqs"]
 
     try:
-        services_module = httpstan.models.import_services_extension_module(model_name)
+        await httpstan.models.fetch_and_import_services_extension_module(model_name)
     except KeyError:
         message, status = f"Model `{model_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
+    response = await _dataset_error(args)
+    if response is not None:
+        return response
+
     try:
-        params_r_constrained = services_module.write_array(data, unconstrained_parameters, include_tparams, include_gqs)  # type: ignore
+        model = await httpstan.models.get_model_instance(model_name, data, args.get("data_id"))
+        params_r_constrained = model.write_array(unconstrained_parameters, include_tparams, include_gqs)
     except Exception as exc:
         message, status = f"Error calling write_array: `{exc}`", 400
         logger.critical(message)
@@ -830,6 +1878,7 @@ async def handle_transform_inits(request: aiohttp.web.Request) -> aiohttp.web.Re
         Returns the output of Stan C++ ``transform_inits`` model class method.
       consumes:
         - application/json
+        - multipart/form-data
       produces:
         - application/json
       parameters:
@@ -844,6 +1893,13 @@ async def handle_transform_inits(request: aiohttp.web.Request) -> aiohttp.web.Re
               Data for the Stan Model.
           required: true
           schema: Data
+        - in: body
+          name: data_id
+          description: >-
+              ID of a data set stored with ``POST /v1/datasets``. Its variables are combined with ``data``.
+          required: false
+          schema:
+            type: string
         - in: body
           name: constrained_parameters
           description: >-
@@ -868,19 +1924,24 @@ async def handle_transform_inits(request: aiohttp.web.Request) -> aiohttp.web.Re
           description: Model not found.
           schema: Status
     """
-    args = cast(dict, await webargs.aiohttpparser.parser.parse(schemas.ShowTransformInitsRequest(), request))
+    args = await _parse_args(schemas.ShowTransformInitsRequest(), request)
     model_name = f'models/{request.match_info["model_id"]}'
     data = args["data"]
     constrained_parameters = args["constrained_parameters"]
 
     try:
-        services_module = httpstan.models.import_services_extension_module(model_name)
+        await httpstan.models.fetch_and_import_services_extension_module(model_name)
     except KeyError:
         message, status = f"Model `{model_name}` not found.", 404
         return aiohttp.web.json_response(_make_error(message, status=status), status=status)
 
+    response = await _dataset_error(args)
+    if response is not None:
+        return response
+
     try:
-        params_r_unconstrained = services_module.transform_inits(data, constrained_parameters)  # type: ignore
+        model = await httpstan.models.get_model_instance(model_name, data, args.get("data_id"))
+        params_r_unconstrained = model.transform_inits(constrained_parameters)
     except Exception as exc:
         message, status = f"Error calling write_array: `{exc}`", 400
         logger.critical(message)
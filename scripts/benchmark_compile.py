@@ -0,0 +1,63 @@
+"""Compare cold model compile times with and without the precompiled header.
+
+Each compile runs in a new process with an empty cache directory. The
+precompiled header, built by the first compile which uses it, is shared by
+compiles with the precompiled header.
+"""
+
+import argparse
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+program_code = """
+data {
+  int<lower=0> N;
+  array[N] int<lower=0, upper=1> y;
+}
+parameters {
+  real<lower=0, upper=1> theta;
+}
+model {
+  theta ~ beta(1, 1);
+  y ~ bernoulli(theta);
+}
+"""
+
+build_script = """
+import asyncio, sys
+import httpstan.models
+asyncio.run(httpstan.models.build_services_extension_module(sys.stdin.read()))
+"""
+
+parser = argparse.ArgumentParser(description="Compare cold model compile times with and without precompiled header.")
+parser.add_argument("--repeat", type=int, default=3, help="Number of compiles in each configuration.")
+
+
+def compile_time(precompiled_header: bool, precompiled_header_directory: pathlib.Path) -> float:
+    """Compile the model in a new process with an empty cache, returning seconds elapsed."""
+    with tempfile.TemporaryDirectory() as cache_home:
+        (pathlib.Path(cache_home) / "httpstan").mkdir()
+        (pathlib.Path(cache_home) / "httpstan" / "precompiled").symlink_to(precompiled_header_directory)
+        env = dict(os.environ, XDG_CACHE_HOME=cache_home, HTTPSTAN_PRECOMPILED_HEADER=str(int(precompiled_header)))
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", build_script], input=program_code, text=True, env=env, check=True)
+        return time.perf_counter() - start
+
+
+def main(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as precompiled_header_directory:
+        directory = pathlib.Path(precompiled_header_directory)
+        print(f"first compile, precompiling header: {compile_time(True, directory):.1f} s")
+        for precompiled_header in (False, True):
+            times = [compile_time(precompiled_header, directory) for _ in range(args.repeat)]
+            label = "with" if precompiled_header else "without"
+            print(f"{label} precompiled header: median {statistics.median(times):.1f} s, min {min(times):.1f} s")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
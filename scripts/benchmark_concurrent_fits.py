@@ -0,0 +1,103 @@
+"""Measure request latency while many fits are running.
+
+Start an httpstan server in-process, launch concurrent fits and poll the
+health endpoint throughout. Long latencies indicate the event loop is being
+blocked by the work done while collecting messages from running fits.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+import typing
+
+import aiohttp
+import aiohttp.web
+
+import httpstan.app
+
+program_code = """
+parameters {
+  vector[10] z;
+}
+model {
+  z ~ std_normal();
+}
+"""
+
+parser = argparse.ArgumentParser(description="Measure request latency with concurrent fits running.")
+parser.add_argument("--num-fits", type=int, default=32, help="Number of concurrent fits.")
+parser.add_argument("--num-samples", type=int, default=5000, help="Number of draws per fit.")
+parser.add_argument("--interval", type=float, default=0.01, help="Seconds between health check requests.")
+parser.add_argument("--port", type=int, default=8089, help="Port used by the server.")
+
+
+async def wait_for_operation(session: aiohttp.ClientSession, api_url: str, operation: dict) -> str:
+    """Poll an operation until it is done. Return the name of the fit."""
+    while not operation["done"]:
+        await asyncio.sleep(0.1)
+        async with session.get(f"{api_url}/operations/{operation['name'].split('/')[-1]}") as resp:
+            operation = await resp.json()
+    return operation["result"]["name"]
+
+
+async def poll_health(session: aiohttp.ClientSession, api_url: str, interval: float, done: asyncio.Event) -> list:
+    """Request the health endpoint repeatedly, recording latencies in seconds."""
+    latencies = []
+    while not done.is_set():
+        start = time.perf_counter()
+        async with session.get(f"{api_url}/health") as resp:
+            assert resp.status == 200
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def main(args: argparse.Namespace) -> None:
+    host, port = "127.0.0.1", args.port
+    api_url = f"http://{host}:{port}/v1"
+    runner = aiohttp.web.AppRunner(httpstan.app.make_app())
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, host, port)
+    await site.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{api_url}/models", json={"program_code": program_code}) as resp:
+                assert resp.status == 201, await resp.text()
+                model_name = (await resp.json())["name"]
+
+            done = asyncio.Event()
+            health_task = asyncio.create_task(poll_health(session, api_url, args.interval, done))
+            start = time.perf_counter()
+            operations: typing.List[dict] = []
+            for random_seed in range(args.num_fits):
+                payload = {
+                    "function": "stan::services::sample::hmc_nuts_diag_e_adapt",
+                    "num_samples": args.num_samples,
+                    "random_seed": random_seed,
+                }
+                async with session.post(f"{api_url}/{model_name}/fits", json=payload) as resp:
+                    assert resp.status == 201, await resp.text()
+                    operations.append(await resp.json())
+            fit_names = await asyncio.gather(*(wait_for_operation(session, api_url, op) for op in operations))
+            elapsed = time.perf_counter() - start
+            done.set()
+            latencies = sorted(await health_task)
+            # delete fits, otherwise the next run finds them in the cache
+            for fit_name in fit_names:
+                async with session.delete(f"{api_url}/{fit_name}") as resp:
+                    assert resp.status == 200, await resp.text()
+    finally:
+        await runner.cleanup()
+
+    def percentile(q: float) -> float:
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+    print(f"{args.num_fits} fits with {args.num_samples} draws each completed in {elapsed:.1f} s")
+    print(f"health check requests: {len(latencies)}")
+    print(f"latency (ms): median {statistics.median(latencies) * 1000:.1f}, ", end="")
+    print(f"p99 {percentile(0.99):.1f}, max {latencies[-1] * 1000:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""Test sending draws in binary frames and storing fits as columns."""
+
+import io
+import json
+import struct
+
+import aiohttp
+import numpy as np
+import pytest
+
+import httpstan.cache
+import httpstan.fits
+import httpstan.services_stub
+
+import helpers
+
+program_code = "parameters {vector[2] z;} model {z ~ normal(0, 1);}"
+
+
+def _without_timings(fit_bytes: bytes) -> list:
+    """Decode messages, without those which record timings."""
+    return [
+        message
+        for message in helpers.decode_messages(fit_bytes)
+        if message["topic"] != "logger" and "seconds" not in str(message["values"])
+    ]
+
+
+def _frame(frame_type: bytes, payload: bytes) -> bytes:
+    return b"\0" + frame_type + struct.pack("<I", len(payload)) + payload
+
+
+def test_frame_decoder() -> None:
+    """Test decoding messages and frames, split across chunks."""
+
+    logger_message = b'{"version":1,"topic":"logger","values":["info:Iteration: 1 / 2 [ 50%]  (Sampling)"]}'
+    adaptation_message = b'{"version":1,"topic":"sample","values":["Adaptation terminated"]}'
+    rows = np.array([[-0.5, np.nan, 1e-05], [-1.5, np.inf, -np.inf]])
+    data = b"".join(
+        [
+            _frame(
+                httpstan.fits.FRAME_HEADER, json.dumps({"topic": "sample", "names": ["lp__", "y.1", "y.2"]}).encode()
+            ),
+            logger_message + b"\n",
+            _frame(httpstan.fits.FRAME_ROW, rows[0].astype("<f8").tobytes()),
+            adaptation_message + b"\n",
+            _frame(httpstan.fits.FRAME_ROW, rows[1].astype("<f8").tobytes()),
+        ]
+    )
+    decoder = httpstan.fits.FrameDecoder()
+    messages = []
+    for start in range(0, len(data), 7):
+        messages.extend(decoder.feed(data[start : start + 7], json_rows=True))
+    assert messages[0] == logger_message
+    assert messages[2] == adaptation_message
+    assert json.loads(messages[1])["values"]["lp__"] == -0.5
+    assert decoder.num_rows("sample") == 2
+    assert bytes(decoder.messages) == logger_message + b"\n" + adaptation_message + b"\n"
+
+    fit_file = io.BytesIO(httpstan.fits.dump_columns([decoder]))
+    assert httpstan.fits.is_columns(fit_file)
+    assert httpstan.fits.open_messages(fit_file).read().splitlines() == messages
+    fit_file.seek(0)
+    names, draws = httpstan.fits.read_draws(fit_file)
+    assert names == ["lp__", "y.1", "y.2"]
+    assert draws.flags["F_CONTIGUOUS"]
+    np.testing.assert_array_equal(draws, rows)
+
+
+@pytest.mark.asyncio
+async def test_fits_binary_framing(api_url: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a fit sampled with binary framing matches one sampled without it."""
+
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123}
+    operation = await helpers.sample(api_url, program_code, payload)
+    fit_name = operation["result"]["name"]
+    fit_bytes = await helpers.fit_bytes(api_url, fit_name)
+    # the fit has the same name with binary framing. Delete it to sample again.
+    httpstan.cache.delete_fit(fit_name)
+
+    monkeypatch.setattr(httpstan.services_stub, "HTTPSTAN_BINARY_FRAMING", True)
+    operation = await helpers.sample(api_url, program_code, payload)
+    assert operation["result"]["name"] == fit_name
+    assert httpstan.cache.load_fit_metadata(fit_name)["format"] == "columns"
+    assert httpstan.cache.load_fit_metadata(fit_name)["num_draws"] == 1000
+    assert _without_timings(await helpers.fit_bytes(api_url, fit_name)) == _without_timings(fit_bytes)
+
+    async with aiohttp.ClientSession() as session:
+        fit_url = f"{api_url}/{fit_name}"
+        # columns are not sent as stored
+        async with session.get(fit_url, headers={"Accept-Encoding": "gzip"}) as resp:
+            assert resp.status == 200
+            assert "Content-Encoding" not in resp.headers
+            assert _without_timings(await resp.read()) == _without_timings(fit_bytes)
+        async with session.get(fit_url, headers={"Accept": "application/x-npz"}) as resp:
+            assert resp.status == 200
+            npz = np.load(io.BytesIO(await resp.read()))
+        assert np.array_equal(npz["draws"][:, list(npz["names"]).index("z.1")], helpers.extract("z.1", fit_bytes))
+        async with session.get(f"{api_url}/{operation['name']}/messages") as resp:
+            assert resp.status == 200
+            events = (await resp.read()).split(b"\n\n")
+    messages_bytes = b"\n".join(event[len(b"data: ") :] for event in events if event)
+    assert _without_timings(messages_bytes) == _without_timings(fit_bytes)
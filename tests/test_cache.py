@@ -1,5 +1,14 @@
 """Test services function argument lookups."""
 
+import gzip
+import os
+import pathlib
+import time
+from importlib.machinery import EXTENSION_SUFFIXES
+
+import aiohttp
+import aiohttp.web
+import numpy as np
 import pytest
 
 import httpstan.app
@@ -50,3 +59,191 @@ def test_delete_fit_keyerror_exception() -> None:
     fit_name = "models/abcdefghijklmnopqrs/fits/abcdefg"  # does not exist
     with pytest.raises(KeyError):
         httpstan.cache.delete_fit(fit_name)
+
+
+def test_load_fit_corrupt() -> None:
+    """Test that a truncated fit, or a fit without integrity metadata, is treated as missing."""
+    fit_name = "models/abcdefghijklmnopqrs/fits/corrupt"
+    fit_bytes = gzip.compress(b'{"topic": "sample"}\n' * 100)
+    httpstan.cache.dump_fit(fit_bytes, fit_name)
+    assert httpstan.cache.load_fit(fit_name) == fit_bytes
+    assert httpstan.cache.open_fit(fit_name).read() == fit_bytes
+
+    path = httpstan.cache.fit_path(fit_name)
+    path.write_bytes(fit_bytes[: len(fit_bytes) // 2])
+    with pytest.raises(KeyError):
+        httpstan.cache.load_fit(fit_name)
+    path.write_bytes(fit_bytes[:-1] + bytes([fit_bytes[-1] ^ 1]))
+    with pytest.raises(KeyError):
+        httpstan.cache.open_fit(fit_name)
+
+    httpstan.cache.dump_fit(fit_bytes, fit_name)
+    httpstan.cache.storage().delete(httpstan.cache.fit_metadata_key(fit_name))
+    with pytest.raises(KeyError):
+        httpstan.cache.load_fit(fit_name)
+    httpstan.cache.delete_model_directory("models/abcdefghijklmnopqrs")
+
+
+@pytest.mark.asyncio
+async def test_get_fit_corrupt(api_url: str) -> None:
+    """Test that a fit is checked as it is sent, and deleted if corrupt."""
+    fit_name = "models/abcdefghijklmnopqrs/fits/corrupt"
+    fit_bytes = gzip.compress(b'{"topic": "sample"}\n' * 100)
+    httpstan.cache.dump_fit(fit_bytes, fit_name)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{api_url}/{fit_name}", headers={"Accept-Encoding": "gzip"}) as resp:
+            assert resp.status == 200
+            assert await resp.read() == gzip.decompress(fit_bytes)
+
+        # same length, different checksum. The stored bytes are sent before the checksum is checked.
+        httpstan.cache.fit_path(fit_name).write_bytes(fit_bytes[:-1] + bytes([fit_bytes[-1] ^ 1]))
+        with pytest.raises(aiohttp.ClientPayloadError):
+            async with session.get(f"{api_url}/{fit_name}", headers={"Accept-Encoding": "gzip"}) as resp:
+                assert resp.status == 200
+                await resp.read()
+        async with session.get(f"{api_url}/{fit_name}") as resp:
+            assert resp.status == 404
+    httpstan.cache.delete_model_directory("models/abcdefghijklmnopqrs")
+
+
+@pytest.mark.asyncio
+async def test_load_fit_metadata(api_url: str) -> None:
+    """Test fit metadata, read without reading the fit."""
+    program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "num_samples": 150}
+    start = time.time()
+    operation = await helpers.sample(api_url, program_code, payload)
+    fit_name = operation["result"]["name"]
+    metadata = httpstan.cache.load_fit_metadata(fit_name)
+    assert metadata["num_draws"] == 150
+    assert metadata["length"] == len(httpstan.cache.load_fit(fit_name))
+    assert start <= metadata["created"] <= time.time()
+
+    path = httpstan.cache.fit_path(fit_name)
+    path.write_bytes(path.read_bytes()[:100])
+    with pytest.raises(KeyError):
+        httpstan.cache.load_fit_metadata(fit_name)
+
+
+@pytest.mark.asyncio
+async def test_create_fit_corrupt_cached_fit(api_url: str) -> None:
+    """Test that a corrupt cached fit is not served, and is replaced."""
+    program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123}
+    operation = await helpers.sample(api_url, program_code, payload)
+    fit_name = operation["result"]["name"]
+    fit_bytes = await helpers.fit_bytes(api_url, fit_name)
+
+    path = httpstan.cache.fit_path(fit_name)
+    path.write_bytes(path.read_bytes()[:100])
+    operation = await helpers.sample(api_url, program_code, payload)
+    assert operation["result"]["name"] == fit_name
+    assert helpers.extract("y", await helpers.fit_bytes(api_url, fit_name)) == helpers.extract("y", fit_bytes)
+
+
+def test_evict(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test least-recently-used and time-to-live eviction of models and fits."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    now = time.time()
+    for i, model_id in enumerate(["aaaaaaaa", "bbbbbbbb", "cccccccc"]):
+        model_directory = httpstan.cache.model_directory(f"models/{model_id}")
+        model_directory.mkdir(parents=True)
+        module_path = model_directory / f"stan_services_model{EXTENSION_SUFFIXES[0]}"
+        module_path.write_bytes(b"\0" * 1000)
+        # models used in order: bbbbbbbb, aaaaaaaa, cccccccc
+        os.utime(module_path, (now - [200, 300, 100][i],) * 2)
+        for j in range(2):
+            fit_name = f"models/{model_id}/fits/fit{j}"
+            httpstan.cache.dump_fit(b"\1" * 100, fit_name)
+            os.utime(httpstan.cache.fit_path(fit_name), (now - 10 * (3 * i + j) - 1,) * 2)
+    usage = httpstan.cache.cache_usage()
+    assert usage["models"] == {"count": 3, "bytes": 3000}
+    assert usage["fits"]["count"] == 6 and usage["fits"]["bytes"] > 600
+
+    # fits: models/cccccccc/fits/fit1 is least recently used
+    assert httpstan.cache.evict(max_fits=5) == ["models/cccccccc/fits/fit1"]
+    assert httpstan.cache.evict(max_fits=3) == ["models/cccccccc/fits/fit0", "models/bbbbbbbb/fits/fit1"]
+
+    # models: bbbbbbbb is least recently used but in use
+    assert httpstan.cache.evict(max_model_bytes=2500, in_use={"models/bbbbbbbb"}) == ["models/aaaaaaaa"]
+    assert httpstan.cache.list_model_names() == ["models/bbbbbbbb", "models/cccccccc"]
+    assert httpstan.cache.cache_usage()["fits"]["count"] == 1
+
+    # using a model protects it from eviction
+    httpstan.cache.record_access(next(httpstan.cache.model_directory("models/bbbbbbbb").glob("stan_services_*")))
+    assert httpstan.cache.evict(max_models=1) == ["models/cccccccc"]
+    assert httpstan.cache.evict(ttl=20) == ["models/bbbbbbbb/fits/fit0"]
+    assert httpstan.cache.evict(max_models=1, ttl=20) == []
+
+
+def test_evict_datasets_objects_precompiled_headers(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test eviction of data sets, object files and precompiled headers."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    now = time.time()
+    for i, dataset_name in enumerate(["datasets/aaaaaaaa", "datasets/bbbbbbbb", "datasets/cccccccc"]):
+        httpstan.cache.dump_dataset({"y": np.zeros(10)}, dataset_name)
+        # data sets used in order: bbbbbbbb, aaaaaaaa, cccccccc
+        os.utime(httpstan.cache.cache_directory() / dataset_name / "dataset.json", (now - [200, 300, 100][i],) * 2)
+    object_cache_directory = httpstan.cache.object_cache_directory()
+    object_cache_directory.mkdir(parents=True)
+    for i in range(3):
+        (object_cache_directory / f"object{i}.o").write_bytes(b"\0" * 100)
+        os.utime(object_cache_directory / f"object{i}.o", (now - 10 * i,) * 2)
+    # an object file being stored is not an entry
+    (object_cache_directory / ".httpstan_object.o").write_bytes(b"\0" * 100)
+    precompiled_header_directory = httpstan.cache.precompiled_header_directory()
+    for key, salt in [("old", "old salt"), ("new", "salt"), ("unknown", None), ("unused", "salt")]:
+        (precompiled_header_directory / key / "stan").mkdir(parents=True)
+        (precompiled_header_directory / key / "stan" / "model_header.hpp.gch").write_bytes(b"\0" * 1000)
+        if salt is not None:
+            (precompiled_header_directory / key / "salt").write_text(salt)
+    os.utime(precompiled_header_directory / "unused" / "stan" / "model_header.hpp.gch", (now - 100,) * 2)
+    # a header being precompiled is not an entry
+    (precompiled_header_directory / "precompiling").mkdir()
+
+    usage = httpstan.cache.cache_usage()
+    assert usage["datasets"]["count"] == 3 and usage["datasets"]["bytes"] > 3 * 80
+    assert usage["objects"] == {"count": 3, "bytes": 300}
+    assert usage["precompiled_headers"] == {"count": 4, "bytes": 4000}
+
+    # data sets: bbbbbbbb is least recently used but in use
+    assert httpstan.cache.evict(max_datasets=2, in_use={"datasets/bbbbbbbb"}) == ["datasets/aaaaaaaa"]
+    with pytest.raises(KeyError):
+        httpstan.cache.load_dataset_metadata("datasets/aaaaaaaa")
+    # using a data set protects it from eviction
+    httpstan.cache.load_dataset_metadata("datasets/bbbbbbbb")
+    assert httpstan.cache.evict(max_datasets=1) == ["datasets/cccccccc"]
+
+    assert httpstan.cache.evict(max_object_bytes=150) == ["objects/object2.o", "objects/object1.o"]
+    assert sorted(path.name for path in object_cache_directory.iterdir()) == [".httpstan_object.o", "object0.o"]
+
+    # precompiled headers: stale salts, or unused
+    assert sorted(httpstan.cache.evict(precompiled_header_salt="salt")) == ["precompiled/old", "precompiled/unknown"]
+    assert httpstan.cache.evict(ttl=50) == ["precompiled/unused"]
+    assert sorted(path.name for path in precompiled_header_directory.iterdir()) == ["new", "precompiling"]
+
+
+def test_in_use() -> None:
+    """Test that models and data sets used by unfinished operations are protected from eviction."""
+    app = aiohttp.web.Application()
+    app["model_builds"] = {"models/aaaaaaaa": None}
+    app["operations"] = {
+        "operations/1": {
+            "done": False,
+            "metadata": {"fit": {"name": "models/bbbbbbbb/fits/1"}, "dataset": {"name": "datasets/cccccccc"}},
+        },
+        "operations/2": {"done": True, "metadata": {"fits": [{"name": "models/dddddddd/fits/2"}]}},
+    }
+    assert httpstan.app._in_use(app) == {"models/aaaaaaaa", "models/bbbbbbbb", "datasets/cccccccc"}
+
+
+@pytest.mark.asyncio
+async def test_get_cache_usage(api_url: str) -> None:
+    program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+    await helpers.get_model_name(api_url, program_code)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{api_url}/cache") as resp:
+            assert resp.status == 200
+            usage = await resp.json()
+    assert usage["models"]["count"] >= 1 and usage["models"]["bytes"] > 0
+    assert usage["fits"]["count"] >= 0
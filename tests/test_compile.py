@@ -1,11 +1,20 @@
 """Test compiling functions."""
 
-import re
+import asyncio
+import gzip
+import logging
+import pathlib
+import time
+import typing
+from importlib.machinery import EXTENSION_SUFFIXES
 
 import aiohttp
 import pytest
 
+import httpstan.build_ext
+import httpstan.cache
 import httpstan.compile
+import httpstan.models
 
 
 def test_compile() -> None:
@@ -45,7 +54,8 @@ async def test_build_invalid_distribution(api_url: str) -> None:
 def test_compile_filename() -> None:
     program_code = "parameters {real y;} model {y ~ normal(0,1);}"
     cpp_code, _ = httpstan.compile.compile(program_code, "test_model")
-    assert re.search(r"httpstan_\S+/test_model.stan", cpp_code)
+    # name of the temporary directory is left out, so generated code does not vary
+    assert "(in 'test_model.stan'" in cpp_code
 
 
 @pytest.mark.asyncio
@@ -82,3 +92,186 @@ async def test_build_integer_division_warning(api_url: str) -> None:
     assert "compiler_output" in response_payload
     assert "stanc_warnings" in response_payload
     assert "int division" in response_payload["stanc_warnings"]
+
+
+@pytest.mark.asyncio
+async def test_build_concurrent(api_url: str, caplog: pytest.LogCaptureFixture) -> None:
+    """Test that concurrent requests to build the same model share one build."""
+
+    # comment makes the program (and the model name) unique
+    program_code = f"// {time.time_ns()}\nparameters {{real y;}} model {{y ~ normal(0,1);}}"
+    payload = {"program_code": program_code}
+    models_url = f"{api_url}/models"
+
+    async def build(session: aiohttp.ClientSession) -> dict:
+        async with session.post(models_url, json=payload) as resp:
+            assert resp.status == 201
+            return typing.cast(dict, await resp.json())
+
+    with caplog.at_level(logging.INFO, logger="httpstan"):
+        async with aiohttp.ClientSession() as session:
+            responses = await asyncio.gather(*(build(session) for _ in range(3)))
+            async with session.delete(f"{api_url}/{responses[0]['name']}") as resp:
+                assert resp.status == 200
+    assert all(response == responses[0] for response in responses)
+    assert sum("Building model-specific services extension module" in message for message in caplog.messages) == 1
+
+
+@pytest.mark.asyncio
+async def test_build_asynchronous(api_url: str) -> None:
+    """Test building a model as a long-running operation."""
+
+    # comment makes the program (and the model name) unique
+    program_code = f"// {time.time_ns()}\nparameters {{real y;}} model {{y ~ normal(0,1);}}"
+    payload = {"program_code": program_code, "asynchronous": True}
+    models_url = f"{api_url}/models"
+    progress = set()
+    async with aiohttp.ClientSession() as session:
+        async with session.post(models_url, json=payload) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+        model_name = operation["metadata"]["model"]["name"]
+        assert operation["name"] == f"operations/{model_name.split('/')[-1]}"
+        while not operation["done"]:
+            progress.add(operation["metadata"].get("progress"))
+            await asyncio.sleep(0.1)
+            async with session.get(f"{api_url}/{operation['name']}") as resp:
+                operation = await resp.json()
+        assert progress - {None} <= {"stanc", "compile", "link"}
+        assert "compile" in progress
+        assert operation["result"]["name"] == model_name
+        assert "compiler_output" in operation["result"]
+
+        # model is in the cache, operation is done immediately
+        async with session.post(models_url, json=payload) as resp:
+            assert resp.status == 201
+            cached_operation = await resp.json()
+        assert cached_operation["done"] and cached_operation["result"] == operation["result"]
+        async with session.delete(f"{api_url}/{model_name}") as resp:
+            assert resp.status == 200
+
+
+@pytest.mark.asyncio
+async def test_build_asynchronous_invalid_distribution(api_url: str) -> None:
+    """Check that compiler error is recorded in the operation."""
+
+    program_code = "parameters {real z;} model {z ~ no_such_distribution();}"
+    payload = {"program_code": program_code, "asynchronous": True}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/models", json=payload) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+        while not operation["done"]:
+            await asyncio.sleep(0.1)
+            async with session.get(f"{api_url}/{operation['name']}") as resp:
+                operation = await resp.json()
+    assert operation["result"]["code"] == 400
+    assert "Semantic error" in operation["result"]["message"]
+
+
+@pytest.mark.asyncio
+async def test_build_ext_in_subprocess_error(tmp_path: pathlib.Path) -> None:
+    """Check that an error in a build process is raised."""
+
+    extension = {"name": "no_such_module", "language": "c++", "sources": [str(tmp_path / "missing.cpp")]}
+    with pytest.raises(RuntimeError, match="missing.cpp"):
+        await httpstan.build_ext.run_build_ext_in_subprocess([extension], str(tmp_path))
+
+
+@pytest.mark.asyncio
+async def test_build_ext_object_cache(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that object files are reused from the object cache."""
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    (tmp_path / "include").mkdir()
+    (tmp_path / "include" / "answer.hpp").write_text("inline int answer() { return 42; }\n")
+    (tmp_path / "module.cpp").write_text('#include "answer.hpp"\nint module_answer() { return answer(); }\n')
+
+    def extension(include_dir: str) -> dict:
+        return {
+            "name": "module",
+            "language": "c++",
+            "sources": [str(tmp_path / "module.cpp")],
+            "include_dirs": [include_dir],
+        }
+
+    await httpstan.build_ext.run_build_ext_in_subprocess(
+        [extension(str(tmp_path / "include"))], str(tmp_path / "first"), object_cache_salt="salt"
+    )
+    assert len(list((tmp_path / "cache" / "httpstan" / "objects").iterdir())) == 1
+
+    # header is missing. Object is found in the cache, so nothing is compiled.
+    await httpstan.build_ext.run_build_ext_in_subprocess(
+        [extension(str(tmp_path / "missing"))], str(tmp_path / "second"), object_cache_salt="salt"
+    )
+    assert list((tmp_path / "second").glob("module*"))
+
+    # a different salt is a cache miss
+    with pytest.raises(RuntimeError, match="answer.hpp"):
+        await httpstan.build_ext.run_build_ext_in_subprocess(
+            [extension(str(tmp_path / "missing"))], str(tmp_path / "third"), object_cache_salt="other salt"
+        )
+
+
+@pytest.mark.asyncio
+async def test_build_ext_precompiled_header(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that the Stan model header is precompiled once and then used."""
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    header_path = tmp_path / "include" / httpstan.build_ext.PRECOMPILED_HEADER
+    header_path.parent.mkdir(parents=True)
+    header_path.write_text("inline int answer() { return 42; }\n")
+    (tmp_path / "module.cpp").write_text(
+        '#include "stan/model/model_header.hpp"\nint module_answer() { return answer(); }\n'
+    )
+    extension = {
+        "name": "module",
+        "language": "c++",
+        "sources": [str(tmp_path / "module.cpp")],
+        "include_dirs": [str(tmp_path / "include")],
+    }
+
+    await httpstan.build_ext.run_build_ext_in_subprocess(
+        [extension], str(tmp_path / "first"), precompiled_header_salt="salt"
+    )
+    (precompiled_path,) = (tmp_path / "cache" / "httpstan" / "precompiled").glob("*/stan/model/model_header.hpp.gch")
+    assert (precompiled_path.parents[2] / "salt").read_text() == "salt"
+    # precompiling again would replace the file
+    inode = precompiled_path.stat().st_ino
+
+    # the precompiled header is found before the header itself, which is no longer needed
+    header_path.write_text("#error header is not precompiled\n")
+    await httpstan.build_ext.run_build_ext_in_subprocess(
+        [extension], str(tmp_path / "second"), precompiled_header_salt="salt"
+    )
+    assert precompiled_path.stat().st_ino == inode
+    assert list((tmp_path / "second").glob("module*"))
+
+
+@pytest.mark.asyncio
+async def test_precompile_header(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that the Stan model header is precompiled with the arguments used by model builds."""
+
+    await httpstan.models.precompile_header()
+    directory = httpstan.cache.precompiled_header_directory()
+    keys = {path.parent.parent.parent for path in directory.glob("*/stan/model/model_header.hpp.gch")}
+    assert keys
+
+    # a model build finds the header precompiled
+    monkeypatch.setattr(httpstan.cache, "cache_directory", lambda: tmp_path)
+    await httpstan.models.build_services_extension_module("parameters {real z;} model {z ~ normal(0,1);}")
+    assert {path.parent.parent.parent for path in directory.glob("*/stan/model/model_header.hpp.gch")} == keys
+
+
+@pytest.mark.asyncio
+async def test_build_minimized_model_files(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that the extension module is stripped and the C++ code compressed."""
+
+    monkeypatch.setattr(httpstan.cache, "cache_directory", lambda: tmp_path)
+    program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+    await httpstan.models.build_services_extension_module(program_code)
+    model_directory = httpstan.cache.model_directory(httpstan.models.calculate_model_name(program_code))
+    cpp_code_path, module_path = sorted(model_directory.iterdir(), key=lambda path: path.suffix != ".gz")
+    assert cpp_code_path.name.endswith(".cpp.gz") and gzip.decompress(cpp_code_path.read_bytes())
+    assert module_path.suffix in EXTENSION_SUFFIXES
+    assert b".debug_info" not in module_path.read_bytes()
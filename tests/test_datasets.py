@@ -0,0 +1,122 @@
+"""Test data sets stored by httpstan and referred to by ID."""
+
+import io
+
+import aiohttp
+import numpy as np
+import pytest
+
+import httpstan.cache
+
+import helpers
+
+program_code = """
+data {
+  int<lower=0> N;
+  array[N] int<lower=0, upper=1> y;
+  real<lower=0> a;
+}
+parameters {
+  real<lower=0, upper=1> theta;
+}
+model {
+  theta ~ beta(a, 1);
+  y ~ bernoulli(theta);
+}
+"""
+
+data = {"N": 10, "y": [0, 1, 0, 0, 0, 0, 0, 0, 0, 1]}
+
+
+async def create_dataset(api_url: str, data: dict) -> dict:
+    """Store a data set, returning `Dataset`."""
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/datasets", json={"data": data}) as resp:
+            assert resp.status == 201
+            return dict(await resp.json())
+
+
+@pytest.mark.asyncio
+async def test_create_get_delete_dataset(api_url: str) -> None:
+    """Test storing, describing and deleting a data set."""
+    dataset = await create_dataset(api_url, data)
+    assert dataset["name"].startswith("datasets/")
+    assert dataset["variables"] == [
+        {"name": "N", "dtype": "<i4", "shape": []},
+        {"name": "y", "dtype": "<i4", "shape": [10]},
+    ]
+    # data sets are identified by their contents
+    assert (await create_dataset(api_url, {"y": np.array(data["y"]).tolist(), "N": 10}))["name"] == dataset["name"]
+    arrays = httpstan.cache.load_dataset(dataset["name"])
+    assert isinstance(arrays["y"], np.memmap)
+    assert arrays["y"].tolist() == data["y"]
+
+    # arrays in NumPy format in a multipart body
+    form = aiohttp.FormData()
+    form.add_field("args", "{}", content_type="application/json")
+    for name, value in data.items():
+        fh = io.BytesIO()
+        np.save(fh, np.array(value))
+        form.add_field(f"data.{name}", fh.getvalue(), content_type="application/x-npy", filename=f"{name}.npy")
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/datasets", data=form) as resp:
+            assert resp.status == 201
+            assert (await resp.json())["name"] == dataset["name"]
+
+        dataset_url = f"{api_url}/{dataset['name']}"
+        async with session.get(dataset_url) as resp:
+            assert resp.status == 200
+            assert await resp.json() == dataset
+        async with session.delete(dataset_url) as resp:
+            assert resp.status == 200
+        async with session.get(dataset_url) as resp:
+            assert resp.status == 404
+        async with session.delete(dataset_url) as resp:
+            assert resp.status == 404
+
+
+@pytest.mark.asyncio
+async def test_create_dataset_invalid(api_url: str) -> None:
+    """Test that data which cannot be stored as a data set is rejected."""
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/datasets", json={"data": {"../y": [1]}}) as resp:
+            assert resp.status == 400
+        async with session.post(f"{api_url}/datasets", json={"data": {"y": "abc"}}) as resp:
+            assert resp.status == 422
+
+
+@pytest.mark.asyncio
+async def test_data_id(api_url: str) -> None:
+    """Test that a data set is used like the data it holds."""
+    dataset_id = (await create_dataset(api_url, data))["name"].split("/")[-1]
+    model_name = await helpers.get_model_name(api_url, program_code)
+    log_prob_url = f"{api_url}/{model_name}/log_prob"
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            log_prob_url, json={"data": {**data, "a": 2}, "unconstrained_parameters": [0.3]}
+        ) as resp:
+            assert resp.status == 200
+            expected = (await resp.json())["log_prob"]
+        payload = {"data_id": dataset_id, "data": {"a": 2}, "unconstrained_parameters": [0.3]}
+        async with session.post(log_prob_url, json=payload) as resp:
+            assert resp.status == 200
+            assert (await resp.json())["log_prob"] == expected
+
+        # a variable may not be in both `data` and the data set
+        payload = {"data_id": dataset_id, "data": {"a": 2, "N": 10}, "unconstrained_parameters": [0.3]}
+        async with session.post(log_prob_url, json=payload) as resp:
+            assert resp.status == 400
+        payload = {"data_id": "aaaaaaaa", "data": {"a": 2}, "unconstrained_parameters": [0.3]}
+        async with session.post(log_prob_url, json=payload) as resp:
+            assert resp.status == 404
+        async with session.post(
+            f"{api_url}/{model_name}/params", json={"data_id": dataset_id, "data": {"a": 2}}
+        ) as resp:
+            assert resp.status == 200
+            assert (await resp.json())["params"][0]["name"] == "theta"
+
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "num_samples": 100, "random_seed": 1}
+    operation = await helpers.sample(api_url, program_code, {**payload, "data_id": dataset_id, "data": {"a": 2}})
+    theta = helpers.extract("theta", await helpers.fit_bytes(api_url, operation["result"]["name"]))
+    operation = await helpers.sample(api_url, program_code, {**payload, "data": {**data, "a": 2}})
+    assert helpers.extract("theta", await helpers.fit_bytes(api_url, operation["result"]["name"])) == theta
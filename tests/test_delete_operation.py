@@ -0,0 +1,67 @@
+"""Test deleting (cancelling) operations."""
+
+import asyncio
+import glob
+import os
+import tempfile
+import time
+
+import aiohttp
+import pytest
+
+import helpers
+
+program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+
+
+@pytest.mark.asyncio
+async def test_delete_operation_running(api_url: str) -> None:
+    """Test cancelling a running operation."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    socket_pattern = os.path.join(tempfile.gettempdir(), "httpstan_*.sock")
+    socket_filenames = set(glob.glob(socket_pattern))
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "num_samples": 10**8}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/{model_name}/fits", json=payload) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+        operation_url = f"{api_url}/{operation['name']}"
+        # wait until sampling has started
+        while "progress" not in operation["metadata"]:
+            await asyncio.sleep(0.1)
+            async with session.get(operation_url) as resp:
+                operation = await resp.json()
+
+        start = time.perf_counter()
+        async with session.delete(operation_url) as resp:
+            assert resp.status == 200
+        assert time.perf_counter() - start < 5
+
+        async with session.get(operation_url) as resp:
+            assert resp.status == 404
+        async with session.get(f"{api_url}/{operation['metadata']['fit']['name']}") as resp:
+            assert resp.status == 404
+    assert set(glob.glob(socket_pattern)) == socket_filenames
+
+    # worker is free to run another fit
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt"}
+    operation = await helpers.sample(api_url, program_code, payload)
+    assert "name" in operation["result"]
+
+
+@pytest.mark.asyncio
+async def test_delete_operation_done(api_url: str) -> None:
+    """Test deleting an operation which is done keeps its fit."""
+
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt"}
+    operation = await helpers.sample(api_url, program_code, payload)
+    async with aiohttp.ClientSession() as session:
+        async with session.delete(f"{api_url}/{operation['name']}") as resp:
+            assert resp.status == 200
+        async with session.get(f"{api_url}/{operation['name']}") as resp:
+            assert resp.status == 404
+        async with session.get(f"{api_url}/{operation['result']['name']}") as resp:
+            assert resp.status == 200
+        async with session.delete(f"{api_url}/{operation['name']}") as resp:
+            assert resp.status == 404
@@ -1,5 +1,6 @@
 """Test sampling."""
 
+import io
 import statistics
 from typing import Any, Dict, List, Optional, Union
 
@@ -7,6 +8,10 @@ import aiohttp
 import numpy as np
 import pytest
 
+import httpstan.datasets
+import httpstan.fits
+import httpstan.services_stub
+
 import helpers
 
 headers = {"content-type": "application/json"}
@@ -94,3 +99,132 @@ async def test_fits_vector_sizes(api_url: str) -> None:
     param_name = "x.1"
     with pytest.raises(KeyError, match="No draws found for parameter `x.1`."):
         await helpers.sample_then_extract(api_url, program_code_vector, payload, param_name)
+
+
+@pytest.mark.asyncio
+async def test_fits_num_chains(api_url: str) -> None:
+    """Test running several chains in one operation."""
+
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123, "num_chains": 3}
+    operation = await helpers.sample(api_url, program_code, payload)
+    fit_names = [fit["name"] for fit in operation["result"]["fits"]]
+    assert fit_names == [fit["name"] for fit in operation["metadata"]["fits"]]
+    assert len(set(fit_names)) == 3
+    draws = [helpers.extract("y", await helpers.fit_bytes(api_url, fit_name)) for fit_name in fit_names]
+    assert all(len(chain_draws) == 1000 for chain_draws in draws)
+    assert draws[0] != draws[1]
+
+    # chains match chains run one at a time
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123, "chain": 2}
+    assert await helpers.sample_then_extract(api_url, program_code, payload, "y") == draws[1]
+
+    # all chains are found in the cache
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123, "num_chains": 3}
+    cached_operation = await helpers.sample(api_url, program_code, payload)
+    assert cached_operation["result"] == operation["result"]
+
+
+@pytest.mark.asyncio
+async def test_fits_npz(api_url: str) -> None:
+    """Test retrieving draws as a NumPy archive."""
+
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123}
+    operation = await helpers.sample(api_url, program_code_vector, payload)
+    fit_name = operation["result"]["name"]
+    fit_bytes = await helpers.fit_bytes(api_url, fit_name)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{api_url}/{fit_name}", headers={"Accept": "application/x-npz"}) as resp:
+            assert resp.status == 200
+            assert resp.headers["Content-Type"] == "application/x-npz"
+            npz = np.load(io.BytesIO(await resp.read()))
+    names, draws = list(npz["names"]), npz["draws"]
+    assert names[0] == "lp__" and names[-2:] == ["z.1", "z.2"]
+    assert draws.shape == (1000, len(names))
+    assert np.array_equal(draws[:, names.index("z.1")], helpers.extract("z.1", fit_bytes))
+
+
+@pytest.mark.asyncio
+async def test_fits_content_encoding(api_url: str) -> None:
+    """Test retrieving a fit with and without gzip content encoding."""
+
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123}
+    operation = await helpers.sample(api_url, program_code, payload)
+    fit_url = f"{api_url}/{operation['result']['name']}"
+    async with aiohttp.ClientSession() as session:
+        async with session.get(fit_url, headers={"Accept-Encoding": "gzip"}) as resp:
+            assert resp.status == 200
+            assert resp.headers["Content-Encoding"] == "gzip"
+            fit_bytes_gzip = await resp.read()
+        async with session.get(fit_url, headers={"Accept-Encoding": "identity"}) as resp:
+            assert resp.status == 200
+            assert "Content-Encoding" not in resp.headers
+            assert resp.headers["Transfer-Encoding"] == "chunked"
+            fit_bytes_identity = await resp.read()
+    assert fit_bytes_gzip == fit_bytes_identity
+    assert len(helpers.extract("y", fit_bytes_identity)) == 1000
+
+
+def test_extract_draws() -> None:
+    """Test extracting draws from fit messages."""
+
+    lines = [
+        b'{"version":1,"topic":"logger","values":["info:Iteration: 1 / 2 [ 50%]  (Sampling)"]}',
+        b'{"version":1,"topic":"sample","values":["Adaptation terminated"]}',
+        b'{"version":1,"topic":"sample","values":{"lp__":-0.5,"y.1":NaN,"y.2":1e-05}}',
+        b'{"version":1,"topic":"sample","values":{"lp__":-1.5,"y.1":Infinity,"y.2":-Infinity}}',
+    ]
+    names, draws = httpstan.fits.extract_draws(lines)
+    assert names == ["lp__", "y.1", "y.2"]
+    assert draws.flags["F_CONTIGUOUS"]
+    np.testing.assert_array_equal(draws, [[-0.5, np.nan, 1e-05], [-1.5, np.inf, -np.inf]])
+
+
+def test_calculate_fit_name() -> None:
+    """Test that fit names depend on the values of data, not on how data are represented."""
+    data = httpstan.datasets.to_arrays({"x": [[1.0, 2.0], [3.0, 4.0]], "N": 2})
+    name = httpstan.fits.calculate_fit_name("hmc_nuts_diag_e_adapt", "models/abc", {"random_seed": 1, "data": data})
+    same_data = {"N": np.array(2, dtype=np.int32), "x": np.array([[1.0, 2.0], [3.0, 4.0]])}
+    kwargs = {"random_seed": 1, "data": same_data}
+    assert httpstan.fits.calculate_fit_name("hmc_nuts_diag_e_adapt", "models/abc", kwargs) == name
+    kwargs = {"random_seed": 1, "data": {**data, "x": data["x"].T}}
+    assert httpstan.fits.calculate_fit_name("hmc_nuts_diag_e_adapt", "models/abc", kwargs) != name
+
+
+@pytest.mark.asyncio
+async def test_fits_large_data(api_url: str) -> None:
+    """Test a fit with data large enough to be sent to the worker process in a file."""
+    program_code = "data {int N; vector[N] x;} parameters {real mu;} model {x ~ normal(mu, 1);}"
+    x = np.random.default_rng(1).normal(3, 1, size=20_000)
+    payload = {
+        "function": "stan::services::sample::hmc_nuts_diag_e_adapt",
+        "data": {"N": len(x), "x": x.tolist()},
+        "num_samples": 200,
+    }
+    mu = await helpers.sample_then_extract(api_url, program_code, payload, "mu")
+    assert abs(statistics.mean(mu) - x.mean()) < 0.1
+
+
+@pytest.mark.asyncio
+async def test_fits_large_data_num_chains(api_url: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that large data are written to files once for all chains of a fit."""
+    program_code = "data {int N; vector[N] x;} parameters {real mu;} model {x ~ normal(mu, 1);}"
+    x = np.random.default_rng(2).normal(-1, 1, size=20_000)
+    write_arrays_calls: List[dict] = []
+
+    def write_arrays(kwargs: dict, directory: str) -> Dict[str, Dict[str, str]]:
+        write_arrays_calls.append(kwargs)
+        return write_arrays_original(kwargs, directory)
+
+    write_arrays_original = httpstan.services_stub._write_arrays
+    monkeypatch.setattr(httpstan.services_stub, "_write_arrays", write_arrays)
+    payload = {
+        "function": "stan::services::sample::hmc_nuts_diag_e_adapt",
+        "data": {"N": len(x), "x": x.tolist()},
+        "num_samples": 200,
+        "num_chains": 3,
+    }
+    operation = await helpers.sample(api_url, program_code, payload)
+    assert len(write_arrays_calls) == 1
+    for fit in operation["result"]["fits"]:
+        mu = helpers.extract("mu", await helpers.fit_bytes(api_url, fit["name"]))
+        assert len(mu) == 200 and abs(statistics.mean(mu) - x.mean()) < 0.1
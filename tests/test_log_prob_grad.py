@@ -7,6 +7,8 @@ import aiohttp
 import numpy as np
 import pytest
 
+import httpstan.models
+
 import helpers
 
 program_code = """
@@ -43,3 +45,45 @@ async def test_log_prob_grad_analytically(x: float, api_url: str) -> None:
             httpstan_grad = response_payload["log_prob_grad"]
             gradient = gaussian_gradient(x, 0, 1)
             assert np.allclose(httpstan_grad, gradient)
+
+
+@pytest.mark.asyncio
+async def test_log_prob_grad_model_instance_reused(api_url: str) -> None:
+    """Test that repeated log_prob_grad requests reuse one model instance."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    models_params_url = f"{api_url}/{model_name}/log_prob_grad"
+    payload = {"data": {}, "unconstrained_parameters": [x], "adjust_transform": False}
+    async with aiohttp.ClientSession() as session:
+        for _ in range(2):
+            async with session.post(models_params_url, json=payload) as resp:
+                assert resp.status == 200
+    instance = await httpstan.models.get_model_instance(model_name, {})
+    assert instance is await httpstan.models.get_model_instance(model_name, {})
+    assert np.allclose(instance.log_prob_grad([x], False), gaussian_gradient(x, 0, 1))
+
+    httpstan.models.evict_services_extension_module(model_name)
+    assert instance is not await httpstan.models.get_model_instance(model_name, {})
+
+
+@pytest.mark.asyncio
+async def test_log_prob_grad_batch(api_url: str) -> None:
+    """Test batched log_prob_grad endpoint."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    models_params_url = f"{api_url}/{model_name}/log_prob_grad_batch"
+    xs = [random.uniform(0, 10) for _ in range(9)]
+    payload = {"data": {}, "unconstrained_parameters": [[x_] for x_ in xs], "adjust_transform": False}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(models_params_url, json=payload) as resp:
+            assert resp.status == 200
+            response_payload = await resp.json()
+    assert np.allclose(response_payload["log_prob"], [-(x_**2) / 2 for x_ in xs])
+    assert np.allclose(response_payload["log_prob_grad"], [gaussian_gradient(x_, 0, 1) for x_ in xs])
+
+    payload = {"data": {}, "unconstrained_parameters": [[x, x]], "adjust_transform": False}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(models_params_url, json=payload) as resp:
+            assert resp.status == 400
+            response_payload = await resp.json()
+            assert "number of parameters does not match" in response_payload["message"]
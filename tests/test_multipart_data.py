@@ -0,0 +1,99 @@
+"""Test data sent in NumPy ``.npy`` format in multipart request bodies."""
+
+import asyncio
+import io
+import json
+import typing
+
+import aiohttp
+import numpy as np
+import pytest
+
+import helpers
+
+program_code = """
+data {
+  int<lower=0> N;
+  array[N] int<lower=0, upper=1> y;
+  matrix[2, 3] X;
+}
+parameters {
+  real<lower=0, upper=1> theta;
+}
+model {
+  theta ~ beta(1 + sum(X), 1);
+  y ~ bernoulli(theta);
+}
+"""
+
+y = np.array([0, 1, 0, 0, 0, 0, 0, 0, 0, 1])
+X = np.arange(6.0).reshape(2, 3) / 10
+data = {"N": len(y), "y": y.tolist(), "X": X.tolist()}
+
+
+def multipart_body(args: dict, arrays: typing.Dict[str, np.ndarray]) -> aiohttp.FormData:
+    """Make a multipart body with JSON arguments and arrays in ``.npy`` format."""
+    form = aiohttp.FormData()
+    form.add_field("args", json.dumps(args), content_type="application/json")
+    for name, array in arrays.items():
+        fh = io.BytesIO()
+        np.save(fh, array, allow_pickle=False)
+        form.add_field(name, fh.getvalue(), content_type="application/x-npy", filename=f"{name}.npy")
+    return form
+
+
+@pytest.mark.asyncio
+async def test_log_prob_multipart(api_url: str) -> None:
+    """Test that arrays in a multipart body are used like data in a JSON body."""
+    model_name = await helpers.get_model_name(api_url, program_code)
+    log_prob_url = f"{api_url}/{model_name}/log_prob"
+    args = {"unconstrained_parameters": [0.3]}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(log_prob_url, json={"data": data, **args}) as resp:
+            assert resp.status == 200
+            expected = (await resp.json())["log_prob"]
+        body = multipart_body({"data": {"N": len(y)}, **args}, {"data.y": y, "data.X": X})
+        async with session.post(log_prob_url, data=body) as resp:
+            assert resp.status == 200
+            assert (await resp.json())["log_prob"] == expected
+
+
+@pytest.mark.asyncio
+async def test_create_fit_multipart(api_url: str) -> None:
+    """Test sampling with arrays in a multipart body."""
+    model_name = await helpers.get_model_name(api_url, program_code)
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "num_samples": 100, "random_seed": 1}
+    body = multipart_body(payload, {"data.N": np.array(len(y)), "data.y": y, "data.X": X})
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/{model_name}/fits", data=body) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+        while not operation["done"]:
+            await asyncio.sleep(0.1)
+            async with session.get(f"{api_url}/{operation['name']}") as resp:
+                operation = await resp.json()
+    theta = helpers.extract("theta", await helpers.fit_bytes(api_url, operation["result"]["name"]))
+    assert len(theta) == 100
+
+    # same draws as with data in a JSON body
+    operation = await helpers.sample(api_url, program_code, {**payload, "data": data})
+    assert helpers.extract("theta", await helpers.fit_bytes(api_url, operation["result"]["name"])) == theta
+
+
+@pytest.mark.parametrize(
+    "args,arrays,field",
+    [
+        ({"unconstrained_parameters": [0.3]}, {"data.y": np.array(["a"])}, "data.y"),
+        ({"unconstrained_parameters": [0.3]}, {"unconstrained_parameters.x": y}, "unconstrained_parameters.x"),
+        ({"unconstrained_parameters": [0.3], "data": {"y": [1]}}, {"data.y": y}, "data.y"),
+        ({}, {"data.y": y}, "unconstrained_parameters"),
+    ],
+)
+@pytest.mark.asyncio
+async def test_multipart_invalid(args: dict, arrays: dict, field: str, api_url: str) -> None:
+    """Test that invalid multipart bodies are rejected, naming the invalid part or field."""
+    model_name = await helpers.get_model_name(api_url, program_code)
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/{model_name}/log_prob", data=multipart_body(args, arrays)) as resp:
+            assert resp.status == 422
+            assert field in (await resp.json())["form"]
@@ -0,0 +1,131 @@
+"""Test streaming messages from operations."""
+
+import asyncio
+import json
+import socket
+import urllib.parse
+
+import aiohttp
+import pytest
+
+import httpstan.services_stub
+
+import helpers
+
+program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+
+
+async def read_events(api_url: str, operation_name: str) -> list:
+    """Read server-sent events from an operation's messages endpoint until the stream ends."""
+    messages = []
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{api_url}/{operation_name}/messages") as resp:
+            assert resp.status == 200
+            assert resp.headers["Content-Type"] == "text/event-stream"
+            async for line in resp.content:
+                if line.startswith(b"data: "):
+                    messages.append(json.loads(line[len(b"data: ") :]))
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_operation_messages(api_url: str) -> None:
+    """Test that draws are streamed from a running operation."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "num_samples": 20000}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/{model_name}/fits", json=payload) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+    messages = await read_events(api_url, operation["name"])
+    draws = [message for message in messages if message["topic"] == "sample" and "y" in message["values"]]
+    assert 0 < len(draws) <= 20000
+    assert any(message["topic"] == "logger" for message in messages)
+
+
+@pytest.mark.asyncio
+async def test_operation_messages_done(api_url: str) -> None:
+    """Test that messages from a finished operation are read from the fit."""
+
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt"}
+    operation = await helpers.sample(api_url, program_code, payload)
+    messages = await read_events(api_url, operation["name"])
+    draws = [message for message in messages if message["topic"] == "sample" and "y" in message["values"]]
+    assert len(draws) == 1000
+
+
+@pytest.mark.asyncio
+async def test_operation_messages_num_chains(api_url: str) -> None:
+    """Test that messages from every chain are streamed."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "num_chains": 2}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/{model_name}/fits", json=payload) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+    messages = await read_events(api_url, operation["name"])
+    draws = [message for message in messages if message["topic"] == "sample" and "y" in message["values"]]
+    assert 0 < len(draws) <= 2000
+
+    # once the operation is done, messages are read from both fits
+    while not operation["done"]:
+        await asyncio.sleep(0.1)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{api_url}/{operation['name']}") as resp:
+                operation = await resp.json()
+    assert len(operation["metadata"]["progress"]) == 2
+    assert all(progress.startswith("Iteration: 2000 / 2000") for progress in operation["metadata"]["progress"])
+    messages = await read_events(api_url, operation["name"])
+    draws = [message for message in messages if message["topic"] == "sample" and "y" in message["values"]]
+    assert len(draws) == 2000
+
+
+@pytest.mark.asyncio
+async def test_operation_messages_not_found(api_url: str) -> None:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{api_url}/operations/abcdefg/messages") as resp:
+            assert resp.status == 404
+
+
+@pytest.mark.asyncio
+async def test_operation_messages_idle_subscriber(api_url: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a subscriber which never reads does not pause the operation."""
+
+    monkeypatch.setattr(httpstan.services_stub, "MESSAGE_QUEUE_TIMEOUT", 0.5)
+    program_code = "parameters {vector[100] z;} model {z ~ normal(0,1);}"
+    model_name = await helpers.get_model_name(api_url, program_code)
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "num_samples": 5000}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/{model_name}/fits", json=payload) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+
+    # subscribe, with a small receive buffer, and read nothing
+    host, port = urllib.parse.urlsplit(api_url).netloc.split(":")
+    subscriber = socket.socket()
+    subscriber.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    subscriber.connect((host, int(port)))
+    subscriber.setblocking(False)
+    subscriber.sendall(f"GET /v1/{operation['name']}/messages HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+
+    # the operation finishes although the subscriber never reads
+    async with aiohttp.ClientSession() as session:
+        for _ in range(1200):
+            async with session.get(f"{api_url}/{operation['name']}") as resp:
+                operation = await resp.json()
+            if operation["done"]:
+                break
+            await asyncio.sleep(0.1)
+    assert operation["done"] and "result" in operation
+
+    # once read, the stream ends with an error event
+    loop = asyncio.get_running_loop()
+    received = b""
+    with subscriber:
+        while chunk := await asyncio.wait_for(loop.sock_recv(subscriber, 1024**2), timeout=10):
+            received += chunk
+            if b"event: error" in received and received.endswith(b"\r\n0\r\n\r\n"):
+                break
+    assert b'"code": 429' in received
@@ -2,6 +2,7 @@
 
 import random
 import string
+import typing
 from time import time
 
 import aiohttp
@@ -43,6 +44,35 @@ async def test_list_models(api_url: str) -> None:
     assert "stanc_warnings" in response_payload["models"].pop()
 
 
+@pytest.mark.asyncio
+async def test_list_models_pages(api_url: str) -> None:
+    """Test listing model names one page at a time."""
+
+    await helpers.get_model_name(api_url, program_code)
+    await helpers.get_model_name(api_url, "parameters {real z;} model {z ~ normal(0,1);}")
+    models_url = f"{api_url}/models"
+    async with aiohttp.ClientSession() as session:
+        async with session.get(models_url) as resp:
+            model_names = [model["name"] for model in (await resp.json())["models"]]
+        assert len(model_names) >= 2 and model_names == sorted(model_names)
+
+        page_model_names: typing.List[str] = []
+        params = {"page_size": "1", "names_only": "true"}
+        while True:
+            async with session.get(models_url, params=params) as resp:
+                assert resp.status == 200
+                response_payload = await resp.json()
+            assert len(response_payload["models"]) == 1 and response_payload["models"][0].keys() == {"name"}
+            page_model_names.extend(model["name"] for model in response_payload["models"])
+            if "next_page_token" not in response_payload:
+                break
+            params["page_token"] = response_payload["next_page_token"]
+        assert page_model_names == model_names
+
+        async with session.get(models_url, params={"page_size": "0"}) as resp:
+            assert resp.status == 422
+
+
 @pytest.mark.asyncio
 async def test_calculate_model_name(api_url: str) -> None:
     """Test model name calculation."""
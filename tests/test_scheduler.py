@@ -0,0 +1,80 @@
+"""Test scheduling of calls to stan::services functions."""
+
+import asyncio
+import typing
+
+import aiohttp
+import pytest
+
+import httpstan.scheduler
+
+import helpers
+
+program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+
+
+@pytest.mark.asyncio
+async def test_scheduler_round_robin() -> None:
+    """Test that waiting calls from different clients are started in turn."""
+
+    scheduler = httpstan.scheduler.FitScheduler(num_workers=1, max_queued=10)
+    started: typing.List[str] = []
+    release = asyncio.Event()
+
+    async def run(client: str) -> None:
+        async with scheduler.slot(client):
+            started.append(client)
+            await release.wait()
+
+    tasks = [asyncio.create_task(run(client)) for client in ["a", "a", "a", "b", "b", "c"]]
+    await asyncio.sleep(0)
+    assert started == ["a"]
+    assert scheduler.queue_depth == 5
+    release.set()
+    await asyncio.gather(*tasks)
+    assert started == ["a", "a", "b", "c", "a", "b"]
+    assert scheduler.num_running == 0 and scheduler.queue_depth == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_admission() -> None:
+    """Test that calls are rejected when the queue is full."""
+
+    scheduler = httpstan.scheduler.FitScheduler(num_workers=2, max_queued=1)
+    assert scheduler.can_admit(3)
+    assert not scheduler.can_admit(4)
+    release = asyncio.Event()
+
+    async def run() -> None:
+        async with scheduler.slot("a"):
+            await release.wait()
+
+    tasks = [asyncio.create_task(run()) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 1
+    assert not scheduler.can_admit()
+    assert scheduler.retry_after() >= 1
+
+    # cancelling a waiting call frees its place in the queue
+    tasks.pop().cancel()
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 0
+    assert scheduler.can_admit()
+    release.set()
+    await asyncio.gather(*tasks)
+    assert scheduler.num_running == 0
+
+
+@pytest.mark.asyncio
+async def test_fit_queue_metadata(api_url: str) -> None:
+    """Test that queue figures are recorded in operation metadata."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt"}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"{api_url}/{model_name}/fits", json=payload) as resp:
+            assert resp.status == 201
+            operation = await resp.json()
+    assert operation["metadata"]["queue_depth"] >= 0
+    operation = await helpers.sample(api_url, program_code, payload)
+    assert operation["metadata"]["queue_wait"] >= 0
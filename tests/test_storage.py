@@ -0,0 +1,230 @@
+"""Test storage backends."""
+
+import asyncio
+import http.server
+import io
+import pathlib
+import threading
+import time
+import typing
+import urllib.parse
+import xml.sax.saxutils
+
+import aiohttp
+import numpy as np
+import pytest
+
+import httpstan.cache
+import httpstan.models
+import httpstan.services_stub
+import httpstan.storage
+
+import helpers
+
+program_code = "parameters {real y;} model {y ~ normal(0,1);}"
+
+
+class S3RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle requests for a minimal S3-style bucket held in memory."""
+
+    objects: typing.Dict[str, bytes] = {}
+    max_keys = 2
+    # seconds each GET request waits before responding, standing in for a slow server
+    delay = 0.0
+    # if set, GET requests send the first half of a blob, then wait for the event before sending the rest
+    # of it. If the event is not set within five seconds, the rest is never sent.
+    hold: typing.Optional[threading.Event] = None
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+    def _key(self) -> str:
+        # path is /<bucket>/<key>
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        return path.split("/", maxsplit=2)[2]
+
+    def _respond(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        time.sleep(self.delay)
+        if "list-type" not in query:
+            key = self._key()
+            if key in self.objects and self.hold is not None:
+                blob = self.objects[key]
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(blob)))
+                self.end_headers()
+                self.wfile.write(blob[: len(blob) // 2])
+                self.wfile.flush()
+                # a client waiting for the whole blob gets only half of it
+                if self.hold.wait(timeout=5):
+                    self.wfile.write(blob[len(blob) // 2 :])
+                return
+            self._respond(200, self.objects[key]) if key in self.objects else self._respond(404)
+            return
+        prefix = query.get("prefix", [""])[0]
+        start = int(query.get("continuation-token", ["0"])[0])
+        keys = sorted(key for key in self.objects if key.startswith(prefix))
+        page = keys[start : start + self.max_keys]
+        truncated = start + self.max_keys < len(keys)
+        contents = "".join(f"<Contents><Key>{xml.sax.saxutils.escape(key)}</Key></Contents>" for key in page)
+        token = f"<NextContinuationToken>{start + self.max_keys}</NextContinuationToken>" if truncated else ""
+        body = (
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<IsTruncated>{str(truncated).lower()}</IsTruncated>{contents}{token}</ListBucketResult>"
+        )
+        self._respond(200, body.encode())
+
+    def do_HEAD(self) -> None:
+        key = self._key()
+        self._respond(200, self.objects[key]) if key in self.objects else self._respond(404)
+
+    def do_PUT(self) -> None:
+        self.objects[self._key()] = self.rfile.read(int(self.headers["Content-Length"]))
+        self._respond(200)
+
+    def do_DELETE(self) -> None:
+        self.objects.pop(self._key(), None)
+        self._respond(204)
+
+
+@pytest.fixture
+def bucket_url() -> typing.Iterator[str]:
+    """Run a minimal S3-style server, standing in for a real one."""
+    S3RequestHandler.objects, S3RequestHandler.delay, S3RequestHandler.hold = {}, 0.0, None
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), S3RequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/httpstan"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["local", "shared", "http"])
+def storage(request: pytest.FixtureRequest, tmp_path: pathlib.Path) -> httpstan.storage.Storage:
+    if request.param == "local":
+        return httpstan.storage.LocalStorage(tmp_path)
+    if request.param == "shared":
+        return httpstan.storage.from_url(f"file://{tmp_path}")
+    return httpstan.storage.from_url(request.getfixturevalue("bucket_url"))
+
+
+def test_storage(storage: httpstan.storage.Storage) -> None:
+    """Test storing, listing and deleting blobs."""
+
+    keys = ["models/a/stderr.log", "models/a/fits/1.jsonlines.gz", "models/a/fits/2.jsonlines.gz", "models/b/x"]
+    for key in keys:
+        storage.put(key, key.encode())
+    storage.put(keys[0], b"replaced")
+    assert storage.get(keys[0]) == b"replaced"
+    assert storage.open(keys[1]).read() == keys[1].encode()
+    assert storage.size(keys[1]) == len(keys[1])
+    assert storage.list("models/a/") == sorted(keys[:3])
+    assert storage.list("models/a/fits/2") == [keys[2]]
+    assert storage.list("models/c/") == []
+
+    storage.delete(keys[0])
+    with pytest.raises(KeyError):
+        storage.get(keys[0])
+    with pytest.raises(KeyError):
+        storage.open(keys[0])
+    with pytest.raises(KeyError):
+        storage.size(keys[0])
+    with pytest.raises(KeyError):
+        storage.delete(keys[0])
+
+
+def test_shared_filesystem_storage_atomic(tmp_path: pathlib.Path) -> None:
+    """Test that no temporary files are left behind."""
+
+    storage = httpstan.storage.SharedFilesystemStorage(tmp_path)
+    storage.put("models/a/stderr.log", b"output")
+    assert [path.name for path in (tmp_path / "models" / "a").iterdir()] == ["stderr.log"]
+
+
+@pytest.mark.asyncio
+async def test_fetch_services_extension_module(
+    api_url: str, bucket_url: str, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that a model stored by one machine is used by another."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    bucket = httpstan.storage.from_url(bucket_url)
+    monkeypatch.setattr(httpstan.cache, "storage", lambda: bucket)
+    # model is built on a different machine
+    httpstan.cache.dump_stanc_warnings("", model_name)
+    httpstan.cache.dump_services_extension_module_compiler_output("", model_name)
+    httpstan.cache.store_services_extension_module(model_name)
+    assert model_name in httpstan.cache.list_model_names()
+
+    # this machine, with a cache directory of its own, has no copy of the model
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    httpstan.models.evict_services_extension_module(model_name)
+    module = httpstan.models.import_services_extension_module(model_name)
+    assert module.model_name()
+    assert httpstan.cache.model_directory(model_name).is_relative_to(tmp_path)
+    assert any(httpstan.cache.model_directory(model_name).iterdir())
+
+
+def test_http_storage_open_streams(bucket_url: str) -> None:
+    """Test that a blob is read from an HTTP server as it arrives, not once all of it has arrived."""
+
+    storage = httpstan.storage.from_url(bucket_url)
+    storage.put("models/a/fits/1.jsonlines.gz", b"0123456789")
+    S3RequestHandler.hold = threading.Event()
+    with storage.open("models/a/fits/1.jsonlines.gz") as fh:
+        assert fh.read(5) == b"01234"
+        S3RequestHandler.hold.set()
+        assert fh.read() == b"56789"
+
+
+@pytest.mark.asyncio
+async def test_slow_storage_does_not_block(api_url: str, bucket_url: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a request waiting for the storage backend does not delay other requests."""
+
+    model_name = await helpers.get_model_name(api_url, program_code)
+    bucket = httpstan.storage.from_url(bucket_url)
+    monkeypatch.setattr(httpstan.cache, "storage", lambda: bucket)
+    httpstan.cache.dump_stanc_warnings("", model_name)
+    httpstan.cache.dump_services_extension_module_compiler_output("", model_name)
+    httpstan.cache.store_services_extension_module(model_name)
+
+    # listing models makes three GET requests, each taking a second
+    S3RequestHandler.delay = 1.0
+    async with aiohttp.ClientSession() as session:
+        list_models = asyncio.create_task(session.get(f"{api_url}/models"))
+        await asyncio.sleep(0.5)
+        start = time.monotonic()
+        async with session.get(f"{api_url}/health") as resp:
+            assert resp.status == 200
+        assert time.monotonic() - start < 0.5
+        assert not list_models.done()
+        async with await list_models as resp:
+            assert resp.status == 200
+            assert model_name in [model["name"] for model in (await resp.json())["models"]]
+
+
+@pytest.mark.asyncio
+async def test_http_storage_fit_columns(api_url: str, bucket_url: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test reading a fit stored as columns, which is read out of order, from an HTTP server."""
+
+    bucket = httpstan.storage.from_url(bucket_url)
+    monkeypatch.setattr(httpstan.cache, "storage", lambda: bucket)
+    monkeypatch.setattr(httpstan.services_stub, "HTTPSTAN_BINARY_FRAMING", True)
+    payload = {"function": "stan::services::sample::hmc_nuts_diag_e_adapt", "random_seed": 123}
+    operation = await helpers.sample(api_url, program_code, payload)
+    fit_name = operation["result"]["name"]
+    assert httpstan.cache.load_fit_metadata(fit_name)["format"] == "columns"
+
+    fit_bytes = await helpers.fit_bytes(api_url, fit_name)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{api_url}/{fit_name}", headers={"Accept": "application/x-npz"}) as resp:
+            assert resp.status == 200
+            npz = np.load(io.BytesIO(await resp.read()))
+    assert np.array_equal(npz["draws"][:, list(npz["names"]).index("y")], helpers.extract("y", fit_bytes))
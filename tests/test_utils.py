@@ -21,25 +21,25 @@ def test_data_split(data: Any) -> None:
     names_r, values_r, dim_r, names_i, values_i, dim_i = httpstan.utils._split_data(data)
     if "floating_only" in data:
         assert b"floating_only" in names_r
-        assert values_r
+        assert len(values_r)
         assert dim_r
         assert not names_i
-        assert not values_i
+        assert len(values_i) == 0
         assert not dim_i
     elif "integer_only" in data:
         assert not names_r
-        assert not values_r
+        assert len(values_r) == 0
         assert not dim_r
         assert b"integer_only" in names_i
-        assert values_i
+        assert len(values_i)
         assert dim_i
 
     else:
         assert b"floating" in names_r
-        assert values_r
+        assert len(values_r)
         assert dim_r
         assert b"integer" in names_i
-        assert values_i
+        assert len(values_i)
         assert dim_i
 
 
@@ -47,3 +47,21 @@ def test_data_split_invalid() -> None:
     """Test data split with invalid data."""
     with pytest.raises(ValueError, match=r"Variable `x` must be int or float\."):
         httpstan.utils._split_data({"x": np.array([1, 2, 3], dtype=object)})
+
+
+def test_data_split_column_major() -> None:
+    """Test that values are contiguous float64 and int32 arrays in column-major order."""
+    data = {"x": np.arange(6.0).reshape(2, 3), "y": 1.5, "n": np.arange(6).reshape(3, 2), "k": [7, 8]}
+    names_r, values_r, dim_r, names_i, values_i, dim_i = httpstan.utils._split_data(data)
+    assert names_r == [b"x", b"y"] and dim_r == [(2, 3), ()]
+    assert values_r.dtype == np.float64 and values_r.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(values_r, [0, 3, 1, 4, 2, 5, 1.5])
+    assert names_i == [b"n", b"k"] and dim_i == [(3, 2), (2,)]
+    assert values_i.dtype == np.int32 and values_i.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(values_i, [0, 2, 4, 1, 3, 5, 7, 8])
+
+
+def test_data_split_integer_overflow() -> None:
+    """Test data split with integers which do not fit in a C++ int."""
+    with pytest.raises(ValueError, match=r"Variable `x` must be within the range of a 32-bit integer\."):
+        httpstan.utils._split_data({"x": np.array([2**31])})